@@ -1,18 +1,30 @@
+import hmac
 import json
+import itertools
 import os
-import logging
+import httpx
 import requests
-from openai import AzureOpenAI
-import copy
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from azure.identity import DefaultAzureCredential
 from base64 import b64encode
-from flask import Flask, Response, request, jsonify, send_from_directory
+from flask import Flask, Response, abort, request, jsonify, stream_with_context
+from werkzeug.wsgi import wrap_file
 from dotenv import load_dotenv
-from opencensus.ext.azure.log_exporter import AzureLogHandler
 
+from backend.aoai.admission import AdmissionController, AdmissionRejected, UpstreamUnavailable, check_response, estimate_tokens, from_openai_error
+from backend.aoai.client_pool import AzureOpenAIClientPool
+from backend.aoai.datasources import CompletionSettings, DataSourceTemplate, parse_bool, parse_int, parse_multi_columns
+from backend.aoai.router import OPEN, ChatBackend, DeploymentRouter, UnknownModel
+from backend.aoai.streaming import relay_stream
+from backend.aoai.transport import ExtensionsTransport
 from backend.auth.auth_utils import get_authenticated_user_details
-from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.cache import TTLCache
+from backend.metrics import HTTP_REQUEST_SECONDS, REGISTRY, RequestTimer, chat_stage, current_timer, timed_stream
+from backend.static_files import StaticFiles
+from backend.telemetry import DEBUG_LOGGING, get_logger
+from backend.history.bulk_delete import BulkDeleteJobs
+from backend.history.cosmosdbservice import CosmosConversationClient, CONVERSATION_LIST_FIELDS, MESSAGE_FIELDS, decode_cursor, encode_cursor
 from backend.usersettings.cosmosdbserviceUserSettings import CosmosUserSettingsClient
 
 load_dotenv()
@@ -41,38 +53,68 @@ BETA_HEADER=os.environ.get("BETA_HEADER", "Beta")
 app = Flask(__name__, static_folder="static")
 
 # Static Files
+# Hashed build assets are cached for good, everything else is revalidated by ETag;
+# prebuilt .br/.gz variants are served when accepted. In memory, nothing is read from disk per request.
+STATIC_FILES_IN_MEMORY = os.environ.get("STATIC_FILES_IN_MEMORY", "false").lower() == "true"
+static_files = StaticFiles(app.static_folder, in_memory=STATIC_FILES_IN_MEMORY)
+
+def send_static(path):
+    selected = static_files.select(path, request.headers.get("Accept-Encoding", ""), request.headers.get("If-None-Match", ""))
+    if not selected:
+        abort(404)
+    status, headers, variant = selected
+    if not variant:
+        body = b""
+    elif variant.content is not None:
+        body = variant.content
+    else:
+        body = wrap_file(request.environ, open(variant.path, "rb"))
+    return Response(body, status=status, headers=headers, direct_passthrough=True)
+
 @app.route("/")
 def index():
-    return app.send_static_file("index.html")
+    return send_static("index.html")
 
 @app.route("/favicon.ico")
 def favicon():
-    return app.send_static_file('favicon.ico')
+    return send_static("favicon.ico")
 
 @app.route("/assets/<path:path>")
 def assets(path):
-    return send_from_directory("static/assets", path)
-
-# Debug settings
-DEBUG = os.environ.get("DEBUG", "false")
-DEBUG_LOGGING = DEBUG.lower() == "true"
-if DEBUG_LOGGING:
-    logging.basicConfig(level=logging.DEBUG)
-
-# Set up Azure App Insights logger
-try:
-    app_insights_conn_str = os.environ.get("AZURE_APP_INSIGHTS_CONNECTION_STRING", "")
-    logger = logging.getLogger(__name__)
-    handler = AzureLogHandler(connection_string=app_insights_conn_str)
-    logger.addHandler(handler)
-    if DEBUG_LOGGING:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
-    logger.info("Loaded Azure App Insights")
-except Exception as e:
-    raise Exception(f"Exception initializing Azure App Insights logger: {e}")
+    return send_static(f"assets/{path}")
+
+@app.before_request
+def start_request_timer():
+    current_timer.set(RequestTimer())
+
+@app.after_request
+def record_request_timing(response):
+    timer = current_timer.get()
+    if timer:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_REQUEST_SECONDS.observe(timer.elapsed(), request.method, route, response.status_code)
+        if METRICS_TIMING_HEADERS and timer.stages:
+            response.headers["Server-Timing"] = timer.server_timing()
+    return response
 
+@app.route("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        abort(404)
+    ## deployment names, circuit states and cache sizes are not for everyone who can reach the app
+    authorization = request.headers.get("Authorization", "").encode("utf-8")
+    if METRICS_TOKEN and not hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}".encode("utf-8")):
+        return Response("Unauthorized", status=401, headers={"WWW-Authenticate": "Bearer"})
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# Shared App Insights log pipeline
+logger = get_logger(__name__)
+logger.info("Loaded Azure App Insights")
+
+# Metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+METRICS_TIMING_HEADERS = os.environ.get("METRICS_TIMING_HEADERS", "false").lower() == "true"
 
 # On Your Data Settings
 DATASOURCE_TYPE = os.environ.get("DATASOURCE_TYPE", "AzureCognitiveSearch")
@@ -96,6 +138,9 @@ AZURE_SEARCH_VECTOR_COLUMNS = os.environ.get("AZURE_SEARCH_VECTOR_COLUMNS")
 AZURE_SEARCH_QUERY_TYPE = os.environ.get("AZURE_SEARCH_QUERY_TYPE")
 AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN")
 AZURE_SEARCH_STRICTNESS = os.environ.get("AZURE_SEARCH_STRICTNESS", SEARCH_STRICTNESS)
+AZURE_SEARCH_GROUPS_CACHE_TTL = os.environ.get("AZURE_SEARCH_GROUPS_CACHE_TTL", 300)
+AZURE_SEARCH_GROUPS_CACHE_MAX_ENTRIES = os.environ.get("AZURE_SEARCH_GROUPS_CACHE_MAX_ENTRIES", 1024)
+AZURE_SEARCH_GROUPS_CACHE_REFRESH_AHEAD = os.environ.get("AZURE_SEARCH_GROUPS_CACHE_REFRESH_AHEAD", 0)
 
 # AOAI Integration Settings
 AZURE_OPENAI_RESOURCE = os.environ.get("AZURE_OPENAI_RESOURCE")
@@ -113,6 +158,24 @@ AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME", "gpt-35-turb
 AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ.get("AZURE_OPENAI_EMBEDDING_ENDPOINT")
 AZURE_OPENAI_EMBEDDING_KEY = os.environ.get("AZURE_OPENAI_EMBEDDING_KEY")
 AZURE_OPENAI_EMBEDDING_NAME = os.environ.get("AZURE_OPENAI_EMBEDDING_NAME", "")
+AZURE_OPENAI_POOL_MAX_CONNECTIONS = os.environ.get("AZURE_OPENAI_POOL_MAX_CONNECTIONS", 100)
+AZURE_OPENAI_POOL_MAX_KEEPALIVE = os.environ.get("AZURE_OPENAI_POOL_MAX_KEEPALIVE", 20)
+AZURE_OPENAI_POOL_KEEPALIVE_EXPIRY = os.environ.get("AZURE_OPENAI_POOL_KEEPALIVE_EXPIRY", 30)
+AZURE_OPENAI_CONNECT_TIMEOUT = os.environ.get("AZURE_OPENAI_CONNECT_TIMEOUT", 10)
+AZURE_OPENAI_READ_TIMEOUT = os.environ.get("AZURE_OPENAI_READ_TIMEOUT", 60)
+AZURE_OPENAI_HTTP2 = os.environ.get("AZURE_OPENAI_HTTP2", "true").lower() == "true"
+AZURE_OPENAI_TITLE_WORKERS = os.environ.get("AZURE_OPENAI_TITLE_WORKERS", 8)
+AZURE_OPENAI_TPM_LIMIT = os.environ.get("AZURE_OPENAI_TPM_LIMIT", 0)
+AZURE_OPENAI_RPM_LIMIT = os.environ.get("AZURE_OPENAI_RPM_LIMIT", 0)
+AZURE_OPENAI_MAX_CONCURRENCY = os.environ.get("AZURE_OPENAI_MAX_CONCURRENCY", 0)
+AZURE_OPENAI_DEPLOYMENT_LIMITS = os.environ.get("AZURE_OPENAI_DEPLOYMENT_LIMITS")
+AZURE_OPENAI_ADMISSION_QUEUE = os.environ.get("AZURE_OPENAI_ADMISSION_QUEUE", 32)
+AZURE_OPENAI_ADMISSION_MAX_WAIT = os.environ.get("AZURE_OPENAI_ADMISSION_MAX_WAIT", 10)
+AZURE_OPENAI_MAX_RETRIES = os.environ.get("AZURE_OPENAI_MAX_RETRIES", 2)
+AZURE_OPENAI_DEPLOYMENT_POOLS = os.environ.get("AZURE_OPENAI_DEPLOYMENT_POOLS")
+AZURE_OPENAI_DEPLOYMENTS = os.environ.get("AZURE_OPENAI_DEPLOYMENTS", "gpt-35-turbo,gpt-4") ## These are available Deployments, not Models in Azure
+AZURE_OPENAI_CIRCUIT_FAILURES = os.environ.get("AZURE_OPENAI_CIRCUIT_FAILURES", 3)
+AZURE_OPENAI_CIRCUIT_COOLDOWN = os.environ.get("AZURE_OPENAI_CIRCUIT_COOLDOWN", 30)
 
 # CosmosDB Mongo vcore vector db Settings
 AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING = os.environ.get("AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING")  #This has to be secure string
@@ -128,7 +191,15 @@ AZURE_COSMOSDB_MONGO_VCORE_TITLE_COLUMN = os.environ.get("AZURE_COSMOSDB_MONGO_V
 AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN = os.environ.get("AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN")
 AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS = os.environ.get("AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS")
 
-SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
+COMPLETION_SETTINGS = CompletionSettings.from_env(
+    temperature=AZURE_OPENAI_TEMPERATURE,
+    max_tokens=AZURE_OPENAI_MAX_TOKENS,
+    top_p=AZURE_OPENAI_TOP_P,
+    stop_sequence=AZURE_OPENAI_STOP_SEQUENCE,
+    stream=AZURE_OPENAI_STREAM
+)
+SHOULD_STREAM = COMPLETION_SETTINGS.stream
+COMPLETION_PARAMETERS = COMPLETION_SETTINGS.as_parameters()
 
 # Chat History CosmosDB Integration Settings
 AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
@@ -138,6 +209,14 @@ AZURE_COSMOSDB_USERSETTINGS_CONTAINER = os.environ.get("AZURE_COSMOSDB_USERSETTI
 AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
 AZURE_COSMOSDB_ENABLE_FEEDBACK = os.environ.get("AZURE_COSMOSDB_ENABLE_FEEDBACK", "false").lower() == "true"
 AZURE_COSMOSDB_SUFFIX = os.environ.get("AZURE_COSMOSDB_SUFFIX", ".us")
+AZURE_COSMOSDB_DELETE_CONCURRENCY = os.environ.get("AZURE_COSMOSDB_DELETE_CONCURRENCY", 4)
+AZURE_COSMOSDB_CACHE_TTL = os.environ.get("AZURE_COSMOSDB_CACHE_TTL", 300)
+AZURE_COSMOSDB_CACHE_MAX_ENTRIES = os.environ.get("AZURE_COSMOSDB_CACHE_MAX_ENTRIES", 4096)
+AZURE_COSMOSDB_CACHE_FRESH = os.environ.get("AZURE_COSMOSDB_CACHE_FRESH", 5)
+AZURE_COSMOSDB_USERSETTINGS_CACHE_TTL = os.environ.get("AZURE_COSMOSDB_USERSETTINGS_CACHE_TTL", 300)
+
+# Conversations returned per /history/list page
+HISTORY_PAGE_SIZE = 25
 
 # Elasticsearch Integration Settings
 ELASTICSEARCH_ENDPOINT = os.environ.get("ELASTICSEARCH_ENDPOINT")
@@ -154,7 +233,6 @@ ELASTICSEARCH_VECTOR_COLUMNS = os.environ.get("ELASTICSEARCH_VECTOR_COLUMNS")
 ELASTICSEARCH_STRICTNESS = os.environ.get("ELASTICSEARCH_STRICTNESS", SEARCH_STRICTNESS)
 ELASTICSEARCH_EMBEDDING_MODEL_ID = os.environ.get("ELASTICSEARCH_EMBEDDING_MODEL_ID")
 
-message_uuid = ""
 
 # Initialize a CosmosDB client with AAD auth and containers for Chat History and User Settings
 cosmos_conversation_client = None
@@ -163,7 +241,7 @@ cosmos_usersettings_client = None
 if AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER and AZURE_COSMOSDB_USERSETTINGS_CONTAINER:
     try :
         cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure{AZURE_COSMOSDB_SUFFIX}:443/'
-        logger.debug(f"CosmosDB endpoint: {cosmos_endpoint}")
+        logger.debug("CosmosDB endpoint: %s", cosmos_endpoint)
 
         if not AZURE_COSMOSDB_ACCOUNT_KEY:
             credential = DefaultAzureCredential()
@@ -175,20 +253,121 @@ if AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERS
             credential=credential, 
             database_name=AZURE_COSMOSDB_DATABASE,
             container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
-            enable_message_feedback = AZURE_COSMOSDB_ENABLE_FEEDBACK
+            enable_message_feedback = AZURE_COSMOSDB_ENABLE_FEEDBACK,
+            cache=TTLCache(
+                max_entries=int(AZURE_COSMOSDB_CACHE_MAX_ENTRIES),
+                ttl=float(AZURE_COSMOSDB_CACHE_TTL),
+                name="conversations"
+            ),
+            cache_fresh=float(AZURE_COSMOSDB_CACHE_FRESH)
         )
 
         cosmos_usersettings_client = CosmosUserSettingsClient(
             cosmosdb_endpoint=cosmos_endpoint, 
             credential=credential, 
             database_name=AZURE_COSMOSDB_DATABASE,
-            container_name=AZURE_COSMOSDB_USERSETTINGS_CONTAINER
+            container_name=AZURE_COSMOSDB_USERSETTINGS_CONTAINER,
+            cache=TTLCache(
+                max_entries=int(AZURE_COSMOSDB_CACHE_MAX_ENTRIES),
+                ttl=float(AZURE_COSMOSDB_USERSETTINGS_CACHE_TTL),
+                name="usersettings"
+            )
         )
     except Exception as e:
-        logger.exception("Exception in CosmosDB initialization", e)
+        logger.exception("Exception in CosmosDB initialization")
         cosmos_conversation_client = None
         cosmos_usersettings_client = None
 
+# Shared Azure OpenAI clients, reused across requests and worker threads.
+# Retries are left to the admission controller, which honours Retry-After across all requests.
+azure_openai_client_pool = AzureOpenAIClientPool(
+    api_key=AZURE_OPENAI_KEY,
+    max_connections=int(AZURE_OPENAI_POOL_MAX_CONNECTIONS),
+    max_keepalive_connections=int(AZURE_OPENAI_POOL_MAX_KEEPALIVE),
+    keepalive_expiry=float(AZURE_OPENAI_POOL_KEEPALIVE_EXPIRY),
+    max_retries=0
+)
+
+# Per-deployment limits on the Azure OpenAI calls this worker starts, with a bounded wait queue
+admission_controller = AdmissionController(
+    tpm=int(AZURE_OPENAI_TPM_LIMIT),
+    rpm=int(AZURE_OPENAI_RPM_LIMIT),
+    max_concurrency=int(AZURE_OPENAI_MAX_CONCURRENCY),
+    max_queue=int(AZURE_OPENAI_ADMISSION_QUEUE),
+    max_wait=float(AZURE_OPENAI_ADMISSION_MAX_WAIT),
+    max_retries=int(AZURE_OPENAI_MAX_RETRIES),
+    deployments=json.loads(AZURE_OPENAI_DEPLOYMENT_LIMITS) if AZURE_OPENAI_DEPLOYMENT_LIMITS else {}
+)
+
+# Pools of deployments per logical model, across regions or PTU/PAYG; models without one use the single configured resource
+deployment_router = DeploymentRouter(
+    admission_controller,
+    pools={model: [ChatBackend.from_config(model, config, AZURE_OPENAI_KEY) for config in configs]
+           for model, configs in json.loads(AZURE_OPENAI_DEPLOYMENT_POOLS).items()} if AZURE_OPENAI_DEPLOYMENT_POOLS else {},
+    default_backend=lambda model: ChatBackend(name=model, endpoint=get_azure_openai_endpoint(), deployment=model, api_key=AZURE_OPENAI_KEY),
+    ## only the deployments offered to the frontend are routed, any other model in a request is refused
+    models=[AZURE_OPENAI_MODEL, *(name.strip() for name in AZURE_OPENAI_DEPLOYMENTS.split(",") if name.strip())],
+    failure_threshold=int(AZURE_OPENAI_CIRCUIT_FAILURES),
+    cooldown=float(AZURE_OPENAI_CIRCUIT_COOLDOWN)
+)
+
+# Shared connection pool for the on-your-data extensions endpoint
+extensions_transport = ExtensionsTransport(
+    max_connections=int(AZURE_OPENAI_POOL_MAX_CONNECTIONS),
+    max_keepalive_connections=int(AZURE_OPENAI_POOL_MAX_KEEPALIVE),
+    keepalive_expiry=float(AZURE_OPENAI_POOL_KEEPALIVE_EXPIRY),
+    connect_timeout=float(AZURE_OPENAI_CONNECT_TIMEOUT),
+    read_timeout=float(AZURE_OPENAI_READ_TIMEOUT),
+    http2=AZURE_OPENAI_HTTP2
+)
+
+# Conversation titles are generated off the request path, concurrently with the answer
+title_executor = ThreadPoolExecutor(max_workers=int(AZURE_OPENAI_TITLE_WORKERS), thread_name_prefix="title")
+
+# Group membership (and the finished security filter) per user principal, for security trimming
+user_groups_cache = TTLCache(
+    max_entries=int(AZURE_SEARCH_GROUPS_CACHE_MAX_ENTRIES),
+    ttl=float(AZURE_SEARCH_GROUPS_CACHE_TTL),
+    refresh_ahead=float(AZURE_SEARCH_GROUPS_CACHE_REFRESH_AHEAD),
+    name="user-groups"
+)
+
+# Background "clear all history" jobs started by /history/delete_all?background=true
+## saved in the user's partition, so a poll that reaches another worker or instance finds the job
+bulk_delete_jobs = BulkDeleteJobs(store=cosmos_conversation_client)
+
+def collect_component_stats():
+    # Exported on /metrics from the stats the shared clients and caches already keep
+    pool = azure_openai_client_pool.stats()
+    yield ("aoai_client_pool_clients", "gauge", "Cached Azure OpenAI clients.", (), [((), pool["clients"])])
+    yield ("aoai_client_pool_hits_total", "counter", "Azure OpenAI client lookups served from the pool.", (), [((), pool["hits"])])
+    yield ("aoai_client_pool_misses_total", "counter", "Azure OpenAI clients created.", (), [((), pool["misses"])])
+    yield ("aoai_client_pool_evictions_total", "counter", "Azure OpenAI clients dropped to stay within the pool's cap.", (), [((), pool["evictions"])])
+    admission = admission_controller.stats()
+    yield ("aoai_admission_active", "gauge", "Azure OpenAI calls in flight.", ("deployment",),
+           [((deployment,), s["active"]) for deployment, s in admission.items()])
+    yield ("aoai_admission_waiting", "gauge", "Requests queued for an Azure OpenAI slot.", ("deployment",),
+           [((deployment,), s["waiting"]) for deployment, s in admission.items()])
+    backends = deployment_router.stats()
+    yield ("aoai_backend_outstanding", "gauge", "Azure OpenAI calls in flight per routed backend.", ("backend",),
+           [((name,), s["outstanding"]) for name, s in backends.items()])
+    yield ("aoai_backend_ttft_seconds", "gauge", "Moving average time to first token per routed backend.", ("backend",),
+           [((name,), s["ttft"]) for name, s in backends.items() if s["ttft"] is not None])
+    yield ("aoai_backend_circuit_open", "gauge", "1 while a backend is out of rotation after throttling or failures.", ("backend",),
+           [((name,), int(s["state"] == OPEN)) for name, s in backends.items()])
+
+    caches = [user_groups_cache]
+    if cosmos_conversation_client:
+        caches.append(cosmos_conversation_client.cache)
+    if cosmos_usersettings_client:
+        caches.append(cosmos_usersettings_client.cache)
+    stats = [(cache.name, cache.stats()) for cache in caches]
+    yield ("cache_entries", "gauge", "Entries held by each cache.", ("cache",), [((name,), s["entries"]) for name, s in stats])
+    for key in ("hits", "misses", "refreshes"):
+        yield (f"cache_{key}_total", "counter", f"Cache {key}.", ("cache",), [((name,), s[key]) for name, s in stats])
+
+REGISTRY.register_collector(collect_component_stats)
+
 def is_chat_model():
     if 'gpt-4' in AZURE_OPENAI_MODEL_NAME.lower() or AZURE_OPENAI_MODEL_NAME.lower() in ['gpt-35-turbo-4k', 'gpt-35-turbo-16k']:
         return True
@@ -210,260 +389,261 @@ def should_use_data():
 def format_as_ndjson(obj: dict) -> str:
     return json.dumps(obj, ensure_ascii=False) + "\n"
 
-def parse_multi_columns(columns: str) -> list:
-    if "|" in columns:
-        return columns.split("|")
-    else:
-        return columns.split(",")
+GRAPH_USER_GROUPS_ENDPOINT = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id&$top=999"
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
-    
+# Keep-alive session for Graph, so following nextLink pages reuses one connection
+graph_session = requests.Session()
+
+def fetchUserGroups(userToken):
+    # Follow @odata.nextLink page by page (largest page size Graph allows), streaming ids into a set
     headers = {
         'Authorization': "bearer " + userToken
     }
-    try :
-        r = requests.get(endpoint, headers=headers)
+    group_ids = set()
+    endpoint = GRAPH_USER_GROUPS_ENDPOINT
+    while endpoint:
+        r = graph_session.get(endpoint, headers=headers, timeout=10)
         if r.status_code != 200:
-            if DEBUG_LOGGING:
-                logger.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
-        
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r['value'].extend(nextLinkData)
-        
-        return r['value']
-    except Exception as e:
-        logger.error(f"Exception in fetchUserGroups: {e}")
-        return []
+            raise Exception(f"Error fetching user groups: {r.status_code} {r.text}")
+
+        page = r.json()
+        group_ids.update(obj['id'] for obj in page.get('value', []))
+        endpoint = page.get("@odata.nextLink")
+
+    return group_ids
+
 
+def buildFilterString(group_ids):
+    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{','.join(group_ids)}'))"
 
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
 
-    # Construct filter string
-    if not userGroups:
+def loadUserGroupFilter(userToken):
+    group_ids = frozenset(fetchUserGroups(userToken))
+    if not group_ids:
         logger.debug("No user groups found")
+    return group_ids, buildFilterString(group_ids)
 
-    group_ids = ", ".join([obj['id'] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
 
+def generateFilterString(userToken, user_id=None):
+    # Get list of groups user is a member of, served from the per-user cache when possible
+    try:
+        with chat_stage("graph_groups"):
+            if user_id:
+                group_ids, filter_string = user_groups_cache.get(user_id, lambda: loadUserGroupFilter(userToken))
+            else:
+                group_ids, filter_string = loadUserGroupFilter(userToken)
+        if DEBUG_LOGGING:
+            logger.debug(f"User group cache: {user_groups_cache.stats()}")
+        return filter_string
+    except Exception as e:
+        logger.error(f"Exception in fetchUserGroups: {e}")
+        return buildFilterString([])
 
 
-def prepare_body_headers_with_data(request):
-    request_messages = request.json["messages"]
+def get_azure_openai_endpoint():
+    return AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
 
-    body = {
-        "messages": request_messages,
-        "temperature": float(AZURE_OPENAI_TEMPERATURE),
-        "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
-        "top_p": float(AZURE_OPENAI_TOP_P),
-        "stop": AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
-        "stream": SHOULD_STREAM,
-        "dataSources": []
-    }
+def deployment_name(model):
+    # The logical model a request is routed for; requests without a model use the configured one
+    name = model or AZURE_OPENAI_MODEL
+    if not deployment_router.routes(name):
+        raise UnknownModel(f"No Azure OpenAI deployment is configured for {name}")
+    return name
+
+def get_extensions_endpoint(model, endpoint=None):
+    return f"{endpoint or get_azure_openai_endpoint()}openai/deployments/{model}/extensions/chat/completions?api-version={AZURE_OPENAI_PREVIEW_API_VERSION}"
+
+def backend_extensions_request(backend, headers, body, stream=False):
+    # The extensions call for one routed backend, with that backend's deployment and key
+    endpoint = get_extensions_endpoint(backend.deployment, backend.endpoint)
+    return send_extensions_request(endpoint, {**headers, 'api-key': backend.api_key}, body, stream=stream)
+
+def get_backend_client(backend):
+    return azure_openai_client_pool.get_client(backend.endpoint, backend.deployment, AZURE_OPENAI_PREVIEW_API_VERSION, backend.api_key)
 
+def load_datasource_template():
     if DATASOURCE_TYPE == "AzureCognitiveSearch":
         # Set query type
         query_type = "simple"
         if AZURE_SEARCH_QUERY_TYPE:
             query_type = AZURE_SEARCH_QUERY_TYPE
-        elif AZURE_SEARCH_USE_SEMANTIC_SEARCH.lower() == "true" and AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG:
+        elif parse_bool(AZURE_SEARCH_USE_SEMANTIC_SEARCH) and AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG:
             query_type = "semantic"
 
-        # Set filter
-        filter = None
-        userToken = None
-        if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
-            userToken = request.headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN', "")
-            if DEBUG_LOGGING:
-                logger.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
-
-            filter = generateFilterString(userToken)
-            if DEBUG_LOGGING:
-                logger.debug(f"FILTER: {filter}")
-
-        body["dataSources"].append(
-            {
-                "type": "AzureCognitiveSearch",
-                "parameters": {
-                    "endpoint": f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
-                    "key": AZURE_SEARCH_KEY,
-                    "indexName": AZURE_SEARCH_INDEX,
-                    "fieldsMapping": {
-                        "contentFields": parse_multi_columns(AZURE_SEARCH_CONTENT_COLUMNS) if AZURE_SEARCH_CONTENT_COLUMNS else [],
-                        "titleField": AZURE_SEARCH_TITLE_COLUMN if AZURE_SEARCH_TITLE_COLUMN else None,
-                        "urlField": AZURE_SEARCH_URL_COLUMN if AZURE_SEARCH_URL_COLUMN else None,
-                        "filepathField": AZURE_SEARCH_FILENAME_COLUMN if AZURE_SEARCH_FILENAME_COLUMN else None,
-                        "vectorFields": parse_multi_columns(AZURE_SEARCH_VECTOR_COLUMNS) if AZURE_SEARCH_VECTOR_COLUMNS else []
-                    },
-                    "inScope": True if AZURE_SEARCH_ENABLE_IN_DOMAIN.lower() == "true" else False,
-                    "topNDocuments": int(AZURE_SEARCH_TOP_K),
-                    "queryType": query_type,
-                    "semanticConfiguration": AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG if AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG else "",
-                    "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE,
-                    "filter": filter,
-                    "strictness": int(AZURE_SEARCH_STRICTNESS)
-                }
-            })
+        parameters = {
+            "endpoint": f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+            "key": AZURE_SEARCH_KEY,
+            "indexName": AZURE_SEARCH_INDEX,
+            "fieldsMapping": {
+                "contentFields": parse_multi_columns(AZURE_SEARCH_CONTENT_COLUMNS) if AZURE_SEARCH_CONTENT_COLUMNS else [],
+                "titleField": AZURE_SEARCH_TITLE_COLUMN if AZURE_SEARCH_TITLE_COLUMN else None,
+                "urlField": AZURE_SEARCH_URL_COLUMN if AZURE_SEARCH_URL_COLUMN else None,
+                "filepathField": AZURE_SEARCH_FILENAME_COLUMN if AZURE_SEARCH_FILENAME_COLUMN else None,
+                "vectorFields": parse_multi_columns(AZURE_SEARCH_VECTOR_COLUMNS) if AZURE_SEARCH_VECTOR_COLUMNS else []
+            },
+            "inScope": parse_bool(AZURE_SEARCH_ENABLE_IN_DOMAIN),
+            "topNDocuments": parse_int("AZURE_SEARCH_TOP_K", AZURE_SEARCH_TOP_K),
+            "queryType": query_type,
+            "semanticConfiguration": AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG if AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG else "",
+            "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE,
+            "filter": None,
+            "strictness": parse_int("AZURE_SEARCH_STRICTNESS", AZURE_SEARCH_STRICTNESS)
+        }
     elif DATASOURCE_TYPE == "AzureCosmosDB":
         # Set query type
         query_type = "vector"
 
-        body["dataSources"].append(
-            {
-                "type": "AzureCosmosDB",
-                "parameters": {
-                    "connectionString": AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING,
-                    "indexName": AZURE_COSMOSDB_MONGO_VCORE_INDEX,
-                    "databaseName": AZURE_COSMOSDB_MONGO_VCORE_DATABASE,
-                    "containerName": AZURE_COSMOSDB_MONGO_VCORE_CONTAINER,                    
-                    "fieldsMapping": {
-                        "contentFields": parse_multi_columns(AZURE_COSMOSDB_MONGO_VCORE_CONTENT_COLUMNS) if AZURE_COSMOSDB_MONGO_VCORE_CONTENT_COLUMNS else [],
-                        "titleField": AZURE_COSMOSDB_MONGO_VCORE_TITLE_COLUMN if AZURE_COSMOSDB_MONGO_VCORE_TITLE_COLUMN else None,
-                        "urlField": AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN if AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN else None,
-                        "filepathField": AZURE_COSMOSDB_MONGO_VCORE_FILENAME_COLUMN if AZURE_COSMOSDB_MONGO_VCORE_FILENAME_COLUMN else None,
-                        "vectorFields": parse_multi_columns(AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS) if AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS else []
-                    },
-                    "inScope": True if AZURE_COSMOSDB_MONGO_VCORE_ENABLE_IN_DOMAIN.lower() == "true" else False,
-                    "topNDocuments": int(AZURE_COSMOSDB_MONGO_VCORE_TOP_K),
-                    "strictness": int(AZURE_COSMOSDB_MONGO_VCORE_STRICTNESS),
-                    "queryType": query_type,
-                    "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE
-                }
-            }
-        )
-
+        parameters = {
+            "connectionString": AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING,
+            "indexName": AZURE_COSMOSDB_MONGO_VCORE_INDEX,
+            "databaseName": AZURE_COSMOSDB_MONGO_VCORE_DATABASE,
+            "containerName": AZURE_COSMOSDB_MONGO_VCORE_CONTAINER,
+            "fieldsMapping": {
+                "contentFields": parse_multi_columns(AZURE_COSMOSDB_MONGO_VCORE_CONTENT_COLUMNS) if AZURE_COSMOSDB_MONGO_VCORE_CONTENT_COLUMNS else [],
+                "titleField": AZURE_COSMOSDB_MONGO_VCORE_TITLE_COLUMN if AZURE_COSMOSDB_MONGO_VCORE_TITLE_COLUMN else None,
+                "urlField": AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN if AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN else None,
+                "filepathField": AZURE_COSMOSDB_MONGO_VCORE_FILENAME_COLUMN if AZURE_COSMOSDB_MONGO_VCORE_FILENAME_COLUMN else None,
+                "vectorFields": parse_multi_columns(AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS) if AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS else []
+            },
+            "inScope": parse_bool(AZURE_COSMOSDB_MONGO_VCORE_ENABLE_IN_DOMAIN),
+            "topNDocuments": parse_int("AZURE_COSMOSDB_MONGO_VCORE_TOP_K", AZURE_COSMOSDB_MONGO_VCORE_TOP_K),
+            "strictness": parse_int("AZURE_COSMOSDB_MONGO_VCORE_STRICTNESS", AZURE_COSMOSDB_MONGO_VCORE_STRICTNESS),
+            "queryType": query_type,
+            "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE
+        }
     elif DATASOURCE_TYPE == "Elasticsearch":
-        body["dataSources"].append(
-            {
-                "messages": request_messages,
-                "temperature": float(AZURE_OPENAI_TEMPERATURE),
-                "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
-                "top_p": float(AZURE_OPENAI_TOP_P),
-                "stop": AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
-                "stream": SHOULD_STREAM,
-                "dataSources": [
-                    {
-                        "type": "AzureCognitiveSearch",
-                        "parameters": {
-                            "endpoint": ELASTICSEARCH_ENDPOINT,
-                            "encodedApiKey": ELASTICSEARCH_ENCODED_API_KEY,
-                            "indexName": ELASTICSEARCH_INDEX,
-                            "fieldsMapping": {
-                                "contentFields": parse_multi_columns(ELASTICSEARCH_CONTENT_COLUMNS) if ELASTICSEARCH_CONTENT_COLUMNS else [],
-                                "titleField": ELASTICSEARCH_TITLE_COLUMN if ELASTICSEARCH_TITLE_COLUMN else None,
-                                "urlField": ELASTICSEARCH_URL_COLUMN if ELASTICSEARCH_URL_COLUMN else None,
-                                "filepathField": ELASTICSEARCH_FILENAME_COLUMN if ELASTICSEARCH_FILENAME_COLUMN else None,
-                                "vectorFields": parse_multi_columns(ELASTICSEARCH_VECTOR_COLUMNS) if ELASTICSEARCH_VECTOR_COLUMNS else []
-                            },
-                            "inScope": True if ELASTICSEARCH_ENABLE_IN_DOMAIN.lower() == "true" else False,
-                            "topNDocuments": int(ELASTICSEARCH_TOP_K),
-                            "queryType": ELASTICSEARCH_QUERY_TYPE,
-                            "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE,
-                            "embeddingEndpoint": AZURE_OPENAI_EMBEDDING_ENDPOINT,
-                            "embeddingKey": AZURE_OPENAI_EMBEDDING_KEY,
-                            "embeddingModelId": ELASTICSEARCH_EMBEDDING_MODEL_ID,
-                            "strictness": int(ELASTICSEARCH_STRICTNESS)
-                        }
-                    }
-                ]
-            }
-        )
+        query_type = ELASTICSEARCH_QUERY_TYPE
+
+        parameters = {
+            "endpoint": ELASTICSEARCH_ENDPOINT,
+            "encodedApiKey": ELASTICSEARCH_ENCODED_API_KEY,
+            "indexName": ELASTICSEARCH_INDEX,
+            "fieldsMapping": {
+                "contentFields": parse_multi_columns(ELASTICSEARCH_CONTENT_COLUMNS) if ELASTICSEARCH_CONTENT_COLUMNS else [],
+                "titleField": ELASTICSEARCH_TITLE_COLUMN if ELASTICSEARCH_TITLE_COLUMN else None,
+                "urlField": ELASTICSEARCH_URL_COLUMN if ELASTICSEARCH_URL_COLUMN else None,
+                "filepathField": ELASTICSEARCH_FILENAME_COLUMN if ELASTICSEARCH_FILENAME_COLUMN else None,
+                "vectorFields": parse_multi_columns(ELASTICSEARCH_VECTOR_COLUMNS) if ELASTICSEARCH_VECTOR_COLUMNS else []
+            },
+            "inScope": parse_bool(ELASTICSEARCH_ENABLE_IN_DOMAIN),
+            "topNDocuments": parse_int("ELASTICSEARCH_TOP_K", ELASTICSEARCH_TOP_K),
+            "queryType": query_type,
+            "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE,
+            "embeddingEndpoint": AZURE_OPENAI_EMBEDDING_ENDPOINT,
+            "embeddingKey": AZURE_OPENAI_EMBEDDING_KEY,
+            "embeddingModelId": ELASTICSEARCH_EMBEDDING_MODEL_ID,
+            "strictness": parse_int("ELASTICSEARCH_STRICTNESS", ELASTICSEARCH_STRICTNESS)
+        }
     else:
         raise Exception(f"DATASOURCE_TYPE is not configured or unknown: {DATASOURCE_TYPE}")
 
     if "vector" in query_type.lower():
         if AZURE_OPENAI_EMBEDDING_NAME:
-            body["dataSources"][0]["parameters"]["embeddingDeploymentName"] = AZURE_OPENAI_EMBEDDING_NAME
+            parameters["embeddingDeploymentName"] = AZURE_OPENAI_EMBEDDING_NAME
         else:
-            body["dataSources"][0]["parameters"]["embeddingEndpoint"] = AZURE_OPENAI_EMBEDDING_ENDPOINT
-            body["dataSources"][0]["parameters"]["embeddingKey"] = AZURE_OPENAI_EMBEDDING_KEY
+            parameters["embeddingEndpoint"] = AZURE_OPENAI_EMBEDDING_ENDPOINT
+            parameters["embeddingKey"] = AZURE_OPENAI_EMBEDDING_KEY
+
+    return DataSourceTemplate(DATASOURCE_TYPE, parameters, COMPLETION_SETTINGS, query_type)
+
+# Built once at import so a misconfigured data source fails at startup instead of on the first chat
+DATASOURCE_TEMPLATE = load_datasource_template() if should_use_data() else None
+if DATASOURCE_TEMPLATE and DEBUG_LOGGING:
+    logger.debug(f"DATA SOURCE: {DATASOURCE_TEMPLATE.type} {json.dumps(DATASOURCE_TEMPLATE.masked(), indent=4)}")
+
+EXTENSIONS_HEADERS = {
+    'Content-Type': 'application/json',
+    'api-key': AZURE_OPENAI_KEY,
+    "x-ms-useragent": "GitHubSampleWebApp/PublicAPI/3.0.0"
+}
+
+def prepare_body_headers_with_data(request_body, request_headers):
+    # Set filter
+    filter = None
+    if DATASOURCE_TEMPLATE.supports_filter and AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
+        userToken = request_headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN', "")
+        if DEBUG_LOGGING:
+            logger.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
+
+        filter = generateFilterString(userToken, request_headers.get('X-Ms-Client-Principal-Id'))
+        if DEBUG_LOGGING:
+            logger.debug(f"FILTER: {filter}")
+
+    body = DATASOURCE_TEMPLATE.build(request_body["messages"], filter, SHOULD_STREAM)
 
     if DEBUG_LOGGING:
-        body_clean = copy.deepcopy(body)
-        if body_clean["dataSources"][0]["parameters"].get("key"):
-            body_clean["dataSources"][0]["parameters"]["key"] = "*****"
-        if body_clean["dataSources"][0]["parameters"].get("connectionString"):
-            body_clean["dataSources"][0]["parameters"]["connectionString"] = "*****"
-        if body_clean["dataSources"][0]["parameters"].get("embeddingKey"):
-            body_clean["dataSources"][0]["parameters"]["embeddingKey"] = "*****"
-            
-        logger.debug(f"REQUEST BODY: {json.dumps(body_clean, indent=4)}")
+        logger.debug(f"REQUEST MESSAGES: {json.dumps(body['messages'], indent=4)}")
 
-    headers = {
-        'Content-Type': 'application/json',
-        'api-key': AZURE_OPENAI_KEY,
-        "x-ms-useragent": "GitHubSampleWebApp/PublicAPI/3.0.0"
+    return body, EXTENSIONS_HEADERS
+
+
+def build_stream_response_with_data(data, history_metadata={}):
+    # Turns the payload of one extensions SSE event into a frontend chunk, or None if there is nothing to relay
+    try:
+        rawResponse = json.loads(data)
+    except json.decoder.JSONDecodeError:
+        return None
+
+    if AZURE_OPENAI_PREVIEW_API_VERSION == '2023-06-01-preview':
+        lineJson = rawResponse
+    else:
+        lineJson = formatApiResponseStreaming(rawResponse)
+
+    if 'error' in lineJson:
+        return lineJson
+
+    response = {
+        "id": history_metadata.get("message_id", ""),
+        "model": lineJson["model"],
+        "created": lineJson["created"],
+        "object": lineJson["object"],
+        "choices": [{
+            "messages": []
+        }],
+        'history_metadata': history_metadata
     }
 
-    return body, headers
+    delta = lineJson["choices"][0]["messages"][0]["delta"]
+    role = delta.get("role")
+    if role == "tool":
+        response["choices"][0]["messages"].append(delta)
+    elif role == "assistant":
+        response["choices"][0]["messages"].append({
+            "role": "assistant",
+            "content": ""
+        })
+    else:
+        deltaText = delta["content"]
+        if deltaText == "[DONE]":
+            return None
+        response["choices"][0]["messages"].append({
+            "role": "assistant",
+            "content": deltaText
+        })
 
+    return response
 
-def stream_with_data(body, headers, endpoint, history_metadata={}):
-    s = requests.Session()
+def send_extensions_request(endpoint, headers, body, stream=False):
+    # Returns the response once its headers are in; throttling and transient failures raise UpstreamUnavailable
+    client = extensions_transport.client
     try:
-        with s.post(endpoint, json=body, headers=headers, stream=True) as r:
-            for line in r.iter_lines(chunk_size=10):
-                response = {
-                    "id": "",
-                    "model": "",
-                    "created": 0,
-                    "object": "",
-                    "choices": [{
-                        "messages": []
-                    }],
-                    "apim-request-id": "",
-                    'history_metadata': history_metadata
-                }
-                if line:
-                    if AZURE_OPENAI_PREVIEW_API_VERSION == '2023-06-01-preview':
-                        lineJson = json.loads(line.lstrip(b'data:').decode('utf-8'))
-                    else:
-                        try:
-                            rawResponse = json.loads(line.lstrip(b'data:').decode('utf-8'))
-                            lineJson = formatApiResponseStreaming(rawResponse)
-                        except json.decoder.JSONDecodeError:
-                            continue
-
-                    if 'error' in lineJson:
-                        yield format_as_ndjson(lineJson)
-                    response.id = message_uuid
-                    response.model = lineJson["model"]
-                    response.created = lineJson["created"]
-                    response.object = lineJson["object"]
-                ## response.apim-request-id = r.headers.get('apim-request-id')
-
-                    role = lineJson["choices"][0]["messages"][0]["delta"].get("role")
-
-                    if role == "tool":
-                        response.choices[0].messages.append(lineJson["choices"][0]["messages"][0]["delta"])
-                        yield format_as_ndjson(response)
-                    elif role == "assistant": 
-                        if response.apim-request-id and DEBUG_LOGGING: 
-                            logger.debug(f"RESPONSE apim-request-id: {response.apim-request-id}")
-                        response.choices[0].messages.append({
-                            "role": "assistant",
-                            "content": ""
-                        })
-                        yield format_as_ndjson(response)
-                    else:
-                        deltaText = lineJson["choices"][0]["messages"][0]["delta"]["content"]
-                        if deltaText != "[DONE]":
-                            response.choices[0].messages.append({
-                                "role": "assistant",
-                                "content": deltaText
-                            })
-                            yield format_as_ndjson(response)
+        r = client.send(client.build_request("POST", endpoint, json=body, headers=headers), stream=stream)
+    except httpx.ConnectError as e:
+        raise UpstreamUnavailable(None) from e
+    try:
+        check_response(r)
+    except UpstreamUnavailable:
+        r.close()
+        raise
+    return r
+
+def stream_with_data(response, history_metadata={}, timer=None):
+    try:
+        yield from timed_stream(relay_stream(response.iter_bytes(), lambda data: build_stream_response_with_data(data, history_metadata)), timer)
     except Exception as e:
-        yield format_as_ndjson({"error" + str(e)})
+        yield format_as_ndjson({"error": str(e)})
+    finally:
+        response.close()
 
 def formatApiResponseNoStreaming(rawResponse):
     if 'error' in rawResponse:
@@ -485,8 +665,8 @@ def formatApiResponseNoStreaming(rawResponse):
         "role": "assistant",
         "content": rawResponse["choices"][0]["message"]["content"]
     }
-    response.choices[0].messages.append(toolMessage)
-    response.choices[0].messages.append(assistantMessage)
+    response["choices"][0]["messages"].append(toolMessage)
+    response["choices"][0]["messages"].append(assistantMessage)
 
     return response
 
@@ -510,14 +690,14 @@ def formatApiResponseStreaming(rawResponse):
                 "content": rawResponse["choices"][0]["delta"]["context"]["messages"][0]["content"]
             }
         }
-        response.choices[0].messages.append(messageObj)
+        response["choices"][0]["messages"].append(messageObj)
     elif rawResponse["choices"][0]["delta"].get("role"):
         messageObj = {
             "delta": {
                 "role": "assistant",
             }
         }
-        response.choices[0].messages.append(messageObj)
+        response["choices"][0]["messages"].append(messageObj)
     else:
         if rawResponse["choices"][0]["end_turn"]:
             messageObj = {
@@ -525,69 +705,80 @@ def formatApiResponseStreaming(rawResponse):
                     "content": "[DONE]",
                 }
             }
-            response.choices[0].messages.append(messageObj)
+            response["choices"][0]["messages"].append(messageObj)
         else:
             messageObj = {
                 "delta": {
                     "content": rawResponse["choices"][0]["delta"]["content"],
                 }
             }
-            response.choices[0].messages.append(messageObj)
+            response["choices"][0]["messages"].append(messageObj)
 
     return response
 
-def conversation_with_data(request_body, model):
-    body, headers = prepare_body_headers_with_data(request)
-    base_url = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-    endpoint = f"{base_url}openai/deployments/{model}/extensions/chat/completions?api-version={AZURE_OPENAI_PREVIEW_API_VERSION}"
+def format_response_with_data(rawResponse, history_metadata={}):
+    if AZURE_OPENAI_PREVIEW_API_VERSION == "2023-06-01-preview":
+        result = rawResponse
+    else:
+        result = formatApiResponseNoStreaming(rawResponse)
+    result['history_metadata'] = history_metadata
+    return result
+
+def conversation_with_data(request_body, model, title_future=None):
+    with chat_stage("prepare"):
+        body, headers = prepare_body_headers_with_data(request_body, request.headers)
     history_metadata = request_body.get("history_metadata", {})
+    cost = estimate_tokens(body["messages"], COMPLETION_PARAMETERS["max_tokens"])
 
     if not SHOULD_STREAM:
-        r = requests.post(endpoint, headers=headers, json=body)
+        with chat_stage("upstream"):
+            lease, r = deployment_router.call(deployment_name(model), cost, lambda backend: backend_extensions_request(backend, headers, body))
+        lease.first_token()
+        lease.release()
         status_code = r.status_code
-        r = r.json()
-        if AZURE_OPENAI_PREVIEW_API_VERSION == "2023-06-01-preview":
-            r['history_metadata'] = history_metadata
-            return Response(format_as_ndjson(r), status=status_code)
-        else:
-            result = formatApiResponseNoStreaming(r)
-            result['history_metadata'] = history_metadata
-            return Response(format_as_ndjson(result), status=status_code)
+        resolve_title(history_metadata, title_future)
+        result = format_response_with_data(r.json(), history_metadata)
+        return Response(format_as_ndjson(result), status=status_code)
 
     else:
-        return Response(stream_with_data(body, headers, endpoint, history_metadata), mimetype='text/event-stream')
+        ## connect before answering, so a busy or failing deployment is failed over, retried or turned into a 503 before anything streams
+        with chat_stage("connect"):
+            lease, r = deployment_router.call(deployment_name(model), cost, lambda backend: backend_extensions_request(backend, headers, body, stream=True))
+        response = Response(with_title_update(lease.track(stream_with_data(r, history_metadata, current_timer.get())), history_metadata, title_future), mimetype='text/event-stream')
+        response.call_on_close(r.close)
+        response.call_on_close(lease.release)
+        return response
+
+def format_stream_chunk_without_data(chunk, history_metadata={}):
+    if chunk.choices:
+        deltaText = chunk.choices[0].delta.content
+    else:
+        deltaText = ""
+    if not deltaText or deltaText == "[DONE]":
+        return None
+
+    response_obj = {
+        "id": history_metadata.get("message_id", ""),
+        "model": chunk.model,
+        "created": chunk.created,
+        "object": chunk.object,
+        "choices": [{
+            "messages": [{
+                "role": "assistant",
+                "content": deltaText
+            }]
+        }],
+        "history_metadata": history_metadata
+    }
+    return format_as_ndjson(response_obj)
 
 def stream_without_data(response, history_metadata={}):
     for line in response:
-        if line.choices:
-            deltaText = line.choices[0].delta.content
-        else:
-            deltaText = ""
-        if deltaText and deltaText != "[DONE]":
-            responseText = deltaText
-
-            response_obj = {
-                "id": message_uuid,
-                "model": line.model,
-                "created": line.created,
-                "object": line.object,
-                "choices": [{
-                    "messages": [{
-                        "role": "assistant",
-                        "content": responseText
-                    }]
-                }],
-                "history_metadata": history_metadata
-            }
-            yield format_as_ndjson(response_obj)
+        chunk = format_stream_chunk_without_data(line, history_metadata)
+        if chunk:
+            yield chunk
 
-def conversation_without_data(request_body, model):
-    client = AzureOpenAI(azure_endpoint=AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/",
-                         azure_deployment=model,
-                         api_version=AZURE_OPENAI_PREVIEW_API_VERSION,
-                         api_key=AZURE_OPENAI_KEY)
-
-    request_messages = request_body["messages"]
+def prepare_messages_without_data(request_body):
     messages = [
         {
             "role": "system",
@@ -595,41 +786,65 @@ def conversation_without_data(request_body, model):
         }
     ]
 
-    for message in request_messages:
+    for message in request_body["messages"]:
         if message:
             messages.append({
                 "role": message["role"] ,
                 "content": message["content"]
             })
 
-    response = client.chat.completions.create(model=model, ## user selected in frontend settings
-    messages = messages,
-    temperature=float(AZURE_OPENAI_TEMPERATURE),
-    max_tokens=int(AZURE_OPENAI_MAX_TOKENS),
-    top_p=float(AZURE_OPENAI_TOP_P),
-    stop=AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
-    stream=SHOULD_STREAM)
+    return messages
+
+def get_completion_parameters():
+    return COMPLETION_PARAMETERS
+
+def format_response_without_data(response, history_metadata={}):
+    return {
+        "id": history_metadata.get("message_id", ""),
+        "model": response.model,
+        "created": response.created,
+        "object": response.object,
+        "choices": [{
+            "messages": [{
+                "role": "assistant",
+                "content": response.choices[0].message.content
+            }]
+        }],
+        "history_metadata": history_metadata
+    }
+
+def create_chat_completion(client, **parameters):
+    try:
+        return client.chat.completions.create(**parameters)
+    except Exception as e:
+        retryable = from_openai_error(e)
+        if retryable:
+            raise retryable from e
+        raise
+
+def conversation_without_data(request_body, model, title_future=None):
+    messages = prepare_messages_without_data(request_body)
+    parameters = get_completion_parameters()
+
+    ## when streaming, create() returns once the response headers arrive
+    with chat_stage("connect" if SHOULD_STREAM else "upstream"):
+        lease, response = deployment_router.call(deployment_name(model), estimate_tokens(messages, parameters["max_tokens"]),
+            lambda backend: create_chat_completion(get_backend_client(backend), model=backend.deployment, ## routed for the model selected in frontend settings
+                messages=messages,
+                **parameters))
 
     history_metadata = request_body.get("history_metadata", {})
 
     if not SHOULD_STREAM:
-        response_obj = {
-            "id": message_uuid,
-            "model": response.model,
-            "created": response.created,
-            "object": response.object,
-            "choices": [{
-                "messages": [{
-                    "role": "assistant",
-                    "content": response.choices[0].message.content
-                }]
-            }],
-            "history_metadata": history_metadata
-        }
-
-        return jsonify(response_obj), 200
+        lease.first_token()
+        lease.release()
+        resolve_title(history_metadata, title_future)
+        return jsonify(format_response_without_data(response, history_metadata)), 200
     else:
-        return Response(stream_without_data(response, history_metadata), mimetype='text/event-stream')
+        streamed = Response(with_title_update(timed_stream(lease.track(stream_without_data(response, history_metadata)), current_timer.get()), history_metadata, title_future), mimetype='text/event-stream')
+        streamed.call_on_close(response.close)
+        streamed.call_on_close(lease.release)
+        return streamed
 
 @app.route("/conversation", methods=["GET", "POST"])
 def conversation():
@@ -637,13 +852,18 @@ def conversation():
     model = request.json.get("model", None);
     return conversation_internal(request_body, model)
 
-def conversation_internal(request_body, model):
+def conversation_internal(request_body, model, title_future=None):
     try:
         use_data = should_use_data()
         if use_data:
-            return conversation_with_data(request_body, model)
+            return conversation_with_data(request_body, model, title_future)
         else:
-            return conversation_without_data(request_body, model)
+            return conversation_without_data(request_body, model, title_future)
+    except UnknownModel as e:
+        return jsonify({"error": str(e)}), 400
+    except AdmissionRejected as e:
+        logger.warning("Rejected /conversation: %s", e)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": e.retry_after_header}
     except Exception as e:
         logger.exception("Exception in /conversation")
         return jsonify({"error": str(e)}), 500
@@ -651,8 +871,6 @@ def conversation_internal(request_body, model):
 ## Conversation History API ## 
 @app.route("/history/generate", methods=["POST"])
 def add_conversation():
-    global message_uuid
-    message_uuid = str(uuid.uuid4())
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user['user_principal_id']
 
@@ -665,10 +883,16 @@ def add_conversation():
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured")
 
+        ## refuse an unknown model before anything is written to the history
+        deployment_name(model)
+
         # check for the conversation_id, if the conversation is not set, we will create a new one
-        history_metadata = {}
+        ## the answer's id travels with the request, concurrent requests must not share it
+        history_metadata = {'message_id': str(uuid.uuid4())}
+        title = None
         if not conversation_id:
-            title = generate_title(request.json["messages"], model)
+            ## start with a provisional title, the real one is generated alongside the answer
+            title = provisional_title(request.json["messages"])
             conversation_dict = cosmos_conversation_client.create_conversation(user_id=user_id, title=title)
             conversation_id = conversation_dict['id']
             history_metadata['title'] = title
@@ -686,13 +910,19 @@ def add_conversation():
             )
         else:
             raise Exception("No user message found")
-        
+
+        title_future = None
+        if title is not None:
+            title_future = title_executor.submit(generate_and_store_title, user_id, conversation_id, messages, model, title)
+
         # Submit request to Chat Completions for response
         request_body = request.json
         history_metadata['conversation_id'] = conversation_id
         request_body['history_metadata'] = history_metadata
-        return conversation_internal(request_body, model)
+        return conversation_internal(request_body, model, title_future)
        
+    except UnknownModel as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.exception("Exception in /history/generate")
         return jsonify({"error": str(e)}), 500
@@ -719,20 +949,16 @@ def update_conversation():
         ## then write it to the conversation history in cosmos
         messages = request.json["messages"]
         if len(messages) > 0 and messages[-1]['role'] == "assistant":
+            new_messages = []
             if len(messages) > 1 and messages[-2].get('role', None) == "tool":
                 # write the tool message first
-                cosmos_conversation_client.create_message(
-                    uuid=str(uuid.uuid4()),
-                    conversation_id=conversation_id,
-                    user_id=user_id,
-                    input_message=messages[-2]
-                )
-            # write the assistant message
-            cosmos_conversation_client.create_message(
-                uuid=message_uuid,
+                new_messages.append((str(uuid.uuid4()), messages[-2]))
+            # write the assistant message under the id its answer was streamed with
+            new_messages.append((messages[-1].get('id') or str(uuid.uuid4()), messages[-1]))
+            cosmos_conversation_client.create_messages(
                 conversation_id=conversation_id,
                 user_id=user_id,
-                input_message=messages[-1]
+                input_messages=new_messages
             )
         else:
             raise Exception("No bot messages found")
@@ -780,13 +1006,13 @@ def delete_conversation():
     
     ## check request for conversation_id
     conversation_id = request.json.get("conversation_id", None)
-    logger.debug(f"{authenticated_user['user_name']} is deleting conversation {conversation_id}")
+    logger.debug("%s is deleting conversation %s", authenticated_user['user_name'], conversation_id)
     try: 
         if not conversation_id:
             return jsonify({"error": "conversation_id is required"}), 400
         
         ## delete the conversation messages from cosmos first
-        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id)
+        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id, max_concurrency=int(AZURE_COSMOSDB_DELETE_CONCURRENCY))
 
         ## Now delete the conversation 
         deleted_conversation = cosmos_conversation_client.delete_conversation(user_id, conversation_id)
@@ -802,15 +1028,26 @@ def list_conversations():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user['user_principal_id']
 
+    ## a cursor from the previous page's X-History-Cursor header takes precedence over offset
+    cursor = request.args.get("cursor", None)
+    if cursor:
+        try:
+            cursor = decode_cursor(cursor)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 400
+
     ## get the conversations from cosmos
-    conversations = cosmos_conversation_client.get_conversations(user_id, offset=offset, limit=25)
-    logger.debug(f"{authenticated_user['user_name']} is listing conversations {conversations}")
+    conversations = cosmos_conversation_client.get_conversations(user_id, offset=offset, limit=HISTORY_PAGE_SIZE, cursor=cursor, fields=CONVERSATION_LIST_FIELDS)
+    logger.debug("%s is listing conversations %s", authenticated_user['user_name'], conversations)
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
     ## return the conversation ids
 
-    return jsonify(conversations), 200
+    response = jsonify(conversations)
+    if len(conversations) == HISTORY_PAGE_SIZE:
+        response.headers["X-History-Cursor"] = encode_cursor(conversations, cursor)
+    return response, 200
 
 @app.route("/history/read", methods=["POST"])
 def get_conversation():
@@ -825,18 +1062,29 @@ def get_conversation():
 
     ## get the conversation object and the related messages from cosmos
     conversation = cosmos_conversation_client.get_conversation(user_id, conversation_id)
-    logger.debug(f"{authenticated_user['user_name']} is getting conversation {conversation}")
+    logger.debug("%s is getting conversation %s", authenticated_user['user_name'], conversation)
     ## return the conversation id and the messages in the bot frontend format
     if not conversation:
         return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
     
-    # get the messages for the conversation from cosmos
-    conversation_messages = cosmos_conversation_client.get_messages(user_id, conversation_id)
-
-    ## format the messages in the bot frontend format
-    messages = [{'id': msg['id'], 'role': msg['role'], 'content': msg['content'], 'createdAt': msg['createdAt'], 'feedback': msg.get('feedback')} for msg in conversation_messages]
-
-    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+    # stream the messages for the conversation from cosmos, one result page at a time
+    pages = cosmos_conversation_client.iter_messages(user_id, conversation_id, fields=MESSAGE_FIELDS)
+    ## read the first page up front so a failing query still surfaces as an error status
+    pages = itertools.chain([next(pages, [])], pages)
+    return Response(stream_with_context(stream_conversation_messages(conversation_id, pages)), mimetype="application/json"), 200
+
+def stream_conversation_messages(conversation_id, pages):
+    ## writes {"conversation_id": ..., "messages": [...]} incrementally, in the bot frontend format
+    yield f'{{"conversation_id": {json.dumps(conversation_id)}, "messages": ['
+    separator = ""
+    for page in pages:
+        if not page:
+            continue
+        for msg in page:
+            msg.setdefault('feedback', None)
+        yield separator + ", ".join(json.dumps(msg, ensure_ascii=False) for msg in page)
+        separator = ", "
+    yield "]}"
 
 @app.route("/history/rename", methods=["POST"])
 def rename_conversation():
@@ -851,7 +1099,7 @@ def rename_conversation():
     
     ## get the conversation from cosmos
     conversation = cosmos_conversation_client.get_conversation(user_id, conversation_id)
-    logger.debug(f"{authenticated_user['user_name']} is renaming conversation {conversation}")
+    logger.debug("%s is renaming conversation %s", authenticated_user['user_name'], conversation)
     if not conversation:
         return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
 
@@ -859,8 +1107,8 @@ def rename_conversation():
     title = request.json.get("title", None)
     if not title:
         return jsonify({"error": "title is required"}), 400
-    conversation['title'] = title
-    updated_conversation = cosmos_conversation_client.upsert_conversation(conversation)
+    ## patch only the title, the conversation read above may come from the cache
+    updated_conversation = cosmos_conversation_client.update_conversation_title(user_id, conversation_id, title)
 
     return jsonify(updated_conversation), 200
 
@@ -869,27 +1117,36 @@ def delete_all_conversations():
     ## get the user id from the request headers
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user['user_principal_id']
+    background = request.args.get("background", "false").lower() == "true"
 
-    # get conversations for user
     try:
-        conversations = cosmos_conversation_client.get_conversations(user_id, offset=0, limit=None)
-        logger.debug(f"{authenticated_user['user_name']} is deleting all conversations {conversations}")
-        if not conversations:
+        logger.debug("%s is deleting all conversations", authenticated_user['user_name'])
+        if background:
+            ## return right away, progress can be polled with the job id
+            job = bulk_delete_jobs.submit(user_id, lambda progress: cosmos_conversation_client.delete_all_conversations(
+                user_id, max_concurrency=int(AZURE_COSMOSDB_DELETE_CONCURRENCY), progress=progress))
+            return jsonify({"message": f"Deleting conversations and messages for user {user_id}", "job_id": job['job_id']}), 202
+
+        deleted = cosmos_conversation_client.delete_all_conversations(user_id, max_concurrency=int(AZURE_COSMOSDB_DELETE_CONCURRENCY))
+        if not deleted['conversations']:
             return jsonify({"error": f"No conversations for {user_id} were found"}), 404
-        
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = cosmos_conversation_client.delete_messages(conversation['id'], user_id)
-
-            ## Now delete the conversation 
-            deleted_conversation = cosmos_conversation_client.delete_conversation(user_id, conversation['id'])
 
         return jsonify({"message": f"Successfully deleted conversation and messages for user {user_id}"}), 200
     
     except Exception as e:
         logger.exception("Exception in /history/delete_all")
         return jsonify({"error": str(e)}), 500
+
+@app.route("/history/delete_all/<job_id>", methods=["GET"])
+def get_delete_all_job(job_id):
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user['user_principal_id']
+
+    job = bulk_delete_jobs.get(user_id, job_id)
+    if not job:
+        return jsonify({"error": f"Delete job {job_id} was not found. It either does not exist, has expired, or was started by another user."}), 404
+
+    return jsonify(job), 200
     
 
 @app.route("/history/clear", methods=["POST"])
@@ -904,9 +1161,9 @@ def clear_messages():
         if not conversation_id:
             return jsonify({"error": "conversation_id is required"}), 400
         
-        logger.debug(f"{authenticated_user['user_name']} is deleting conversation {conversation_id}")
+        logger.debug("%s is deleting conversation %s", authenticated_user['user_name'], conversation_id)
         ## delete the conversation messages from cosmos
-        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id)
+        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id, max_concurrency=int(AZURE_COSMOSDB_DELETE_CONCURRENCY))
 
         return jsonify({"message": "Successfully deleted messages in conversation", "conversation_id": conversation_id}), 200
     except Exception as e:
@@ -931,32 +1188,20 @@ def read_frontend_settings():
         FEEDBACK_ENABLED = AZURE_COSMOSDB_ENABLE_FEEDBACK and AZURE_COSMOSDB_DATABASE not in [None, ""]
         HEADER_TITLE = os.environ.get("HEADER_TITLE", "TryOpenAI")
         PAGE_TAB_TITLE = os.environ.get("PAGE_TAB_TITLE", "TryOpenAI Chat Room")
-        AZURE_OPENAI_DEPLOYMENTS = os.environ.get("AZURE_OPENAI_DEPLOYMENTS", "gpt-35-turbo,gpt-4") ## These are available Deployments, not Models in Azure
         AZURE_OPENAI_MODEL = os.environ.get("AZURE_OPENAI_MODEL", "gpt-35-turbo")
 
         if AUTH_ENABLED:
             ## Check if there are any user specific values
             authenticated_user = get_authenticated_user_details(request_headers=request.headers)
             user_id = authenticated_user['user_principal_id']
-            logger.debug(f"Retrieving any user settings for {authenticated_user['user_name']}")
+            logger.debug("Retrieving any user settings for %s", authenticated_user['user_name'])
 
             # Retrieve any user settings for this user from cosmos
             user_settings = cosmos_usersettings_client.get_user_settings(user_id)
 
-            if user_settings:
-                for setting in user_settings:
-                    key = setting['key']
-                    match key:
-                        case 'AUTH_ENABLED':
-                            AUTH_ENABLED = os.environ.get("AUTH_ENABLED", "True") == "True" ## User cannot override
-                        case 'FEEDBACK_ENABLED':
-                            FEEDBACK_ENABLED = AZURE_COSMOSDB_ENABLE_FEEDBACK and AZURE_COSMOSDB_DATABASE not in [None, ""] ## User cannot override
-                        case 'HEADER_TITLE':
-                            HEADER_TITLE = os.environ.get("HEADER_TITLE", "TryOpenAI") ## User cannot override
-                        case 'PAGE_TAB_TITLE':
-                            PAGE_TAB_TITLE = os.environ.get("PAGE_TAB_TITLE", "TryOpenAI Chat Room") ## User cannot override
-                        case 'AZURE_OPENAI_MODEL':
-                            AZURE_OPENAI_MODEL = setting['value']
+            ## AUTH_ENABLED, FEEDBACK_ENABLED, HEADER_TITLE and PAGE_TAB_TITLE are saved too, but the user cannot override them
+            if user_settings and 'AZURE_OPENAI_MODEL' in user_settings:
+                AZURE_OPENAI_MODEL = user_settings['AZURE_OPENAI_MODEL']
         else:
             logger.debug("NOTE!! Authentication is disabled so the user accessing chat is unknown.")
 
@@ -995,41 +1240,82 @@ def write_frontend_settings():
         authenticated_user = get_authenticated_user_details(request_headers=request.headers)
         user_id = authenticated_user['user_principal_id']
 
-        # Create(upsert) user settings for this user in Cosmos DB
-        cosmos_usersettings_client.create_user_setting(user_id, "AUTH_ENABLED", "True" if request.json["AUTH_ENABLED"] else "False")
-        cosmos_usersettings_client.create_user_setting(user_id, "FEEDBACK_ENABLED", "True" if request.json["FEEDBACK_ENABLED"] else "False")
-        cosmos_usersettings_client.create_user_setting(user_id, "HEADER_TITLE", request.json["HEADER_TITLE"])
-        cosmos_usersettings_client.create_user_setting(user_id, "PAGE_TAB_TITLE", request.json["PAGE_TAB_TITLE"])
-        cosmos_usersettings_client.create_user_setting(user_id, "AZURE_OPENAI_MODEL", request.json["AZURE_OPENAI_MODEL"])
+        # Update this user's settings document in Cosmos DB, in one patch
+        cosmos_usersettings_client.update_user_settings(user_id, {
+            "AUTH_ENABLED": "True" if request.json["AUTH_ENABLED"] else "False",
+            "FEEDBACK_ENABLED": "True" if request.json["FEEDBACK_ENABLED"] else "False",
+            "HEADER_TITLE": request.json["HEADER_TITLE"],
+            "PAGE_TAB_TITLE": request.json["PAGE_TAB_TITLE"],
+            "AZURE_OPENAI_MODEL": request.json["AZURE_OPENAI_MODEL"]
+        })
 
-        logger.debug(f"Frontend settings have been saved by {authenticated_user['user_name']}")
+        logger.debug("Frontend settings have been saved by %s", authenticated_user['user_name'])
 
         return jsonify(request.json), 200
     except Exception as e:
         logger.exception("Exception in /frontend_settings_save")
         return jsonify({"error": str(e)}), 500  
     
-def generate_title(conversation_messages, model):
-    client = AzureOpenAI(azure_endpoint=AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/",
-                        azure_deployment=model,
-                        api_version=AZURE_OPENAI_PREVIEW_API_VERSION,
-                        api_key=AZURE_OPENAI_KEY)
-        
-    ## make sure the messages are sorted by _ts descending
-    title_prompt = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
+TITLE_PROMPT = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
 
+def prepare_title_messages(conversation_messages):
     messages = [{'role': msg['role'], 'content': msg['content']} for msg in conversation_messages]
-    messages.append({'role': 'user', 'content': title_prompt})
+    messages.append({'role': 'user', 'content': TITLE_PROMPT})
+    return messages
+
+def parse_title(completion, title_messages):
+    try:
+        return json.loads(completion.choices[0].message.content)['title']
+    except Exception:
+        return title_messages[-2]['content']
+
+def provisional_title(conversation_messages):
+    return conversation_messages[-1]['content']
 
+def generate_and_store_title(user_id, conversation_id, conversation_messages, model, current_title):
+    title = generate_title(conversation_messages, model)
+    if title == current_title:
+        return title
     try:
-        ## Submit prompt to Chat Completions for response
-        base_url = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-        completion = client.chat.completions.create(model=model, ## user selected in frontend settings
-        messages=messages,
-        temperature=1,
-        max_tokens=64)
-        title = json.loads(completion.choices[0].message.content).title
+        cosmos_conversation_client.update_conversation_title(user_id, conversation_id, title)
         return title
+    except Exception:
+        logger.exception("Exception updating conversation title")
+        return current_title
+
+def resolve_title(history_metadata, title_future=None):
+    # Waits for a title still being generated in the background and records it in the history metadata
+    if title_future:
+        try:
+            history_metadata['title'] = title_future.result()
+        except Exception:
+            logger.exception("Exception generating conversation title")
+
+def with_title_update(chunks, history_metadata, title_future=None):
+    yield from chunks
+    if title_future:
+        ## once the answer has streamed, push the final title in one last metadata-only chunk
+        resolve_title(history_metadata, title_future)
+        yield format_as_ndjson({
+            "id": history_metadata.get("message_id", ""),
+            "choices": [{
+                "messages": []
+            }],
+            "history_metadata": history_metadata
+        })
+
+def generate_title(conversation_messages, model):
+    messages = prepare_title_messages(conversation_messages)
+
+    try:
+        ## Submit prompt to Chat Completions for response; when the deployment is busy the provisional title stays
+        lease, completion = deployment_router.call(deployment_name(model), estimate_tokens(messages, 64),
+            lambda backend: create_chat_completion(get_backend_client(backend), model=backend.deployment, ## routed for the model selected in frontend settings
+                messages=messages,
+                temperature=1,
+                max_tokens=64))
+        lease.release()
+        return parse_title(completion, messages)
     except Exception as e:
         return messages[-2]['content']
 
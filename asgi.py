@@ -0,0 +1,423 @@
+import asyncio
+import json
+import uuid
+
+import httpx
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from werkzeug.datastructures import Headers
+
+import app as wsgi
+from app import logger
+from backend.aoai.admission import AdmissionRejected, UpstreamUnavailable, check_response, estimate_tokens, from_openai_error
+from backend.aoai.router import UnknownModel
+from backend.aoai.streaming import arelay_stream
+from backend.metrics import HTTP_REQUEST_SECONDS, RequestTimer, atimed_stream, chat_stage, current_timer
+from backend.auth.auth_utils import get_authenticated_user_details
+
+# Async serving mode. Run with `uvicorn asgi:app` instead of uwsgi to serve the
+# streaming chat routes as coroutines; every other route falls through to the
+# Flask app in app.py, which still works on its own under uwsgi.
+
+
+class AsgiRequest():
+
+    def __init__(self, scope, body: bytes):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        ## title-case the header names so they match what the EasyAuth helpers expect from WSGI
+        self.headers = Headers([(k.decode("latin-1").title(), v.decode("latin-1")) for k, v in scope["headers"]])
+        self.json = json.loads(body) if body else {}
+
+
+async def read_body(receive) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_body(send, payload: str, status=200, mimetype="text/html", headers=()):
+    body = payload.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", mimetype.encode()), (b"content-length", str(len(body)).encode())]
+                   + [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, obj, status=200, headers=()):
+    await send_body(send, json.dumps(obj, ensure_ascii=False), status, "application/json", headers)
+
+
+class ResponseSend():
+    """Wraps an ASGI `send`, remembering how far the response has got."""
+
+    def __init__(self, send):
+        self.send = send
+        self.started = False
+        self.finished = False
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.started = True
+        elif message["type"] == "http.response.body" and not message.get("more_body", False):
+            self.finished = True
+        await self.send(message)
+
+
+async def end_stream(send: ResponseSend, error: Exception):
+    ## the status line has gone out, so close the body with an error line instead of a second response
+    if not send.finished:
+        await send({"type": "http.response.body", "body": wsgi.format_as_ndjson({"error": str(error)}).encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+async def send_stream(send, chunks, status=200, mimetype="text/event-stream"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", mimetype.encode())]
+    })
+    async for chunk in chunks:
+        await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+def get_async_openai_client(backend):
+    return wsgi.azure_openai_client_pool.get_async_client(backend.endpoint, backend.deployment, wsgi.AZURE_OPENAI_PREVIEW_API_VERSION, backend.api_key)
+
+
+async def send_extensions_request(endpoint, headers, body, stream=False):
+    client = wsgi.extensions_transport.async_client
+    try:
+        r = await client.send(client.build_request("POST", endpoint, json=body, headers=headers), stream=stream)
+    except httpx.ConnectError as e:
+        raise UpstreamUnavailable(None) from e
+    try:
+        check_response(r)
+    except UpstreamUnavailable:
+        await r.aclose()
+        raise
+    return r
+
+
+async def backend_extensions_request(backend, headers, body, stream=False):
+    endpoint = wsgi.get_extensions_endpoint(backend.deployment, backend.endpoint)
+    return await send_extensions_request(endpoint, {**headers, 'api-key': backend.api_key}, body, stream=stream)
+
+
+async def stream_with_data(response, history_metadata={}):
+    try:
+        async for chunk in atimed_stream(arelay_stream(response.aiter_bytes(), lambda data: wsgi.build_stream_response_with_data(data, history_metadata))):
+            yield chunk
+    except Exception as e:
+        yield wsgi.format_as_ndjson({"error": str(e)})
+    finally:
+        await response.aclose()
+
+
+async def conversation_with_data(send, request, request_body, model, title_task=None):
+    ## the Graph group lookup behind security trimming is blocking, keep it off the event loop
+    with chat_stage("prepare"):
+        body, headers = await asyncio.to_thread(wsgi.prepare_body_headers_with_data, request_body, request.headers)
+    history_metadata = request_body.get("history_metadata", {})
+    cost = estimate_tokens(body["messages"], wsgi.COMPLETION_PARAMETERS["max_tokens"])
+
+    with chat_stage("connect" if wsgi.SHOULD_STREAM else "upstream"):
+        lease, r = await wsgi.deployment_router.acall(wsgi.deployment_name(model), cost,
+                                                      lambda backend: backend_extensions_request(backend, headers, body, stream=wsgi.SHOULD_STREAM))
+    try:
+        if not wsgi.SHOULD_STREAM:
+            lease.first_token()
+            lease.release()
+            await resolve_title(history_metadata, title_task)
+            result = wsgi.format_response_with_data(r.json(), history_metadata)
+            await send_body(send, wsgi.format_as_ndjson(result), status=r.status_code)
+        else:
+            await send_stream(send, with_title_update(lease.atrack(stream_with_data(r, history_metadata)), history_metadata, title_task))
+    finally:
+        lease.release()
+        await r.aclose()
+
+
+async def stream_without_data(response, history_metadata={}):
+    async for line in response:
+        chunk = wsgi.format_stream_chunk_without_data(line, history_metadata)
+        if chunk:
+            yield chunk
+
+
+async def create_chat_completion(client, **parameters):
+    try:
+        return await client.chat.completions.create(**parameters)
+    except Exception as e:
+        retryable = from_openai_error(e)
+        if retryable:
+            raise retryable from e
+        raise
+
+
+async def conversation_without_data(send, request_body, model, title_task=None):
+    messages = wsgi.prepare_messages_without_data(request_body)
+    parameters = wsgi.get_completion_parameters()
+    with chat_stage("connect" if wsgi.SHOULD_STREAM else "upstream"):
+        lease, response = await wsgi.deployment_router.acall(wsgi.deployment_name(model), estimate_tokens(messages, parameters["max_tokens"]),
+            lambda backend: create_chat_completion(get_async_openai_client(backend), model=backend.deployment,
+                messages=messages,
+                **parameters))
+
+    history_metadata = request_body.get("history_metadata", {})
+
+    try:
+        if not wsgi.SHOULD_STREAM:
+            lease.first_token()
+            lease.release()
+            await resolve_title(history_metadata, title_task)
+            await send_json(send, wsgi.format_response_without_data(response, history_metadata))
+        else:
+            await send_stream(send, with_title_update(atimed_stream(lease.atrack(stream_without_data(response, history_metadata))), history_metadata, title_task))
+    finally:
+        lease.release()
+        if wsgi.SHOULD_STREAM:
+            await response.close()
+
+
+async def conversation_internal(send, request, request_body, model, title_task=None):
+    send = ResponseSend(send)
+    try:
+        if wsgi.should_use_data():
+            await conversation_with_data(send, request, request_body, model, title_task)
+        else:
+            await conversation_without_data(send, request_body, model, title_task)
+    except UnknownModel as e:
+        await send_json(send, {"error": str(e)}, 400)
+    except AdmissionRejected as e:
+        logger.warning("Rejected /conversation: %s", e)
+        await send_json(send, {"error": str(e)}, 503, [("Retry-After", e.retry_after_header)])
+    except Exception as e:
+        logger.exception("Exception in /conversation")
+        if send.started:
+            await end_stream(send, e)
+        else:
+            await send_json(send, {"error": str(e)}, 500)
+
+
+async def conversation(send, request):
+    request_body = request.json
+    model = request_body.get("model", None)
+    await conversation_internal(send, request, request_body, model)
+
+
+async def generate_title(conversation_messages, model):
+    messages = wsgi.prepare_title_messages(conversation_messages)
+
+    try:
+        lease, completion = await wsgi.deployment_router.acall(wsgi.deployment_name(model), estimate_tokens(messages, 64),
+            lambda backend: create_chat_completion(get_async_openai_client(backend), model=backend.deployment,
+                messages=messages,
+                temperature=1,
+                max_tokens=64))
+        lease.release()
+        return wsgi.parse_title(completion, messages)
+    except Exception:
+        return messages[-2]['content']
+
+
+async def generate_and_store_title(user_id, conversation_id, conversation_messages, model, current_title):
+    title = await generate_title(conversation_messages, model)
+    if title == current_title:
+        return title
+    try:
+        await asyncio.to_thread(wsgi.cosmos_conversation_client.update_conversation_title, user_id, conversation_id, title)
+        return title
+    except Exception:
+        logger.exception("Exception updating conversation title")
+        return current_title
+
+
+async def resolve_title(history_metadata, title_task=None):
+    if title_task:
+        try:
+            history_metadata['title'] = await title_task
+        except Exception:
+            logger.exception("Exception generating conversation title")
+
+
+async def with_title_update(chunks, history_metadata, title_task=None):
+    async for chunk in chunks:
+        yield chunk
+    if title_task:
+        await resolve_title(history_metadata, title_task)
+        yield wsgi.format_as_ndjson({
+            "id": history_metadata.get("message_id", ""),
+            "choices": [{
+                "messages": []
+            }],
+            "history_metadata": history_metadata
+        })
+
+
+async def add_conversation(send, request):
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user['user_principal_id']
+    cosmos_conversation_client = wsgi.cosmos_conversation_client
+
+    ## check request for conversation_id and Azure OpenAI Model
+    request_body = request.json
+    conversation_id = request_body.get("conversation_id", None)
+    model = request_body.get("model", None)
+
+    try:
+        # make sure cosmos is configured
+        if not cosmos_conversation_client:
+            raise Exception("CosmosDB is not configured")
+
+        ## refuse an unknown model before anything is written to the history
+        wsgi.deployment_name(model)
+
+        # check for the conversation_id, if the conversation is not set, we will create a new one
+        ## the answer's id travels with the request, concurrent requests must not share it
+        history_metadata = {'message_id': str(uuid.uuid4())}
+        title = None
+        if not conversation_id:
+            ## start with a provisional title, the real one is generated alongside the answer
+            title = wsgi.provisional_title(request_body["messages"])
+            conversation_dict = await asyncio.to_thread(cosmos_conversation_client.create_conversation, user_id=user_id, title=title)
+            conversation_id = conversation_dict['id']
+            history_metadata['title'] = title
+            history_metadata['date'] = conversation_dict['createdAt']
+
+        ## Format the incoming message object in the "chat/completions" messages format
+        ## then write it to the conversation history in cosmos
+        messages = request_body["messages"]
+        if len(messages) > 0 and messages[-1]['role'] == "user":
+            await asyncio.to_thread(cosmos_conversation_client.create_message,
+                uuid=str(uuid.uuid4()),
+                conversation_id=conversation_id,
+                user_id=user_id,
+                input_message=messages[-1]
+            )
+        else:
+            raise Exception("No user message found")
+
+        title_task = None
+        if title is not None:
+            title_task = asyncio.create_task(generate_and_store_title(user_id, conversation_id, messages, model, title))
+
+        # Submit request to Chat Completions for response
+        history_metadata['conversation_id'] = conversation_id
+        request_body['history_metadata'] = history_metadata
+        await conversation_internal(send, request, request_body, model, title_task)
+
+    except UnknownModel as e:
+        await send_json(send, {"error": str(e)}, 400)
+    except Exception as e:
+        logger.exception("Exception in /history/generate")
+        await send_json(send, {"error": str(e)}, 500)
+
+
+def static_path(path):
+    if path == "/":
+        return "index.html"
+    if path == "/favicon.ico":
+        return "favicon.ico"
+    if path.startswith("/assets/"):
+        return path[1:]
+    return None
+
+
+async def send_static(send, scope, path):
+    ## static files are served here directly, without a trip through a WSGI thread
+    headers = Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]])
+    selected = wsgi.static_files.select(path, headers.get("Accept-Encoding", ""), headers.get("If-None-Match", ""))
+    if not selected:
+        return await send_json(send, {"error": "Not Found"}, 404)
+
+    status, response_headers, variant = selected
+    body = b""
+    if variant and scope["method"] == "GET":
+        body = variant.content if variant.content is not None else await asyncio.to_thread(read_file, variant.path)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response_headers]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def timed_send(send, timer, scope):
+    ## records the time to response headers, and adds Server-Timing when enabled, like the Flask hooks do
+    async def wrapper(message):
+        if message["type"] == "http.response.start":
+            HTTP_REQUEST_SECONDS.observe(timer.elapsed(), scope["method"], scope["path"], message["status"])
+            if wsgi.METRICS_TIMING_HEADERS and timer.stages:
+                message = {**message, "headers": list(message["headers"]) + [(b"server-timing", timer.server_timing().encode("latin-1"))]}
+        await send(message)
+    return wrapper
+
+
+ASYNC_ROUTES = {
+    ("POST", "/conversation"): conversation,
+    ("POST", "/history/generate"): add_conversation,
+}
+
+
+class ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    ## asgiref runs WSGI apps thread-sensitive, on one shared thread: Flask requests would queue
+    ## behind each other, and concurrent ones fail with "Single thread executor already being used"
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.run_wsgi_app.__wrapped__, thread_sensitive=False)
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi that serves each request on the event loop's thread pool, like uwsgi's threads."""
+
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiInstance(self.wsgi_application)(scope, receive, send)
+
+
+class ChatApp():
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = ThreadPoolWsgiToAsgi(wsgi_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        handler = ASYNC_ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+        if not handler and scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            path = static_path(scope["path"])
+            if path:
+                return await send_static(send, scope, path)
+        if not handler:
+            return await self.wsgi_app(scope, receive, send)
+
+        request = AsgiRequest(scope, await read_body(receive))
+        timer = RequestTimer()
+        current_timer.set(timer)
+        await handler(timed_send(send, timer, scope), request)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await wsgi.azure_openai_client_pool.aclose()
+                await wsgi.extensions_transport.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+app = ChatApp(wsgi.app)
@@ -0,0 +1,295 @@
+import asyncio
+import email.utils
+import logging
+import math
+import random
+import threading
+import time
+from typing import Optional
+
+import httpx
+import openai
+
+from backend.metrics import REGISTRY, current_timer
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: throttling and transient service errors
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# How long waiters sleep between checks when only the concurrency limit holds them back
+POLL_INTERVAL = 0.05
+# Azure OpenAI allows 6 requests per minute for every 1000 tokens per minute of quota
+RPM_PER_1000_TPM = 6
+
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram("aoai_admission_wait_seconds", "Time chat requests waited for an Azure OpenAI slot.", ("deployment",))
+ADMISSION_REJECTED = REGISTRY.counter("aoai_admission_rejected_total", "Requests turned away with a 503 instead of queueing.", ("deployment",))
+UPSTREAM_RETRIES = REGISTRY.counter("aoai_upstream_retries_total", "Azure OpenAI calls retried after a throttled or failed attempt.",
+                                    ("deployment", "status"))
+
+
+class AdmissionRejected(Exception):
+    """No upstream slot within the wait budget. Surfaced to the client as a 503 with Retry-After."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class UpstreamUnavailable(Exception):
+    """A retryable failure before any of the answer was relayed: a 429 or 5xx, or no connection (status None)."""
+
+    def __init__(self, status_code: Optional[int], retry_after: Optional[float] = None):
+        super().__init__(f"Azure OpenAI returned {status_code}" if status_code else "Could not connect to Azure OpenAI")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def check_response(response: httpx.Response):
+    """Raises UpstreamUnavailable for a retryable response; the caller closes it."""
+    if response.status_code in RETRYABLE_STATUS:
+        raise UpstreamUnavailable(response.status_code, retry_after_seconds(response.headers))
+
+
+def from_openai_error(e: Exception) -> Optional[UpstreamUnavailable]:
+    """The UpstreamUnavailable for a retryable openai SDK error, or None."""
+    if isinstance(e, openai.APIStatusError) and e.status_code in RETRYABLE_STATUS:
+        return UpstreamUnavailable(e.status_code, retry_after_seconds(e.response.headers))
+    ## a read timeout already cost the full timeout, do not spend it again
+    if isinstance(e, openai.APIConnectionError) and not isinstance(e, openai.APITimeoutError):
+        return UpstreamUnavailable(None)
+    return None
+
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """Reads retry-after-ms, x-ms-retry-after-ms or Retry-After (seconds or an HTTP date)."""
+    if not headers:
+        return None
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def estimate_tokens(messages: list, max_tokens: int) -> int:
+    """Rough token cost of a chat call the way the service counts it against TPM: prompt plus max_tokens."""
+    characters = sum(len(str(message.get("content") or "")) for message in messages)
+    return characters // 4 + len(messages) * 4 + int(max_tokens or 0)
+
+
+class TokenBucket():
+    """Refills continuously at `per_minute`; holds at most `burst_seconds` worth, like the service's short windows."""
+
+    def __init__(self, per_minute: float, burst_seconds: float = 10.0):
+        self.rate = per_minute / 60
+        self.capacity = max(self.rate * burst_seconds, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, cost: float, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        ## a request bigger than the bucket goes through once it is full, and the debt delays the next ones
+        needed = min(cost, self.capacity)
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self, cost: float):
+        self.tokens -= cost
+
+
+class DeploymentLimiter():
+    """Admission state of one deployment in this worker process."""
+
+    def __init__(self, deployment: str, tpm: int = 0, rpm: int = 0, max_concurrency: int = 0):
+        self.deployment = deployment
+        self.tokens = TokenBucket(tpm) if tpm else None
+        rpm = rpm or (tpm * RPM_PER_1000_TPM // 1000)
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.waiting = 0
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, cost: int) -> float:
+        """Takes a slot and returns 0, or returns how long to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            waits = [self.blocked_until - now]
+            if self.tokens:
+                waits.append(self.tokens.wait_time(cost, now))
+            if self.requests:
+                waits.append(self.requests.wait_time(1, now))
+            if self.max_concurrency and self.active >= self.max_concurrency:
+                waits.append(POLL_INTERVAL)
+            wait = max(waits)
+            if wait > 0:
+                return wait
+            if self.tokens:
+                self.tokens.take(cost)
+            if self.requests:
+                self.requests.take(1)
+            self.active += 1
+            return 0.0
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+    def pause(self, seconds: float):
+        ## the service said when it will take requests again; hold everyone back until then
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def enqueue(self, max_queue: int) -> bool:
+        with self._lock:
+            if max_queue and self.waiting >= max_queue:
+                return False
+            self.waiting += 1
+            return True
+
+    def dequeue(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"active": self.active, "waiting": self.waiting}
+
+
+class Admission():
+    """A held upstream slot. Release it once the answer has been fully relayed; releasing twice is harmless."""
+
+    def __init__(self, limiter: DeploymentLimiter):
+        self.limiter = limiter
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release()
+
+
+class AdmissionController():
+    """Per-deployment admission control for Azure OpenAI calls.
+
+    A request waits in a bounded queue until its deployment has a free concurrency slot and
+    enough room in the token (TPM) and request (RPM) buckets; when the queue is full, or the
+    wait would exceed `max_wait`, it is rejected at once so the client can retry later.
+    `backoff` spaces out retries of throttled (429) and transiently failed (5xx) calls by the
+    service's Retry-After, with jitter, and a 429 pauses the whole deployment for that long;
+    the retries themselves are driven by `backend.aoai.router`. Limits apply per worker
+    process, so give each worker its share of the deployment's quota.
+    """
+
+    def __init__(self, tpm: int = 0, rpm: int = 0, max_concurrency: int = 0, max_queue: int = 32, max_wait: float = 10.0,
+                 max_retries: int = 2, deployments: dict = None):
+        self.tpm = tpm
+        self.rpm = rpm
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        ## per-deployment overrides, e.g. {"gpt-4": {"tpm": 40000, "rpm": 240, "max_concurrency": 8}}
+        self.deployments = deployments or {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, deployment: str) -> DeploymentLimiter:
+        with self._lock:
+            limiter = self._limiters.get(deployment)
+            if not limiter:
+                limits = self.deployments.get(deployment, {})
+                limiter = self._limiters[deployment] = DeploymentLimiter(
+                    deployment,
+                    tpm=int(limits.get("tpm", self.tpm)),
+                    rpm=int(limits.get("rpm", self.rpm)),
+                    max_concurrency=int(limits.get("max_concurrency", self.max_concurrency))
+                )
+            return limiter
+
+    def next_wait(self, limiter: DeploymentLimiter, cost: int, deadline: float) -> float:
+        wait = limiter.try_acquire(cost)
+        if wait and time.monotonic() + wait > deadline:
+            ADMISSION_REJECTED.inc(1, limiter.deployment)
+            raise AdmissionRejected(f"Deployment {limiter.deployment} is busy, try again shortly", wait)
+        return wait
+
+    def enqueue(self, limiter: DeploymentLimiter):
+        if not limiter.enqueue(self.max_queue):
+            ADMISSION_REJECTED.inc(1, limiter.deployment)
+            raise AdmissionRejected(f"Too many requests waiting for deployment {limiter.deployment}, try again shortly",
+                                    max(limiter.blocked_until - time.monotonic(), 1.0))
+
+    def try_admit(self, deployment: str, cost: int) -> Optional[Admission]:
+        """An admission when a slot is free right now, else None; never waits or queues."""
+        limiter = self.limiter(deployment)
+        if limiter.try_acquire(cost):
+            return None
+        return Admission(limiter)
+
+    def admit(self, deployment: str, cost: int, deadline: float = None) -> Admission:
+        limiter = self.limiter(deployment)
+        started = time.monotonic()
+        deadline = deadline or started + self.max_wait
+        self.enqueue(limiter)
+        try:
+            while wait := self.next_wait(limiter, cost, deadline):
+                time.sleep(min(wait, deadline - time.monotonic()))
+        finally:
+            limiter.dequeue()
+            self.record_wait(deployment, time.monotonic() - started)
+        return Admission(limiter)
+
+    async def aadmit(self, deployment: str, cost: int, deadline: float = None) -> Admission:
+        limiter = self.limiter(deployment)
+        started = time.monotonic()
+        deadline = deadline or started + self.max_wait
+        self.enqueue(limiter)
+        try:
+            while wait := self.next_wait(limiter, cost, deadline):
+                await asyncio.sleep(min(wait, deadline - time.monotonic()))
+        finally:
+            limiter.dequeue()
+            self.record_wait(deployment, time.monotonic() - started)
+        return Admission(limiter)
+
+    def record_wait(self, deployment: str, seconds: float):
+        ADMISSION_WAIT_SECONDS.observe(seconds, deployment)
+        timer = current_timer.get()
+        if timer:
+            timer.add("admission", seconds)
+
+    def backoff(self, limiter: DeploymentLimiter, error: UpstreamUnavailable, attempt: int, deadline: float) -> float:
+        UPSTREAM_RETRIES.inc(1, limiter.deployment, str(error.status_code or "connect"))
+        if error.status_code == 429 and error.retry_after:
+            limiter.pause(error.retry_after)
+        ## the service's hint when there is one, else exponential backoff; jitter spreads the retries out
+        delay = error.retry_after if error.retry_after is not None else 0.5 * 2 ** attempt
+        delay *= 1 + random.uniform(0, 0.25)
+        if attempt >= self.max_retries or time.monotonic() + delay > deadline:
+            ADMISSION_REJECTED.inc(1, limiter.deployment)
+            raise AdmissionRejected(f"Deployment {limiter.deployment} is unavailable ({error}), try again shortly", delay)
+        logger.debug("Retrying %s in %.2fs after %s", limiter.deployment, delay, error.status_code)
+        return delay
+
+    def stats(self) -> dict:
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return {limiter.deployment: limiter.stats() for limiter in limiters}
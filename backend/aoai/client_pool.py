@@ -0,0 +1,114 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import httpx
+from openai import AzureOpenAI, AsyncAzureOpenAI
+
+logger = logging.getLogger(__name__)
+
+
+class AzureOpenAIClientPool():
+    """Process-wide registry of Azure OpenAI clients keyed by (endpoint, deployment, api_version).
+
+    All sync clients share one keep-alive httpx connection pool (and all async clients
+    another), so chat turns and title generation reuse warm TLS connections instead of
+    building a new client per call. Lookups are safe across worker threads. At most
+    `max_clients` clients of each kind are kept; the least recently used one is dropped first,
+    which costs nothing but a rebuild since the connections belong to the shared pool.
+    """
+
+    def __init__(self, api_key: str, max_connections: int = 100, max_keepalive_connections: int = 20, keepalive_expiry: float = 30.0,
+                 max_retries: int = 2, max_clients: int = 64):
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.max_clients = max_clients
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()
+        self._async_clients = OrderedDict()
+        self._http_client = None
+        self._async_http_client = None
+
+    def get_client(self, endpoint: str, deployment: str, api_version: str, api_key: str = None) -> AzureOpenAI:
+        with self._lock:
+            key = (endpoint, deployment, api_version)
+            client = self._clients.get(key)
+            if client:
+                self.hits += 1
+                self._clients.move_to_end(key)
+                return client
+
+            self.misses += 1
+            if not self._http_client:
+                self._http_client = httpx.Client(limits=self.limits)
+            client = AzureOpenAI(azure_endpoint=endpoint,
+                                 azure_deployment=deployment,
+                                 api_version=api_version,
+                                 api_key=api_key or self.api_key,
+                                 max_retries=self.max_retries,
+                                 http_client=self._http_client)
+            self._clients[key] = client
+            self.evict(self._clients)
+            logger.debug(f"Created Azure OpenAI client for {key}")
+            return client
+
+    def get_async_client(self, endpoint: str, deployment: str, api_version: str, api_key: str = None) -> AsyncAzureOpenAI:
+        with self._lock:
+            key = (endpoint, deployment, api_version)
+            client = self._async_clients.get(key)
+            if client:
+                self.hits += 1
+                self._async_clients.move_to_end(key)
+                return client
+
+            self.misses += 1
+            if not self._async_http_client:
+                self._async_http_client = httpx.AsyncClient(limits=self.limits)
+            client = AsyncAzureOpenAI(azure_endpoint=endpoint,
+                                      azure_deployment=deployment,
+                                      api_version=api_version,
+                                      api_key=api_key or self.api_key,
+                                      max_retries=self.max_retries,
+                                      http_client=self._async_http_client)
+            self._async_clients[key] = client
+            self.evict(self._async_clients)
+            logger.debug(f"Created async Azure OpenAI client for {key}")
+            return client
+
+    def evict(self, clients: OrderedDict):
+        ## not closed: closing a client would close the shared connection pool under the others
+        while len(clients) > self.max_clients:
+            clients.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "clients": len(self._clients) + len(self._async_clients),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def close(self):
+        with self._lock:
+            if self._http_client:
+                self._http_client.close()
+            self._clients.clear()
+            self._http_client = None
+
+    async def aclose(self):
+        with self._lock:
+            async_http_client = self._async_http_client
+            self._async_clients.clear()
+            self._async_http_client = None
+        if async_http_client:
+            await async_http_client.aclose()
@@ -0,0 +1,96 @@
+import copy
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+
+def parse_multi_columns(columns: str) -> list:
+    if "|" in columns:
+        return columns.split("|")
+    else:
+        return columns.split(",")
+
+
+def parse_bool(value) -> bool:
+    return str(value).lower() == "true"
+
+
+def parse_int(name: str, value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise Exception(f"{name} must be an integer, got {value!r}")
+
+
+def parse_float(name: str, value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise Exception(f"{name} must be a number, got {value!r}")
+
+
+@dataclass(frozen=True)
+class CompletionSettings():
+    temperature: float
+    max_tokens: int
+    top_p: float
+    stop: Optional[tuple]
+    stream: bool
+
+    @classmethod
+    def from_env(cls, temperature, max_tokens, top_p, stop_sequence, stream):
+        return cls(
+            temperature=parse_float("AZURE_OPENAI_TEMPERATURE", temperature),
+            max_tokens=parse_int("AZURE_OPENAI_MAX_TOKENS", max_tokens),
+            top_p=parse_float("AZURE_OPENAI_TOP_P", top_p),
+            stop=tuple(stop_sequence.split("|")) if stop_sequence else None,
+            stream=parse_bool(stream)
+        )
+
+    def as_parameters(self) -> dict:
+        return {
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "top_p": self.top_p,
+            "stop": list(self.stop) if self.stop else None,
+            "stream": self.stream
+        }
+
+
+@dataclass(frozen=True)
+class DataSourceTemplate():
+    """Request body for the extensions endpoint, built once from settings.
+
+    Only the messages, the optional security filter and the stream flag vary per
+    request. The parameters are kept read-only, and `build` gives every request its own
+    copy of them, so a caller that edits one request body cannot change the next.
+    """
+    type: str
+    parameters: Mapping
+    completion: CompletionSettings
+    query_type: str = "simple"
+    body: Mapping = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "parameters", MappingProxyType(copy.deepcopy(dict(self.parameters))))
+        object.__setattr__(self, "body", MappingProxyType(self.completion.as_parameters()))
+
+    @property
+    def supports_filter(self) -> bool:
+        return "filter" in self.parameters
+
+    def build(self, messages: list, filter: Optional[str] = None, stream: Optional[bool] = None) -> dict:
+        parameters = copy.deepcopy(dict(self.parameters))
+        if filter is not None and self.supports_filter:
+            parameters["filter"] = filter
+
+        body = copy.deepcopy(dict(self.body))
+        body["messages"] = messages
+        if stream is not None:
+            body["stream"] = stream
+        body["dataSources"] = [{"type": self.type, "parameters": parameters}]
+        return body
+
+    def masked(self) -> dict:
+        return {key: "*****" if key in ("key", "connectionString", "embeddingKey", "encodedApiKey") and value else value
+                for key, value in self.parameters.items()}
@@ -0,0 +1,350 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Iterable, Optional
+from urllib.parse import urlparse
+
+import httpx
+import openai
+
+from backend.aoai.admission import POLL_INTERVAL, Admission, AdmissionController, AdmissionRejected, UpstreamUnavailable
+from backend.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Circuit states of a backend
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+BACKEND_FAILURES = REGISTRY.counter("aoai_backend_failures_total", "Retryable Azure OpenAI failures, each followed by failover or backoff.",
+                                    ("backend", "status"))
+
+
+class UnknownModel(Exception):
+    """A request asked for a model that no deployment is configured for."""
+
+
+class ChatBackend():
+    """One Azure OpenAI deployment serving a logical model, with the health and latency the router keeps for it."""
+
+    def __init__(self, name: str, endpoint: str, deployment: str, api_key: str = None, priority: int = 0, limits: dict = None):
+        self.name = name
+        self.endpoint = endpoint if endpoint.endswith("/") else endpoint + "/"
+        self.deployment = deployment
+        self.api_key = api_key
+        self.priority = priority
+        self.limits = limits or {}
+        self.outstanding = 0
+        self.ttft = None
+        self.failures = 0
+        self.open_until = 0.0
+        self.trial = False
+
+    @classmethod
+    def from_config(cls, model: str, config: dict, api_key: str = None) -> "ChatBackend":
+        """A backend from one AZURE_OPENAI_DEPLOYMENT_POOLS entry, e.g.
+        {"endpoint": "https://contoso-east.openai.azure.com/", "deployment": "gpt-4", "key": "...", "priority": 0, "tpm": 40000}
+        """
+        if not config.get("endpoint"):
+            raise Exception(f"A deployment for {model} has no endpoint")
+        deployment = config.get("deployment", model)
+        host = urlparse(config["endpoint"]).hostname or config["endpoint"]
+        return cls(
+            name=config.get("name", f"{deployment}@{host.split('.')[0]}"),
+            endpoint=config["endpoint"],
+            deployment=deployment,
+            api_key=config.get("key", api_key),
+            priority=int(config.get("priority", 0)),
+            limits={key: config[key] for key in ("tpm", "rpm", "max_concurrency") if key in config}
+        )
+
+    def state(self, now: float) -> str:
+        if self.open_until > now:
+            return OPEN
+        return HALF_OPEN if self.open_until else CLOSED
+
+    def available(self, now: float) -> bool:
+        ## a half-open backend takes a single trial call until it proves healthy again
+        state = self.state(now)
+        return state == CLOSED or (state == HALF_OPEN and not self.trial)
+
+    def stats(self, now: float) -> dict:
+        return {"outstanding": self.outstanding, "ttft": self.ttft, "state": self.state(now)}
+
+
+class Lease():
+    """A routed call in progress: the backend it went to and its admission slot.
+
+    Wrap the answer in `track` (or `atrack`) so the backend's time to first token is measured,
+    and release the lease once the answer has been fully relayed; releasing twice is harmless.
+    """
+
+    def __init__(self, router: "DeploymentRouter", backend: ChatBackend, admission: Admission, started: float):
+        self.router = router
+        self.backend = backend
+        self.admission = admission
+        self.started = started
+        self.first_token_seconds = None
+        self.released = False
+
+    def first_token(self):
+        if self.first_token_seconds is None:
+            self.first_token_seconds = time.monotonic() - self.started
+            self.router.observe(self.backend, self.first_token_seconds)
+
+    def track(self, chunks):
+        for chunk in chunks:
+            self.first_token()
+            yield chunk
+
+    async def atrack(self, chunks):
+        async for chunk in chunks:
+            self.first_token()
+            yield chunk
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.admission.release()
+            self.router.finish(self.backend)
+
+
+class DeploymentRouter():
+    """Spreads the calls for each logical model over a pool of Azure OpenAI backends.
+
+    A call goes to the backend with the best (lowest) priority that has a free admission slot,
+    and among equals to the one with the lowest (outstanding calls + 1) x EWMA time to first
+    token, so a slow or busy region gets less traffic and PAYG deployments only take what the
+    PTU ones cannot; when every backend is at its limit the call queues on the best one. A backend that throttles (429) is taken out of rotation for its
+    Retry-After, and one that fails `failure_threshold` times in a row (5xx, no connection) for
+    `cooldown` seconds; afterwards a single trial call decides whether it is back. A call that
+    fails before anything has streamed moves to the next backend at once, and only when all of
+    them have failed does it back off and start over, within the admission controller's
+    `max_wait` and `max_retries`. Models without a configured pool get a single backend from
+    `default_backend`, so a plain one-resource setup keeps working unchanged. When `models` is
+    given only those (and the pooled ones) are routed; anything else raises UnknownModel, so a
+    client cannot grow the pools, limiters and metric labels by making up model names.
+    """
+
+    def __init__(self, controller: AdmissionController, pools: dict = None, default_backend: Callable[[str], ChatBackend] = None,
+                 models: Iterable[str] = None, failure_threshold: int = 3, cooldown: float = 30.0, ewma_alpha: float = 0.3):
+        self.controller = controller
+        self.pools = pools or {}
+        self.default_backend = default_backend
+        self.models = None if models is None else frozenset(models)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+        for backends in self.pools.values():
+            for backend in backends:
+                self.register(backend)
+
+    def register(self, backend: ChatBackend):
+        if backend.limits:
+            self.controller.deployments.setdefault(backend.name, backend.limits)
+
+    def routes(self, model: str) -> bool:
+        if model in self.pools:
+            return True
+        return bool(model) and self.default_backend is not None and (self.models is None or model in self.models)
+
+    def backends(self, model: str) -> list:
+        with self._lock:
+            backends = self.pools.get(model)
+            if backends is None:
+                if not self.routes(model):
+                    raise UnknownModel(f"No Azure OpenAI deployment is configured for {model}")
+                backends = self.pools[model] = [self.default_backend(model)]
+                self.register(backends[0])
+            return backends
+
+    def candidates(self, model: str, exclude: set) -> list:
+        """The available backends not yet tried, best first."""
+        backends = self.backends(model)
+        with self._lock:
+            now = time.monotonic()
+            available = [b for b in backends if b not in exclude and b.available(now)]
+            ## a backend without a measurement yet scores like the fastest known one, so it gets tried
+            known = [b.ttft for b in available if b.ttft is not None]
+            default_ttft = min(known) if known else 1.0
+            return sorted(available, key=lambda b: (b.priority, (b.outstanding + 1) * (b.ttft if b.ttft is not None else default_ttft)))
+
+    def reopens_in(self, model: str) -> float:
+        """Seconds until the first open circuit of the model's pool lets a trial call through."""
+        now = time.monotonic()
+        with self._lock:
+            waits = [b.open_until - now for b in self.pools.get(model, []) if b.state(now) == OPEN]
+        return max(min(waits), POLL_INTERVAL) if waits else POLL_INTERVAL
+
+    def begin(self, backend: ChatBackend):
+        with self._lock:
+            backend.outstanding += 1
+            if backend.state(time.monotonic()) == HALF_OPEN:
+                backend.trial = True
+
+    def finish(self, backend: ChatBackend):
+        with self._lock:
+            backend.outstanding -= 1
+
+    def succeeded(self, backend: ChatBackend):
+        with self._lock:
+            if backend.open_until:
+                logger.info("Azure OpenAI backend %s is healthy again", backend.name)
+            backend.failures = 0
+            backend.open_until = 0.0
+            backend.trial = False
+
+    def failed(self, backend: ChatBackend, error: UpstreamUnavailable):
+        with self._lock:
+            now = time.monotonic()
+            backend.outstanding -= 1
+            was_trial = backend.trial
+            backend.trial = False
+            backend.failures += 1
+            if error.status_code == 429:
+                ## throttled: out of rotation until the service says it takes calls again
+                open_for = error.retry_after if error.retry_after is not None else self.cooldown
+            elif was_trial or backend.failures >= self.failure_threshold:
+                open_for = self.cooldown
+            else:
+                open_for = 0.0
+            if open_for:
+                backend.open_until = now + open_for
+                logger.warning("Azure OpenAI backend %s out of rotation for %.1fs after %s", backend.name, open_for, error)
+        BACKEND_FAILURES.inc(1, backend.name, str(error.status_code or "connect"))
+
+    def aborted(self, backend: ChatBackend, error: BaseException):
+        """A call that ended in an error not worth retrying elsewhere: a 4xx, a content filter, a cancellation."""
+        with self._lock:
+            backend.outstanding -= 1
+            ## a trial call that proved nothing must not keep the backend out of rotation
+            backend.trial = False
+        if isinstance(error, (openai.APIStatusError, httpx.HTTPStatusError)):
+            ## the service answered, so it is reachable
+            self.succeeded(backend)
+
+    def observe(self, backend: ChatBackend, seconds: float):
+        with self._lock:
+            if backend.ttft is None:
+                backend.ttft = seconds
+            else:
+                backend.ttft += self.ewma_alpha * (seconds - backend.ttft)
+
+    def admit(self, model: str, cost: int, deadline: float, tried: set):
+        """The best backend that has a slot, with its admission; (None, None) when none is left to try."""
+        candidates = self.candidates(model, tried)
+        for backend in candidates:
+            admission = self.controller.try_admit(backend.name, cost)
+            if admission:
+                self.begin(backend)
+                return backend, admission
+        ## every candidate is at its limit: queue on the best one, or the next when that queue is full
+        for i, backend in enumerate(candidates):
+            try:
+                admission = self.controller.admit(backend.name, cost, deadline)
+            except AdmissionRejected:
+                if i == len(candidates) - 1:
+                    raise
+                continue
+            self.begin(backend)
+            return backend, admission
+        return None, None
+
+    async def aadmit(self, model: str, cost: int, deadline: float, tried: set):
+        candidates = self.candidates(model, tried)
+        for backend in candidates:
+            admission = self.controller.try_admit(backend.name, cost)
+            if admission:
+                self.begin(backend)
+                return backend, admission
+        for i, backend in enumerate(candidates):
+            try:
+                admission = await self.controller.aadmit(backend.name, cost, deadline)
+            except AdmissionRejected:
+                if i == len(candidates) - 1:
+                    raise
+                continue
+            self.begin(backend)
+            return backend, admission
+        return None, None
+
+    def next_round(self, model: str, error: Optional[UpstreamUnavailable], last: Optional[ChatBackend], attempt: int,
+                   deadline: float) -> float:
+        """How long to wait before trying the pool again, or AdmissionRejected when the budget is spent."""
+        if error is None:
+            ## nothing to try: every circuit is open, or a trial call is still out
+            wait = self.reopens_in(model)
+            if time.monotonic() + wait > deadline:
+                raise AdmissionRejected(f"No healthy Azure OpenAI deployment for {model}, try again shortly", wait)
+            return wait
+        return self.controller.backoff(self.controller.limiter(last.name), error, attempt, deadline + (error.retry_after or 0))
+
+    def call(self, model: str, cost: int, send: Callable[[ChatBackend], object]):
+        """Runs `send(backend)` on the best backend, failing over while nothing has streamed.
+
+        Returns (lease, result); release the lease once the answer has been relayed. Raises
+        AdmissionRejected when no backend can take the call within the wait budget.
+        """
+        deadline = time.monotonic() + self.controller.max_wait
+        attempt, tried = 0, set()
+        while True:
+            error = last = None
+            while True:
+                backend, admission = self.admit(model, cost, deadline, tried)
+                if not backend:
+                    break
+                started = time.monotonic()
+                try:
+                    result = send(backend)
+                except UpstreamUnavailable as e:
+                    admission.release()
+                    self.failed(backend, e)
+                    tried.add(backend)
+                    error, last = e, backend
+                    continue
+                except BaseException as e:
+                    admission.release()
+                    self.aborted(backend, e)
+                    raise
+                self.succeeded(backend)
+                return Lease(self, backend, admission, started), result
+            time.sleep(self.next_round(model, error, last, attempt, deadline))
+            if error:
+                attempt += 1
+            tried.clear()
+
+    async def acall(self, model: str, cost: int, send):
+        """`call` for an async `send(backend)`."""
+        deadline = time.monotonic() + self.controller.max_wait
+        attempt, tried = 0, set()
+        while True:
+            error = last = None
+            while True:
+                backend, admission = await self.aadmit(model, cost, deadline, tried)
+                if not backend:
+                    break
+                started = time.monotonic()
+                try:
+                    result = await send(backend)
+                except UpstreamUnavailable as e:
+                    admission.release()
+                    self.failed(backend, e)
+                    tried.add(backend)
+                    error, last = e, backend
+                    continue
+                except BaseException as e:
+                    admission.release()
+                    self.aborted(backend, e)
+                    raise
+                self.succeeded(backend)
+                return Lease(self, backend, admission, started), result
+            await asyncio.sleep(self.next_round(model, error, last, attempt, deadline))
+            if error:
+                attempt += 1
+            tried.clear()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {backend.name: backend.stats(now) for backends in self.pools.values() for backend in backends}
@@ -0,0 +1,109 @@
+import json
+import re
+
+# A frame whose delta carries nothing but a content token, e.g. {"delta":{"content":"Hello"}}.
+# The capture is the raw, already JSON-encoded string, so it can be copied into the output as-is.
+CONTENT_DELTA = re.compile(rb'"delta":\{"content":("(?:[^"\\]|\\.)*")\}')
+END_TURN = b'"end_turn":true'
+DONE = b'"[DONE]"'
+SENTINEL = "\x00content\x00"
+
+
+class SSEParser():
+    """Incremental Server-Sent Events parser.
+
+    Accepts arbitrarily sized byte chunks straight off the socket and returns the
+    payload of every `data:` field that is complete, so reads can be as large as the
+    network allows instead of a few bytes at a time.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.data = []
+
+    def feed(self, chunk: bytes) -> list:
+        events = []
+        self.buffer += chunk
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if not line:
+                if self.data:
+                    events.append(b"\n".join(self.data))
+                    self.data = []
+            elif line.startswith(b"data:"):
+                self.data.append(line[5:].lstrip(b" "))
+        return events
+
+    def flush(self) -> list:
+        events = self.feed(b"\n\n") if self.buffer else []
+        if self.data:
+            events.append(b"\n".join(self.data))
+            self.data = []
+        return events
+
+
+class StreamRelay():
+    """Rewrites upstream extension frames into the frontend's ndjson chunks.
+
+    Frames go through `build_response` (the full parse) until it has produced a
+    regular message chunk. Its envelope is then serialized once, and later frames
+    that only carry a content token are relayed by splicing the raw token into that
+    template, without decoding or re-encoding the frame.
+    """
+
+    def __init__(self, build_response):
+        self.build_response = build_response
+        self.prefix = None
+        self.suffix = None
+
+    def relay(self, data: bytes):
+        if self.prefix is not None and END_TURN not in data:
+            match = CONTENT_DELTA.search(data)
+            if match:
+                content = match.group(1)
+                if content == DONE:
+                    return None
+                return self.prefix + content.decode("utf-8") + self.suffix
+
+        response = self.build_response(data)
+        if response is None:
+            return None
+        if self.prefix is None and "choices" in response:
+            self.compile_template(response)
+        return json.dumps(response, ensure_ascii=False) + "\n"
+
+    def compile_template(self, response: dict):
+        template = dict(response)
+        template["choices"] = [{"messages": [{"role": "assistant", "content": SENTINEL}]}]
+        serialized = json.dumps(template, ensure_ascii=False)
+        self.prefix, suffix = serialized.split(json.dumps(SENTINEL), 1)
+        self.suffix = suffix + "\n"
+
+
+def relay_stream(byte_chunks, build_response):
+    parser = SSEParser()
+    relay = StreamRelay(build_response)
+    for chunk in byte_chunks:
+        for data in parser.feed(chunk):
+            line = relay.relay(data)
+            if line:
+                yield line
+    for data in parser.flush():
+        line = relay.relay(data)
+        if line:
+            yield line
+
+
+async def arelay_stream(byte_chunks, build_response):
+    parser = SSEParser()
+    relay = StreamRelay(build_response)
+    async for chunk in byte_chunks:
+        for data in parser.feed(chunk):
+            line = relay.relay(data)
+            if line:
+                yield line
+    for data in parser.flush():
+        line = relay.relay(data)
+        if line:
+            yield line
@@ -0,0 +1,62 @@
+import importlib.util
+import logging
+import threading
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+class ExtensionsTransport():
+    """Long-lived, pooled HTTP transport for the on-your-data extensions endpoint.
+
+    One keep-alive connection pool is shared by every request in the process (httpx
+    clients are safe to use from many threads), so grounded chats skip DNS, TCP and
+    TLS setup. HTTP/2 is used when the optional `h2` package is installed.
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20, keepalive_expiry: float = 30.0,
+                 connect_timeout: float = 10.0, read_timeout: float = 60.0, http2: bool = True):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.http2 = http2 and http2_available()
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self) -> httpx.Client:
+        with self._lock:
+            if not self._client:
+                self._client = httpx.Client(limits=self.limits, timeout=self.timeout, http2=self.http2)
+                logger.debug(f"Created extensions transport (http2={self.http2})")
+            return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        with self._lock:
+            if not self._async_client:
+                self._async_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+                logger.debug(f"Created async extensions transport (http2={self.http2})")
+            return self._async_client
+
+    def close(self):
+        with self._lock:
+            if self._client:
+                self._client.close()
+            self._client = None
+
+    async def aclose(self):
+        with self._lock:
+            async_client = self._async_client
+            self._async_client = None
+        if async_client:
+            await async_client.aclose()
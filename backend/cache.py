@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache():
+    """Bounded, thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    `get` loads missing keys through the given loader, and concurrent callers asking
+    for the same key wait on a single in-flight load instead of repeating it. With
+    `refresh_ahead` set, a hit on an entry that expires within that many seconds
+    schedules a background reload so hot keys never go cold. Failed loads are not cached.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0, refresh_ahead: float = 0.0, name: str = "cache"):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key, loader):
+        if not self.enabled:
+            return loader()
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if self.refresh_ahead and entry[1] - now < self.refresh_ahead and key not in self._inflight:
+                    self._schedule_refresh(key, loader)
+                return entry[0]
+
+            self.misses += 1
+            future = self._inflight.get(key)
+            if future:
+                leader = False
+            else:
+                future = self._inflight[key] = Future()
+                leader = True
+
+        if not leader:
+            return future.result()
+        return self._load(key, loader, future)
+
+    def peek(self, key, record_stats: bool = False):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                if record_stats:
+                    self.hits += 1
+                return entry[0]
+            if record_stats:
+                self.misses += 1
+            return None
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes
+            }
+
+    def _load(self, key, loader, future):
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._store(key, value)
+            self._inflight.pop(key, None)
+        future.set_result(value)
+        return value
+
+    def _store(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _schedule_refresh(self, key, loader):
+        # called with the lock held
+        future = self._inflight[key] = Future()
+        self.refreshes += 1
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix=f"{self.name}-refresh")
+        self._executor.submit(self._refresh, key, loader, future)
+
+    def _refresh(self, key, loader, future):
+        try:
+            self._load(key, loader, future)
+        except Exception as e:
+            logger.warning(f"Background refresh of {self.name} entry failed: {e}")
@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from backend.metrics import COSMOS_REQUEST_SECONDS, COSMOS_REQUEST_UNITS, current_timer
+
+logger = logging.getLogger(__name__)
+
+
+class RequestCharge():
+    """`response_hook` for azure-cosmos calls that sums the RU charge of every response page."""
+
+    def __init__(self):
+        self.request_charge = 0.0
+        self.requests = 0
+
+    def __call__(self, headers, result):
+        ## query_items also invokes the hook once with the (not yet fetched) pager, which carries stale headers;
+        ## a 304 from a conditional read has no body at all
+        if result is not None and not isinstance(result, (dict, list)):
+            return
+        self.request_charge += float(headers.get('x-ms-request-charge', 0) or 0)
+        self.requests += 1
+
+
+class CosmosRequestMetrics():
+    """Per-operation request unit and latency totals for a Cosmos DB client."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    @contextmanager
+    def measure(self, operation: str):
+        charge = RequestCharge()
+        started = time.perf_counter()
+        try:
+            yield charge
+        finally:
+            duration = time.perf_counter() - started
+            self.record(operation, charge.request_charge, duration, charge.requests)
+            self.report(operation, charge.request_charge, duration, charge.requests)
+
+    def measure_pages(self, operation: str, query):
+        """Yields the result pages of `query(response_hook)` as lists, recording each page fetch as one call.
+
+        Only the fetches are timed, not what the caller does between pages (e.g. relaying them to
+        a slow client); the request's Server-Timing gets a single entry with their total.
+        """
+        charge = RequestCharge()
+        pages = iter(query(charge))
+        total_charge, total_duration, total_requests = 0.0, 0.0, 0
+        try:
+            while True:
+                request_charge, requests = charge.request_charge, charge.requests
+                started = time.perf_counter()
+                try:
+                    page = list(next(pages))
+                except StopIteration:
+                    return
+                duration = time.perf_counter() - started
+                self.record(operation, charge.request_charge - request_charge, duration, charge.requests - requests)
+                total_charge, total_duration, total_requests = charge.request_charge, total_duration + duration, charge.requests
+                yield page
+        finally:
+            self.report(operation, total_charge, total_duration, total_requests)
+
+    def report(self, operation: str, request_charge: float, duration: float, requests: int):
+        timer = current_timer.get()
+        if timer:
+            timer.add(f"cosmos_{operation}", duration)
+        logger.debug("%s.%s: %.2f RU, %d request(s), %.1f ms", self.name, operation, request_charge, requests, duration * 1000)
+
+    def record(self, operation: str, request_charge: float, duration: float, requests: int = 1):
+        COSMOS_REQUEST_SECONDS.observe(duration, self.name, operation)
+        COSMOS_REQUEST_UNITS.inc(request_charge, self.name, operation)
+        with self._lock:
+            totals = self._operations.setdefault(operation, {"calls": 0, "requests": 0, "request_charge": 0.0, "duration": 0.0})
+            totals["calls"] += 1
+            totals["requests"] += requests
+            totals["request_charge"] += request_charge
+            totals["duration"] += duration
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {operation: dict(totals) for operation, totals in self._operations.items()}
@@ -0,0 +1,79 @@
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from backend.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class BulkDeleteJobs():
+    """Runs long chat history deletions in the background and tracks their progress.
+
+    The worker running a job keeps it in memory. With a `store` (the conversation client) the
+    job is also saved to Cosmos DB in the user's partition, at most every `save_interval`
+    seconds while it runs, so a poll that reaches another worker or instance finds it too.
+    Jobs are kept for `retention` seconds after they are submitted, and each job is visible
+    only to the user who started it.
+    """
+
+    def __init__(self, max_workers: int = 2, retention: float = 3600.0, store=None, save_interval: float = 1.0):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bulk-delete")
+        self.jobs = TTLCache(max_entries=1024, ttl=retention, name="bulk-delete-jobs")
+        self.retention = retention
+        self.store = store
+        self.save_interval = save_interval
+
+    def submit(self, user_id, delete) -> dict:
+        ## delete is called with a progress(deleted, total) callback
+        job = {
+            'job_id': str(uuid.uuid4()),
+            'status': 'running',
+            'deleted': 0,
+            'total': None
+        }
+        self.jobs.set((user_id, job['job_id']), job)
+        ## saved before the job id is handed out, so the first poll finds it on any worker
+        self.save(user_id, job)
+        self.executor.submit(self._run, user_id, job, delete)
+        return dict(job)
+
+    def get(self, user_id, job_id):
+        job = self.jobs.peek((user_id, job_id))
+        if job:
+            return dict(job)
+        if self.store:
+            return self.store.get_delete_job(user_id, job_id)
+        return None
+
+    def save(self, user_id, job):
+        job['updatedAt'] = datetime.utcnow().isoformat()
+        if not self.store:
+            return
+        try:
+            self.store.save_delete_job(user_id, dict(job), ttl=int(self.retention))
+        except Exception:
+            ## reporting progress must not fail the deletion itself
+            logger.exception(f"Exception saving bulk delete job {job['job_id']}")
+
+    def _run(self, user_id, job, delete):
+        saved = time.monotonic()
+
+        def progress(deleted, total):
+            nonlocal saved
+            job['deleted'] = deleted
+            job['total'] = total
+            if time.monotonic() - saved >= self.save_interval:
+                saved = time.monotonic()
+                self.save(user_id, job)
+
+        try:
+            job['result'] = delete(progress)
+            job['status'] = 'succeeded'
+        except Exception as e:
+            logger.exception(f"Exception in bulk delete job {job['job_id']}")
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        self.save(user_id, job)
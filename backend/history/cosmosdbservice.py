@@ -1,35 +1,35 @@
-import logging
+import base64
+import json
 import os
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from flask import Flask, request
 from azure.identity import DefaultAzureCredential  
-from azure.cosmos import CosmosClient, PartitionKey  
-from opencensus.ext.azure.log_exporter import AzureLogHandler
-
-# Debug settings
-DEBUG = os.environ.get("DEBUG", "false")
-DEBUG_LOGGING = DEBUG.lower() == "true"
-if DEBUG_LOGGING:
-    logging.basicConfig(level=logging.DEBUG)
-
-# Set up Azure App Insights logger
-try:
-    app_insights_conn_str = os.environ.get("AZURE_APP_INSIGHTS_CONNECTION_STRING", "")
-    logger = logging.getLogger(__name__)
-    handler = AzureLogHandler(connection_string=app_insights_conn_str)
-    logger.addHandler(handler)
-    if DEBUG_LOGGING:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
-    logger.info("Loaded Azure App Insights for CosmosDB service")
-except Exception as e:
-    raise Exception(f"Exception initializing Azure App Insights logger: {e}")
+from azure.core import MatchConditions
+from azure.cosmos import CosmosClient, PartitionKey, exceptions
+
+from backend.cache import TTLCache
+from backend.cosmos_metrics import CosmosRequestMetrics
+from backend.telemetry import get_logger
+
+# Shared App Insights log pipeline
+logger = get_logger(__name__)
+
+# Cosmos DB allows at most 100 operations in one transactional batch
+MAX_BATCH_OPERATIONS = 100
+
+## fields returned to the frontend by /history/list and /history/read
+CONVERSATION_LIST_FIELDS = ('id', 'title', 'createdAt', 'updatedAt')
+MESSAGE_FIELDS = ('id', 'role', 'content', 'createdAt', 'feedback')
+## fields of a background delete job returned by /history/delete_all/<job_id>
+DELETE_JOB_FIELDS = ('job_id', 'status', 'deleted', 'total', 'result', 'error', 'updatedAt')
 
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False,
+                 cache: TTLCache = None, cache_fresh: float = 5.0):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
@@ -38,19 +38,26 @@ class CosmosConversationClient():
         self.database_client = self.cosmosdb_client.get_database_client(database_name)
         self.container_client = self.database_client.get_container_client(container_name)
         self.enable_message_feedback = enable_message_feedback
+        self.request_metrics = CosmosRequestMetrics("conversations")
+        ## conversations and short message lists, kept current by the writes made through this client.
+        ## Entries younger than cache_fresh seconds are served as-is; older ones are revalidated with their ETag
+        ## so changes made by other workers are picked up.
+        self.cache = cache or TTLCache(max_entries=0, ttl=0, name="conversations")
+        self.cache_fresh = cache_fresh
 
     def ensure(self):
         try:
             if not self.cosmosdb_client or not self.database_client or not self.container_client:
                 return False
             
-            container_info = self.container_client.read()
+            with self.request_metrics.measure("ensure") as hook:
+                container_info = self.container_client.read(response_hook=hook)
             if not container_info:
                 return False
             
             return True
         except Exception as e:
-            logger.exception(f"Exception occurred in cosmosdbservice.py ", e)
+            logger.exception("Exception occurred in cosmosdbservice.py")
             return False
 
     def create_conversation(self, user_id, title = ''):
@@ -63,125 +70,310 @@ class CosmosConversationClient():
             'title': title
         }
         ## TODO: add some error handling based on the output of the upsert_item call
-        resp = self.container_client.upsert_item(conversation)  
+        with self.request_metrics.measure("create_conversation") as hook:
+            resp = self.container_client.upsert_item(conversation, response_hook=hook)
         if resp:
-            logger.debug(f"create_conversation response: {resp}")
+            logger.debug("create_conversation response: %s", resp)
+            self.cache_conversation(resp)
             return resp
         else:
             logger.debug("No response object returned during create_conversation call")
             return False
     
     def upsert_conversation(self, conversation):
-        resp = self.container_client.upsert_item(conversation)
+        with self.request_metrics.measure("upsert_conversation") as hook:
+            resp = self.container_client.upsert_item(conversation, response_hook=hook)
         if resp:
-            logger.debug(f"upsert_conversation response: {resp}")
+            logger.debug("upsert_conversation response: %s", resp)
+            self.cache_conversation(resp)
             return resp
         else:
             logger.debug("No response object returned during upsert_conversation call")
             return False
 
+    def update_conversation_title(self, user_id, conversation_id, title):
+        ## partial update, so it cannot clobber concurrent writes to the rest of the conversation
+        with self.request_metrics.measure("update_conversation_title") as hook:
+            resp = self.container_client.patch_item(item=conversation_id, partition_key=user_id,
+                                                    patch_operations=[{'op': 'set', 'path': '/title', 'value': title}],
+                                                    response_hook=hook)
+        if resp:
+            logger.debug("update_conversation_title response: %s", resp)
+            self.cache_conversation(resp)
+            return resp
+        else:
+            logger.debug("No response object returned during update_conversation_title call")
+            return False
+
     def delete_conversation(self, user_id, conversation_id):
-        conversation = self.container_client.read_item(item=conversation_id, partition_key=user_id)        
+        self.evict_conversation(user_id, conversation_id)
+        with self.request_metrics.measure("delete_conversation") as hook:
+            conversation = self.container_client.read_item(item=conversation_id, partition_key=user_id, response_hook=hook)
+            if conversation:
+                resp = self.container_client.delete_item(item=conversation_id, partition_key=user_id, response_hook=hook)
         if conversation:
-            resp = self.container_client.delete_item(item=conversation_id, partition_key=user_id)
-            logger.debug(f"delete_conversation response: {resp}")
+            logger.debug("delete_conversation response: %s", resp)
             return resp
         else:
             logger.debug("No response object returned during delete_conversation call")
             return True
         
-    def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
-
-    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+    def delete_messages(self, conversation_id, user_id, max_concurrency=4, progress=None):
+        ## only the ids are needed to delete the messages in the conversation
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            }
+        ]
+        query = "SELECT VALUE c.id FROM c WHERE c.conversationId = @conversationId AND c.type='message'"
+        message_ids = self.get_item_ids(user_id, query, parameters)
+        self.cache.invalidate(('messages', user_id, conversation_id))
+        deleted = self.delete_items(user_id, message_ids, max_concurrency, progress)
+        self.touch_conversation(user_id, conversation_id)
+        return deleted
+
+    def delete_all_conversations(self, user_id, max_concurrency=4, progress=None):
+        ## messages go first, so a failure part way through never leaves messages without their conversation
+        message_ids = self.get_item_ids(user_id, "SELECT VALUE c.id FROM c WHERE c.type='message'")
+        conversation_ids = self.get_item_ids(user_id, "SELECT VALUE c.id FROM c WHERE c.type='conversation'")
+        total = len(message_ids) + len(conversation_ids)
+        for conversation_id in conversation_ids:
+            self.evict_conversation(user_id, conversation_id)
+
+        deleted_messages = self.delete_items(user_id, message_ids, max_concurrency,
+                                             progress and (lambda deleted, _: progress(deleted, total)))
+        deleted_conversations = self.delete_items(user_id, conversation_ids, max_concurrency,
+                                                  progress and (lambda deleted, _: progress(deleted_messages + deleted, total)))
+        return {'conversations': deleted_conversations, 'messages': deleted_messages}
+
+    def save_delete_job(self, user_id, job, ttl=None):
+        ## kept in the user's partition so every worker can report the job; its type keeps it out of the deletion
+        document = {**job, 'id': job['job_id'], 'type': 'deleteJob', 'userId': user_id}
+        if ttl:
+            document['ttl'] = ttl
+        with self.request_metrics.measure("save_delete_job") as hook:
+            self.container_client.upsert_item(document, response_hook=hook)
+
+    def get_delete_job(self, user_id, job_id):
+        try:
+            with self.request_metrics.measure("get_delete_job") as hook:
+                document = self.container_client.read_item(item=job_id, partition_key=user_id, response_hook=hook)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        if not document or document.get('type') != 'deleteJob':
+            return None
+        return {key: document[key] for key in DELETE_JOB_FIELDS if key in document}
+
+    def get_item_ids(self, user_id, query, parameters=[]):
+        with self.request_metrics.measure("get_item_ids") as hook:
+            return list(self.container_client.query_items(query=query, parameters=parameters,
+                                                          partition_key=user_id, response_hook=hook))
+
+    def delete_items(self, user_id, item_ids, max_concurrency=4, progress=None):
+        ## delete in transactional batches within the user's partition, a bounded number at a time
+        batches = [item_ids[i:i + MAX_BATCH_OPERATIONS] for i in range(0, len(item_ids), MAX_BATCH_OPERATIONS)]
+        deleted = 0
+        if not batches:
+            return deleted
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(batches)))) as executor:
+            for count in executor.map(lambda batch: self.delete_batch(user_id, batch), batches):
+                deleted += count
+                if progress:
+                    progress(deleted, len(item_ids))
+        logger.debug("delete_items deleted %s items", deleted)
+        return deleted
+
+    def delete_batch(self, user_id, item_ids):
+        with self.request_metrics.measure("delete_batch") as hook:
+            try:
+                self.container_client.execute_item_batch(batch_operations=[('delete', (item_id,)) for item_id in item_ids],
+                                                         partition_key=user_id, response_hook=hook)
+            except exceptions.CosmosBatchOperationError:
+                ## the batch is all or nothing, e.g. when one item was already deleted; fall back to one at a time
+                for item_id in item_ids:
+                    try:
+                        self.container_client.delete_item(item=item_id, partition_key=user_id, response_hook=hook)
+                    except exceptions.CosmosResourceNotFoundError:
+                        pass
+        return len(item_ids)
+
+    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0, cursor = None, fields = None):
         parameters = [
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        query = f"SELECT {projection(fields)} FROM c where c.userId = @userId and c.type='conversation'"
+        if cursor:
+            ## keyset pagination: continue from the last page's updatedAt instead of skipping rows with OFFSET,
+            ## which Cosmos still reads (and charges for). Conversations already returned with that exact
+            ## updatedAt are excluded so ties are neither repeated nor dropped.
+            comparison = '<=' if sort_order.upper() == 'DESC' else '>='
+            query += f" and c.updatedAt {comparison} @updatedAt and not array_contains(@seenIds, c.id)"
+            parameters.append({'name': '@updatedAt', 'value': cursor['updatedAt']})
+            parameters.append({'name': '@seenIds', 'value': cursor['ids']})
+        ## a single-path ORDER BY is served by the default range index, so containers created without
+        ## the composite index in infra/db.bicep (e.g. from infrastructure/deployment.json) still work
+        query += f" order by c.updatedAt {sort_order}"
         if limit is not None:
-            query += f" offset {offset} limit {limit}" 
+            query += f" offset {0 if cursor else offset} limit {limit}" 
             
-        conversations = list(self.container_client.query_items(query=query, parameters=parameters,
-                                                                               enable_cross_partition_query =True))
+        ## every document is partitioned by userId, so scope the query to the user's partition
+        with self.request_metrics.measure("get_conversations") as hook:
+            conversations = list(self.container_client.query_items(query=query, parameters=parameters,
+                                                                   partition_key=user_id, response_hook=hook))
         ## if no conversations are found, return None
         if len(conversations) == 0:
             logger.debug("No conversations were found.")
             return []
         else:
-            logger.debug(f"Conversations found: {conversations}")
+            logger.debug("Conversations found: %s", conversations)
             return conversations
 
     def get_conversation(self, user_id, conversation_id):
-        parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
-            {
-                'name': '@userId',
-                'value': user_id
-            }
-        ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        conversation = list(self.container_client.query_items(query=query, parameters=parameters,
-                                                                               enable_cross_partition_query =True))
-        ## if no conversations are found, return None
-        if len(conversation) == 0:
+        key = ('conversation', user_id, conversation_id)
+        entry = self.cache.peek(key, record_stats=True)
+        try:
+            if entry and time.monotonic() - entry[1] < self.cache_fresh:
+                conversation = entry[0]
+            elif entry:
+                ## revalidate: an unchanged document comes back as a bodiless 304
+                with self.request_metrics.measure("get_conversation") as hook:
+                    conversation = self.container_client.read_item(item=conversation_id, partition_key=user_id,
+                                                                   etag=entry[0]['_etag'], match_condition=MatchConditions.IfModified,
+                                                                   response_hook=hook) or entry[0]
+                self.cache_conversation(conversation)
+            else:
+                ## point read by id within the user's partition
+                with self.request_metrics.measure("get_conversation") as hook:
+                    conversation = self.container_client.read_item(item=conversation_id, partition_key=user_id, response_hook=hook)
+                self.cache_conversation(conversation)
+        except exceptions.CosmosResourceNotFoundError:
+            self.evict_conversation(user_id, conversation_id)
+            conversation = None
+
+        if not conversation or conversation.get('type') != 'conversation':
             logger.debug("No conversation was found.")
             return None
         else:
-            logger.debug(f"Conversations found: {conversation[0]}")
-            return conversation[0]
+            logger.debug("Conversations found: %s", conversation)
+            ## callers may modify what they get back, never hand out the cached document itself
+            return dict(conversation)
+
+    def cache_conversation(self, conversation):
+        if conversation and conversation.get('type') == 'conversation':
+            self.cache.set(('conversation', conversation['userId'], conversation['id']), (conversation, time.monotonic()))
+
+    def touch_conversation(self, user_id, conversation_id):
+        ## changes the conversation's ETag, so every worker drops its cached message list for it;
+        ## a counter rather than updatedAt, which would move the conversation up the history list
+        try:
+            with self.request_metrics.measure("touch_conversation") as hook:
+                resp = self.container_client.patch_item(item=conversation_id, partition_key=user_id,
+                                                        patch_operations=[{'op': 'incr', 'path': '/messagesVersion', 'value': 1}],
+                                                        response_hook=hook)
+        except exceptions.CosmosResourceNotFoundError:
+            self.evict_conversation(user_id, conversation_id)
+            return
+        self.cache_conversation(resp)
+
+    def evict_conversation(self, user_id, conversation_id):
+        self.cache.invalidate(('conversation', user_id, conversation_id))
+        self.cache.invalidate(('messages', user_id, conversation_id))
  
     def create_message(self, uuid, conversation_id, user_id, input_message: dict):
-        message = {
-            'id': uuid,
-            'type': 'message',
-            'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
-            'conversationId' : conversation_id,
-            'role': input_message['role'],
-            'content': input_message['content']
-        }
+        messages = self.create_messages(conversation_id, user_id, [(uuid, input_message)])
+        return messages[0] if messages else False
 
-        if self.enable_message_feedback:
-            message['feedback'] = ''
-        
-        resp = self.container_client.upsert_item(message)  
-        if resp:
-            logger.debug(f"create_message response: {resp}")
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = self.get_conversation(user_id, conversation_id)
-            conversation['updatedAt'] = message['createdAt']
-            self.upsert_conversation(conversation)
-            return resp
-        else:
-            logger.debug("No response returned in create_message")
-            return False
+    def create_messages(self, conversation_id, user_id, input_messages: list):
+        ## input_messages is a list of (message id, chat message) pairs, written in order
+        messages = []
+        for message_id, input_message in input_messages:
+            message = {
+                'id': message_id,
+                'type': 'message',
+                'userId' : user_id,
+                'createdAt': datetime.utcnow().isoformat(),
+                'updatedAt': datetime.utcnow().isoformat(),
+                'conversationId' : conversation_id,
+                'role': input_message['role'],
+                'content': input_message['content']
+            }
+            if self.enable_message_feedback:
+                message['feedback'] = ''
+            messages.append(message)
+
+        if not messages:
+            return []
+
+        ## write the messages and bump the parent conversation's updatedAt to the newest message's createdAt
+        ## in one transactional batch within the user's partition; the conversation is patched, not re-read
+        resp = []
+        conversation = None
+        for start in range(0, len(messages), MAX_BATCH_OPERATIONS - 1):
+            chunk = messages[start:start + MAX_BATCH_OPERATIONS - 1]
+            batch_operations = [('upsert', (message,)) for message in chunk]
+            batch_operations.append(('patch', (conversation_id, [{'op': 'set', 'path': '/updatedAt', 'value': chunk[-1]['createdAt']}])))
+            with self.request_metrics.measure("create_messages") as hook:
+                results = self.container_client.execute_item_batch(batch_operations=batch_operations, partition_key=user_id, response_hook=hook)
+            resp.extend(result.get('resourceBody', message) for result, message in zip(results, chunk))
+            conversation = results[-1].get('resourceBody')
+
+        ## write through: the patched conversation comes back with the batch, and a cached message list is extended
+        key = ('messages', user_id, conversation_id)
+        entry = self.cache.peek(key)
+        self.cache.invalidate(key)
+        if conversation:
+            self.cache_conversation(conversation)
+            if entry:
+                fields, cached_messages, _ = entry
+                cached_messages = cached_messages + [{field: message[field] for field in fields if field in message} for message in messages]
+                self.cache.set(key, (fields, cached_messages, conversation['_etag']))
+
+        logger.debug("create_messages response: %s", resp)
+        return resp
     
     def update_message_feedback(self, user_id, message_id, feedback):
-        message = self.container_client.read_item(item=message_id, partition_key=user_id)
+        with self.request_metrics.measure("update_message_feedback") as hook:
+            message = self.container_client.read_item(item=message_id, partition_key=user_id, response_hook=hook)
+            if message:
+                message['feedback'] = feedback
+                resp = self.container_client.upsert_item(message, response_hook=hook)
         if message:
-            message['feedback'] = feedback
-            resp = self.container_client.upsert_item(message)
-            logger.debug(f"update_message_feedback response {resp}")
+            self.cache.invalidate(('messages', user_id, message['conversationId']))
+            self.touch_conversation(user_id, message['conversationId'])
+            logger.debug("update_message_feedback response %s", resp)
             return resp
         else:
             logger.debug("No response returned in update_message_feedback")
             return False
 
-    def get_messages(self, user_id, conversation_id):
+    def get_messages(self, user_id, conversation_id, fields=None):
+        messages = [message for page in self.iter_messages(user_id, conversation_id, fields) for message in page]
+        ## if no messages are found, return false
+        if len(messages) == 0:
+            logger.debug("No messages were found.")
+            return []
+        else:
+            logger.debug("Messages found: %s", messages)
+            return messages
+
+    def iter_messages(self, user_id, conversation_id, fields=None, page_size=100):
+        ## yields the conversation's messages one result page at a time, oldest first,
+        ## so long conversations can be relayed without holding every message in memory
+        key = ('messages', user_id, conversation_id)
+        ## a cached list is only valid for the conversation version it was read with; every write bumps its ETag
+        conversation = self.cache.peek(('conversation', user_id, conversation_id))
+        etag = conversation[0]['_etag'] if conversation else None
+        entry = self.cache.peek(key, record_stats=True)
+        if entry and etag and entry[0] == fields and entry[2] == etag:
+            ## callers may modify the messages, e.g. to fill in defaults, so they get copies
+            yield [dict(message) for message in entry[1]]
+            return
+
         parameters = [
             {
                 'name': '@conversationId',
@@ -192,14 +384,43 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
-        messages = list(self.container_client.query_items(query=query, parameters=parameters,
-                                                                     enable_cross_partition_query =True))
-        ## if no messages are found, return false
-        if len(messages) == 0:
-            logger.debug("No messages were found.")
-            return []
-        else:
-            logger.debug(f"Messages found: {messages}")
-            return messages
+        query = f"SELECT {projection(fields)} FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt ASC"
+        messages = []
+        ## each page fetch is timed on its own, the time the caller takes to relay a page is not Cosmos latency
+        pages = self.request_metrics.measure_pages("get_messages", lambda hook: self.container_client.query_items(
+            query=query, parameters=parameters, partition_key=user_id, max_item_count=page_size, response_hook=hook).by_page())
+        for page in pages:
+            if messages is not None:
+                ## copied before the page is handed out, the caller may modify it
+                messages = messages + [dict(message) for message in page] if len(messages) + len(page) <= page_size else None
+            yield page
+
+        ## only conversations that fit in a single page are cached
+        if messages is not None and etag:
+            self.cache.set(key, (fields, messages, etag))
+
+
+def projection(fields=None):
+    if not fields:
+        return "*"
+    return ", ".join(f"c.{field}" for field in fields)
+
+
+def encode_cursor(conversations, previous=None):
+    """Opaque cursor for the page after `conversations`, as returned by `get_conversations`."""
+    updated_at = conversations[-1]['updatedAt']
+    ids = [c['id'] for c in conversations if c['updatedAt'] == updated_at]
+    if previous and previous['updatedAt'] == updated_at:
+        ids = previous['ids'] + ids
+    cursor = json.dumps({'updatedAt': updated_at, 'ids': ids}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
 
+def decode_cursor(token):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        if not isinstance(cursor.get('updatedAt'), str) or not isinstance(cursor.get('ids'), list):
+            raise ValueError(token)
+        return cursor
+    except Exception:
+        raise Exception(f"Invalid history cursor: {token}")
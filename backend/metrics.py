@@ -0,0 +1,207 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cache hit up to a long streamed answer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_RATE_BUCKETS = (5, 10, 20, 40, 80, 160, 320)
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Histogram():
+    """Prometheus-style histogram. Observing is one bisect and a few additions under a lock."""
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if not series:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(label_values, list(counts), total, count) for label_values, (counts, total, count) in self._series.items()]
+        for label_values, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Counter():
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        lines.extend(f"{self.name}{format_labels(self.labels, label_values)} {value}" for label_values, value in values)
+        return lines
+
+
+class MetricsRegistry():
+    """Metrics of this worker process, rendered in the Prometheus text format.
+
+    Collectors are callables returning (name, type, help, labels, [(label values, value), ...])
+    tuples, used to export stats that other components already keep, like cache hit counts.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        histogram = Histogram(name, help, labels, buckets)
+        self._metrics.append(histogram)
+        return histogram
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        counter = Counter(name, help, labels)
+        self._metrics.append(counter)
+        return counter
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, metric_type, help, labels, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.extend(f"{name}{format_labels(labels, label_values)} {value}" for label_values, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+CHAT_STAGE_SECONDS = REGISTRY.histogram("chat_stage_seconds", "Time spent in each stage of a chat turn.", ("stage",))
+CHAT_STREAM_TOKENS = REGISTRY.counter("chat_stream_tokens_total", "Streamed answer chunks relayed to clients, about one token each.")
+CHAT_TOKENS_PER_SECOND = REGISTRY.histogram("chat_stream_tokens_per_second", "Streaming rate of each answer after its first token.",
+                                            buckets=TOKEN_RATE_BUCKETS)
+HTTP_REQUEST_SECONDS = REGISTRY.histogram("http_request_seconds", "Time until the response headers were sent.", ("method", "route", "status"))
+COSMOS_REQUEST_SECONDS = REGISTRY.histogram("cosmos_request_seconds", "Duration of Cosmos DB operations.", ("client", "operation"))
+COSMOS_REQUEST_UNITS = REGISTRY.counter("cosmos_request_units_total", "Request units charged for Cosmos DB operations.", ("client", "operation"))
+
+
+class RequestTimer():
+    """Stage durations of the current request, for the Server-Timing response header."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = []
+
+    def add(self, name: str, seconds: float):
+        self.stages.append((name, seconds))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages)
+
+
+# Set per request (thread or asyncio task); asyncio.to_thread carries it into worker threads
+current_timer = contextvars.ContextVar("current_timer", default=None)
+
+
+@contextmanager
+def chat_stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def record_stage(name: str, seconds: float, timer: RequestTimer = None):
+    CHAT_STAGE_SECONDS.observe(seconds, name)
+    timer = timer or current_timer.get()
+    if timer:
+        timer.add(name, seconds)
+
+
+class StreamTiming():
+    """Time to first token, total stream time and token rate of one streamed answer."""
+
+    def __init__(self, timer: RequestTimer = None):
+        self.timer = timer or current_timer.get()
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.tokens = 0
+
+    def chunk(self):
+        self.tokens += 1
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+            ## measured from the start of the request when there is one, that is what the user waits for
+            started = self.timer.started if self.timer else self.started
+            record_stage("first_token", self.first_token - started, self.timer)
+
+    def finish(self):
+        finished = time.perf_counter()
+        record_stage("stream", finished - self.started, self.timer)
+        CHAT_STREAM_TOKENS.inc(self.tokens)
+        if self.first_token and self.tokens > 1 and finished > self.first_token:
+            CHAT_TOKENS_PER_SECOND.observe((self.tokens - 1) / (finished - self.first_token))
+
+
+def timed_stream(chunks, timer: RequestTimer = None):
+    timing = StreamTiming(timer)
+    try:
+        for chunk in chunks:
+            timing.chunk()
+            yield chunk
+    finally:
+        timing.finish()
+
+
+async def atimed_stream(chunks, timer: RequestTimer = None):
+    timing = StreamTiming(timer)
+    try:
+        async for chunk in chunks:
+            timing.chunk()
+            yield chunk
+    finally:
+        timing.finish()
@@ -0,0 +1,212 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Vite names its build output like index-87c2be60.js, so those files never change under the same name
+HASHED_NAME = re.compile(r"-[0-9A-Za-z_-]{8}\.[0-9A-Za-z]+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon")
+MIN_COMPRESS_SIZE = 1024
+# (Content-Encoding, file suffix), in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def is_compressible(path: str) -> bool:
+    mimetype = mimetypes.guess_type(path)[0] or ""
+    return mimetype.startswith(COMPRESSIBLE_TYPES) or path.endswith(".map")
+
+
+def compress(content: bytes, encoding: str) -> Optional[bytes]:
+    if encoding == "gzip":
+        return gzip.compress(content, compresslevel=9, mtime=0)
+    if encoding == "br" and brotli:
+        return brotli.compress(content, quality=11)
+    return None
+
+
+def precompress(folder: str) -> int:
+    """Writes a .gz (and, with the brotli package installed, a .br) next to every compressible file.
+
+    Run on the frontend build output, e.g. `python -m backend.static_files static`.
+    """
+    written = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith(tuple(suffix for _, suffix in ENCODINGS)) or not is_compressible(path):
+                continue
+            with open(path, "rb") as f:
+                content = f.read()
+            if len(content) < MIN_COMPRESS_SIZE:
+                continue
+            for encoding, suffix in ENCODINGS:
+                compressed = compress(content, encoding)
+                ## only worth sending if it saves something
+                if compressed and len(compressed) < len(content) * 0.9:
+                    with open(path + suffix, "wb") as f:
+                        f.write(compressed)
+                    written += 1
+    return written
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    encodings = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q=") and q[2:].strip() in ("0", "0.0", "0.00", "0.000"):
+            continue
+        if name:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+@dataclass
+class StaticVariant():
+    encoding: Optional[str]
+    path: str
+    size: int
+    etag: str
+    content: Optional[bytes] = None
+
+
+@dataclass
+class StaticAsset():
+    mimetype: str
+    cache_control: str
+    mtime: float
+    variants: dict = field(default_factory=dict)
+
+    @property
+    def etags(self) -> set:
+        return {variant.etag for variant in self.variants.values()}
+
+
+class StaticFiles():
+    """Serves the frontend build with validators, long-lived caching and precompressed variants.
+
+    Hashed build assets are sent with an immutable Cache-Control; everything else must be
+    revalidated, which costs a 304 when the ETag still matches. A .br/.gz file next to an asset
+    is sent instead when the client accepts that encoding. With `in_memory` every asset (and a
+    compressed copy, when none was prebuilt) is loaded once, so serving never touches the disk.
+    """
+
+    def __init__(self, folder: str, in_memory: bool = False):
+        self.folder = os.path.abspath(folder)
+        self.in_memory = in_memory
+        self._assets = {}
+        self._lock = threading.Lock()
+        if in_memory:
+            for root, _, files in os.walk(self.folder):
+                for name in files:
+                    if not name.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                        full_path = os.path.join(root, name)
+                        path = os.path.relpath(full_path, self.folder).replace(os.sep, "/")
+                        self._assets[path] = self.load(path, full_path, os.stat(full_path).st_mtime)
+
+    def get(self, path: str) -> Optional[StaticAsset]:
+        if self.in_memory:
+            return self._assets.get(path)
+
+        full_path = self.resolve_path(path)
+        if not full_path:
+            return None
+
+        asset = self._assets.get(path)
+        try:
+            mtime = os.stat(full_path).st_mtime
+        except OSError:
+            return None
+        ## on disk, pick up a rebuilt frontend without a restart
+        if asset and asset.mtime == mtime:
+            return asset
+
+        asset = self.load(path, full_path, mtime)
+        with self._lock:
+            self._assets[path] = asset
+        return asset
+
+    def resolve_path(self, path: str) -> Optional[str]:
+        full_path = os.path.abspath(os.path.join(self.folder, path))
+        if not full_path.startswith(self.folder + os.sep) or not os.path.isfile(full_path):
+            return None
+        return full_path
+
+    def load(self, path: str, full_path: str, mtime: float) -> StaticAsset:
+        with open(full_path, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha1(content).hexdigest()[:16]
+        mimetype = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        if mimetype.startswith("text/") or mimetype in ("application/javascript", "application/json"):
+            mimetype += "; charset=utf-8"
+        asset = StaticAsset(
+            mimetype=mimetype,
+            cache_control=IMMUTABLE if HASHED_NAME.search(path) else REVALIDATE,
+            mtime=mtime
+        )
+        asset.variants[None] = StaticVariant(None, full_path, len(content), f'"{digest}"', content if self.in_memory else None)
+
+        for encoding, suffix in ENCODINGS:
+            variant_path = full_path + suffix
+            compressed = None
+            if os.path.isfile(variant_path):
+                if self.in_memory:
+                    with open(variant_path, "rb") as f:
+                        compressed = f.read()
+                size = os.path.getsize(variant_path)
+            elif self.in_memory and len(content) >= MIN_COMPRESS_SIZE and is_compressible(full_path):
+                compressed = compress(content, encoding)
+                if not compressed or len(compressed) >= len(content) * 0.9:
+                    continue
+                size = len(compressed)
+            else:
+                continue
+            asset.variants[encoding] = StaticVariant(encoding, variant_path, size, f'"{digest}-{encoding}"', compressed)
+        return asset
+
+    def select(self, path: str, accept_encoding: str = "", if_none_match: str = ""):
+        """Returns (status, headers, variant) for a GET of `path`, or None when there is no such file.
+
+        The variant is None for a 304, otherwise its `content` (in memory) or `path` is the body.
+        """
+        asset = self.get(path)
+        if not asset:
+            return None
+
+        accepted = accepted_encodings(accept_encoding)
+        variant = next((asset.variants[encoding] for encoding, _ in ENCODINGS
+                        if encoding in asset.variants and (encoding in accepted or "*" in accepted)),
+                       asset.variants[None])
+
+        headers = [("Cache-Control", asset.cache_control), ("ETag", variant.etag)]
+        if len(asset.variants) > 1:
+            headers.append(("Vary", "Accept-Encoding"))
+
+        if if_none_match:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or tags & asset.etags:
+                return 304, headers, None
+
+        headers.append(("Content-Type", asset.mimetype))
+        headers.append(("Content-Length", str(variant.size)))
+        if variant.encoding:
+            headers.append(("Content-Encoding", variant.encoding))
+        return 200, headers, variant
+
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else "static"
+    print(f"Wrote {precompress(folder)} compressed file(s) in {folder}{'' if brotli else ' (install brotli for .br files)'}")
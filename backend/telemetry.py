@@ -0,0 +1,51 @@
+import logging
+import os
+import threading
+
+from opencensus.ext.azure.log_exporter import AzureLogHandler
+
+# Debug settings
+DEBUG = os.environ.get("DEBUG", "false")
+DEBUG_LOGGING = DEBUG.lower() == "true"
+
+# App Insights export settings
+AZURE_APP_INSIGHTS_CONNECTION_STRING = os.environ.get("AZURE_APP_INSIGHTS_CONNECTION_STRING", "")
+AZURE_APP_INSIGHTS_EXPORT_INTERVAL = os.environ.get("AZURE_APP_INSIGHTS_EXPORT_INTERVAL", 15)
+AZURE_APP_INSIGHTS_MAX_BATCH_SIZE = os.environ.get("AZURE_APP_INSIGHTS_MAX_BATCH_SIZE", 100)
+AZURE_APP_INSIGHTS_QUEUE_CAPACITY = os.environ.get("AZURE_APP_INSIGHTS_QUEUE_CAPACITY", 1000)
+
+_handler = None
+_lock = threading.Lock()
+
+
+def get_handler() -> AzureLogHandler:
+    """The process-wide App Insights handler.
+
+    Logging a record only puts it on the handler's bounded queue; one exporter thread
+    formats and ships records in batches, so request threads never wait on the network.
+    When the queue is full, records are dropped rather than blocking the caller.
+    """
+    global _handler
+    with _lock:
+        if not _handler:
+            if DEBUG_LOGGING:
+                logging.basicConfig(level=logging.DEBUG)
+            try:
+                _handler = AzureLogHandler(
+                    connection_string=AZURE_APP_INSIGHTS_CONNECTION_STRING,
+                    export_interval=float(AZURE_APP_INSIGHTS_EXPORT_INTERVAL),
+                    max_batch_size=int(AZURE_APP_INSIGHTS_MAX_BATCH_SIZE),
+                    queue_capacity=int(AZURE_APP_INSIGHTS_QUEUE_CAPACITY)
+                )
+            except Exception as e:
+                raise Exception(f"Exception initializing Azure App Insights logger: {e}")
+        return _handler
+
+
+def get_logger(name: str) -> logging.Logger:
+    logger = logging.getLogger(name)
+    handler = get_handler()
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if DEBUG_LOGGING else logging.INFO)
+    return logger
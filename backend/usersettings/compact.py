@@ -0,0 +1,53 @@
+import argparse
+import os
+
+from azure.identity import DefaultAzureCredential
+
+from backend.usersettings.cosmosdbserviceUserSettings import CosmosUserSettingsClient
+
+# Folds the per-key user setting documents written by earlier versions into one
+# settings document per user, then deletes them. Safe to re-run, and safe to run
+# while the app is serving. Run from the repository root:
+#
+#   python -m backend.usersettings.compact [--dry-run]
+#
+# It reads the same AZURE_COSMOSDB_* settings as the app.
+
+
+def compact_all(client: CosmosUserSettingsClient, dry_run: bool = False):
+    user_ids = client.get_legacy_user_ids()
+    print(f"{len(user_ids)} user(s) with legacy settings documents")
+    removed = 0
+    for user_id in user_ids:
+        if dry_run:
+            print(f"Would compact settings for {user_id}: {client.get_legacy_user_settings(user_id)}")
+            continue
+        count = client.compact_user_settings(user_id)
+        removed += count
+        print(f"Compacted {count} document(s) for {user_id}")
+    if not dry_run:
+        print(f"Removed {removed} legacy document(s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compact duplicate user settings documents into one document per user",
+    )
+    parser.add_argument("--dry-run", action="store_true", help="Only print what would be compacted.")
+    args = parser.parse_args()
+
+    account = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
+    database = os.environ.get("AZURE_COSMOSDB_DATABASE")
+    container = os.environ.get("AZURE_COSMOSDB_USERSETTINGS_CONTAINER")
+    if not account or not database or not container:
+        raise Exception("AZURE_COSMOSDB_ACCOUNT, AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_USERSETTINGS_CONTAINER are required")
+
+    suffix = os.environ.get("AZURE_COSMOSDB_SUFFIX", ".us")
+    account_key = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
+    client = CosmosUserSettingsClient(
+        cosmosdb_endpoint=f'https://{account}.documents.azure{suffix}:443/',
+        credential=account_key or DefaultAzureCredential(),
+        database_name=database,
+        container_name=container
+    )
+    compact_all(client, args.dry_run)
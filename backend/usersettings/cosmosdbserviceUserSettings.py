@@ -1,33 +1,24 @@
-import logging
 import os
-import uuid
 from datetime import datetime
-from azure.cosmos import CosmosClient
-from opencensus.ext.azure.log_exporter import AzureLogHandler
-
-# Debug settings
-DEBUG = os.environ.get("DEBUG", "false")
-DEBUG_LOGGING = DEBUG.lower() == "true"
-if DEBUG_LOGGING:
-    logging.basicConfig(level=logging.DEBUG)
-
-# Set up Azure App Insights logger
-try:
-    app_insights_conn_str = os.environ.get("AZURE_APP_INSIGHTS_CONNECTION_STRING", "")
-    logger = logging.getLogger(__name__)
-    handler = AzureLogHandler(connection_string=app_insights_conn_str)
-    logger.addHandler(handler)
-    if DEBUG_LOGGING:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
-    logger.info("Loaded Azure App Insights for CosmosDB service")
-except Exception as e:
-    raise Exception(f"Exception initializing Azure App Insights logger: {e}")
+from azure.cosmos import CosmosClient, exceptions
+
+from backend.cache import TTLCache
+from backend.cosmos_metrics import CosmosRequestMetrics
+from backend.telemetry import get_logger
+
+# Shared App Insights log pipeline
+logger = get_logger(__name__)
+
+## Settings are stored as one document per user, with the user id as the document id:
+## {'id': userId, 'type': 'usersettings', 'userId': userId, 'settings': {key: value}, ...}
+## Older deployments wrote one 'usersetting' document per key on every save; those are
+## still read when a user has no settings document yet, and compact_user_settings folds them into one.
+SETTINGS_TYPE = 'usersettings'
+LEGACY_SETTING_TYPE = 'usersetting'
 
 class CosmosUserSettingsClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, cache: TTLCache = None):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
@@ -35,6 +26,8 @@ class CosmosUserSettingsClient():
         self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
         self.database_client = self.cosmosdb_client.get_database_client(database_name)
         self.container_client = self.database_client.get_container_client(container_name)
+        self.request_metrics = CosmosRequestMetrics("usersettings")
+        self.cache = cache or TTLCache(max_entries=0, ttl=0, name="usersettings")
 
     def ensure(self):
         try:
@@ -49,61 +42,119 @@ class CosmosUserSettingsClient():
         except:
             return False
 
-    def create_user_setting(self, user_id, key, value):
-        userSetting = {
-            'id': str(uuid.uuid4()),  
-            'type': 'usersetting',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
-            'userId': user_id,
-            'key': key,
-            'value': value
-        }
-
-        resp = self.container_client.upsert_item(userSetting)  
-        if resp:
-            logger.debug(f"Response object in create_user_setting: {resp}")
-            return resp
-        else:
-            logger.debug("No response returned in create_user_setting")
-            return False
-    
-    def upsert_user_setting(self, userSetting):
-        resp = self.container_client.upsert_item(userSetting)
+    def get_user_settings(self, user_id):
+        ## {key: value} for the user, or None if they never saved any
+        try:
+            return self.cache.get(user_id, lambda: self.read_user_settings(user_id))
+        except Exception:
+            logger.exception("Exception reading user settings")
+            return None
+
+    def read_user_settings(self, user_id):
+        try:
+            with self.request_metrics.measure("get_user_settings") as hook:
+                userSettings = self.container_client.read_item(item=user_id, partition_key=user_id, response_hook=hook)
+            settings = userSettings['settings']
+        except exceptions.CosmosResourceNotFoundError:
+            settings = self.get_legacy_user_settings(user_id)
+
+        ## if no settings are found, return None
+        if not settings:
+            logger.debug("No user frontend settings found.")
+            return None
+        logger.debug("Frontend user settings found: %s", settings)
+        return settings
+
+    def update_user_settings(self, user_id, settings: dict):
+        ## a single patch of every changed key; the document is created on a user's first save
+        now = datetime.utcnow().isoformat()
+        patch_operations = [{'op': 'set', 'path': f'/settings/{key}', 'value': value} for key, value in settings.items()]
+        patch_operations.append({'op': 'set', 'path': '/updatedAt', 'value': now})
+        with self.request_metrics.measure("update_user_settings") as hook:
+            try:
+                resp = self.container_client.patch_item(item=user_id, partition_key=user_id,
+                                                        patch_operations=patch_operations, response_hook=hook)
+            except exceptions.CosmosResourceNotFoundError:
+                userSettings = {
+                    'id': user_id,
+                    'type': SETTINGS_TYPE,
+                    'createdAt': now,
+                    'updatedAt': now,
+                    'userId': user_id,
+                    'settings': {**(self.get_legacy_user_settings(user_id) or {}), **settings}
+                }
+                try:
+                    resp = self.container_client.create_item(userSettings, response_hook=hook)
+                except exceptions.CosmosResourceExistsError:
+                    ## another request created it in the meantime
+                    resp = self.container_client.patch_item(item=user_id, partition_key=user_id,
+                                                            patch_operations=patch_operations, response_hook=hook)
         if resp:
-            logger.debug(f"Response object in upsert_user_setting: {resp}")
+            logger.debug("Response object in update_user_settings: %s", resp)
+            self.cache.set(user_id, resp['settings'])
             return resp
         else:
-            logger.debug("No response returned in upsert_user_setting")
+            logger.debug("No response returned in update_user_settings")
             return False
 
-    def get_user_settings(self, user_id):
+    def get_legacy_user_settings(self, user_id):
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        ## later saves win over earlier ones
+        query = f"SELECT c['key'], c['value'] FROM c where c.userId = @userId and c.type = '{LEGACY_SETTING_TYPE}' order by c.updatedAt ASC"
+        with self.request_metrics.measure("get_legacy_user_settings") as hook:
+            rows = list(self.container_client.query_items(query=query, parameters=parameters,
+                                                          partition_key=user_id, response_hook=hook))
+        return {row['key']: row.get('value') for row in rows} or None
+
+    def compact_user_settings(self, user_id):
+        ## folds a user's legacy per-key documents into their settings document and deletes them;
+        ## returns the number of legacy documents removed
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = f"SELECT VALUE c.id FROM c where c.userId = @userId and c.type = '{LEGACY_SETTING_TYPE}'"
+        with self.request_metrics.measure("compact_user_settings") as hook:
+            legacy_ids = list(self.container_client.query_items(query=query, parameters=parameters,
+                                                                partition_key=user_id, response_hook=hook))
+        if not legacy_ids:
+            return 0
+
+        settings = self.get_legacy_user_settings(user_id) or {}
         try:
-            parameters = [
-                {
-                    'name': '@userId',
-                    'value': user_id
-                }
-            ]
-            query = f"SELECT * FROM c where c.userId = @userId"
-            userSettings = list(self.container_client.query_items(query=query, parameters=parameters,
-                                                                enable_cross_partition_query =True))
-            ## if no settings are found, return None
-            if len(userSettings) == 0:
-                logger.debug("No user frontend settings found.")
-                return None
-            else:
-                logger.debug(f"Frontend user settings found: {userSettings}")
-
-            return userSettings
-        except:
-            return None
+            with self.request_metrics.measure("compact_user_settings") as hook:
+                current = self.container_client.read_item(item=user_id, partition_key=user_id, response_hook=hook)
+            ## settings saved since the upgrade are newer than any legacy row
+            settings.update(current['settings'])
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+        self.update_user_settings(user_id, settings)
+
+        with self.request_metrics.measure("compact_user_settings") as hook:
+            for legacy_id in legacy_ids:
+                try:
+                    self.container_client.delete_item(item=legacy_id, partition_key=user_id, response_hook=hook)
+                except exceptions.CosmosResourceNotFoundError:
+                    pass
+        return len(legacy_ids)
+
+    def get_legacy_user_ids(self):
+        query = f"SELECT DISTINCT VALUE c.userId FROM c where c.type = '{LEGACY_SETTING_TYPE}'"
+        with self.request_metrics.measure("get_legacy_user_ids") as hook:
+            return list(self.container_client.query_items(query=query, enable_cross_partition_query=True, response_hook=hook))
  
     def delete_user_setting(self, user_id, usersetting_id):
         userSetting = self.container_client.read_item(item=usersetting_id, partition_key=user_id)        
         if userSetting:
             resp = self.container_client.delete_item(item=usersetting_id, partition_key=user_id)
-            logger.debug(f"Response object from deleting user setting: {resp}")
+            logger.debug("Response object from deleting user setting: %s", resp)
             return resp
         else:
             logger.debug("No response object returned on delete user setting attempt.")
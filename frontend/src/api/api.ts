@@ -36,11 +36,13 @@ export const fetchChatHistoryInit = (): Conversation[] | null => {
     return chatHistorySampleData;
 }
 
-export const historyList = async (offset=0, model: string): Promise<Conversation[] | null> => {
-    const response = await fetch(`/history/list?offset=${offset}`, {
+export const historyList = async (offset=0, model: string, cursor?: string | null, onCursor?: (cursor: string | null) => void): Promise<Conversation[] | null> => {
+    const query = cursor ? `cursor=${encodeURIComponent(cursor)}` : `offset=${offset}`;
+    const response = await fetch(`/history/list?${query}`, {
         method: "GET",
     }).then(async (res) => {
         const payload = await res.json();
+        onCursor?.(res.headers.get("X-History-Cursor"));
         if (!Array.isArray(payload)) {
             console.error("There was an issue fetching your data.");
             return null;
@@ -246,7 +246,6 @@ export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps>
     const appStateContext = useContext(AppStateContext);
     const observerTarget = useRef(null);
     const [ , setSelectedItem] = React.useState<Conversation | null>(null);
-    const [offset, setOffset] = useState<number>(25);
     const [observerCounter, setObserverCounter] = useState(0);
     const [showSpinner, setShowSpinner] = useState(false);
     const firstRender = useRef(true);
@@ -269,14 +268,20 @@ export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps>
             return;
         }
         handleFetchHistory();
-        setOffset((offset) => offset += 25);
     }, [observerCounter]);
 
     const handleFetchHistory = async () => {
         const currentChatHistory = appStateContext?.state.chatHistory;
+        const cursor = appStateContext?.state.chatHistoryCursor;
+        // no cursor means the last page has already been loaded
+        if (!cursor) {
+            return;
+        }
         setShowSpinner(true);
 
-        await historyList(offset, appStateContext?.state.frontendSettings?.azure_openai_model!).then((response) => {
+        await historyList(0, appStateContext?.state.frontendSettings?.azure_openai_model!, cursor, (nextCursor) => {
+            appStateContext?.dispatch({ type: 'SET_CHAT_HISTORY_CURSOR', payload: nextCursor });
+        }).then((response) => {
             const concatenatedChatHistory = currentChatHistory && response && currentChatHistory.concat(...response)
             if (response) {
                 appStateContext?.dispatch({ type: 'FETCH_CHAT_HISTORY', payload: concatenatedChatHistory || response });
@@ -7,6 +7,7 @@ export interface AppState {
     chatHistoryLoadingState: ChatHistoryLoadingState;
     isCosmosDBAvailable: CosmosDBHealth;
     chatHistory: Conversation[] | null;
+    chatHistoryCursor: string | null;
     filteredChatHistory: Conversation[] | null;
     currentChat: Conversation | null;
     frontendSettings: FrontendSettings | null;
@@ -25,6 +26,7 @@ export type Action =
     | { type: 'DELETE_CHAT_HISTORY'}  // API Call
     | { type: 'DELETE_CURRENT_CHAT_MESSAGES', payload: string }  // API Call
     | { type: 'FETCH_CHAT_HISTORY', payload: Conversation[] | null }  // API Call
+    | { type: 'SET_CHAT_HISTORY_CURSOR', payload: string | null }
     | { type: 'FETCH_FRONTEND_SETTINGS', payload: FrontendSettings | null }  // API Call
     | { type: 'SET_FRONTEND_SETTINGS', payload: FrontendSettings | null } // API Call
     | { type: 'SET_FEEDBACK_STATE'; payload: { answerId: string; feedback: Feedback.Positive | Feedback.Negative | Feedback.Neutral } }
@@ -34,6 +36,7 @@ const initialState: AppState = {
     isChatHistoryOpen: false,
     chatHistoryLoadingState: ChatHistoryLoadingState.Loading,
     chatHistory: null,
+    chatHistoryCursor: null,
     filteredChatHistory: null,
     currentChat: null,
     isCosmosDBAvailable: {
@@ -59,7 +62,9 @@ export const AppStateProvider: React.FC<AppStateProviderProps> = ({ children })
     useEffect(() => {
         // Check for cosmosdb config and fetch initial data here
         const fetchChatHistory = async (offset=0): Promise<Conversation[] | null> => {
-            const result = await historyList(offset, state.frontendSettings?.azure_openai_model!).then((response) => {
+            const result = await historyList(offset, state.frontendSettings?.azure_openai_model!, null, (cursor) => {
+                dispatch({ type: 'SET_CHAT_HISTORY_CURSOR', payload: cursor });
+            }).then((response) => {
                 if(response){
                     dispatch({ type: 'FETCH_CHAT_HISTORY', payload: response});
                 }else{
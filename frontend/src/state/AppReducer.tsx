@@ -47,7 +47,7 @@ export const appStateReducer = (state: AppState, action: Action): AppState => {
             return { ...state, chatHistory: filteredChat };
         case 'DELETE_CHAT_HISTORY':
             //TODO: make api call to delete all conversations from DB
-            return { ...state, chatHistory: [], filteredChatHistory: [], currentChat: null };
+            return { ...state, chatHistory: [], filteredChatHistory: [], currentChat: null, chatHistoryCursor: null };
         case 'DELETE_CURRENT_CHAT_MESSAGES':
             //TODO: make api call to delete current conversation messages from DB
             if(!state.currentChat || !state.chatHistory){
@@ -63,6 +63,8 @@ export const appStateReducer = (state: AppState, action: Action): AppState => {
             };
         case 'FETCH_CHAT_HISTORY':
             return { ...state, chatHistory: action.payload };
+        case 'SET_CHAT_HISTORY_CURSOR':
+            return { ...state, chatHistoryCursor: action.payload };
         case 'SET_COSMOSDB_STATUS':
             return { ...state, isCosmosDBAvailable: action.payload };
         case 'FETCH_FRONTEND_SETTINGS':
@@ -0,0 +1,264 @@
+import copy
+import re
+import threading
+import time
+import uuid
+
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+
+# In-memory stand-in for the parts of azure-cosmos the history and user settings clients use:
+# point reads (with ETag revalidation), upserts, patches, deletes, transactional batches and
+# the handful of query shapes they issue. Every call reports a nominal RU charge through
+# response_hook and can be slowed down with `latency`, so request metrics keep working.
+
+SELECT = re.compile(r"^\s*select\s+(distinct\s+)?(value\s+)?(.+?)\s+from\s+c\b(.*)$", re.IGNORECASE | re.DOTALL)
+ORDER_BY = re.compile(r"\s+order\s+by\s+(c\.\w+(?:\s+(?:asc|desc))?(?:\s*,\s*c\.\w+(?:\s+(?:asc|desc))?)*)", re.IGNORECASE)
+ORDER_ITEM = re.compile(r"c\.(\w+)(?:\s+(asc|desc))?", re.IGNORECASE)
+OFFSET_LIMIT = re.compile(r"\s+offset\s+(\d+)\s+limit\s+(\d+)", re.IGNORECASE)
+CONDITION = re.compile(r"^c\.(\w+)\s*(=|<=|>=|<|>|!=)\s*(@\w+|'[^']*'|\d+)$", re.IGNORECASE)
+NOT_IN = re.compile(r"^not\s+array_contains\(\s*(@\w+)\s*,\s*c\.(\w+)\s*\)$", re.IGNORECASE)
+FIELD = re.compile(r"^c(?:\.(\w+)|\['([^']+)'\])$")
+
+OPERATORS = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    ">": lambda a, b: a is not None and a > b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">=": lambda a, b: a is not None and a >= b,
+}
+
+# Nominal charges, in the ballpark of a 1 KB document
+READ_CHARGE = 1.0
+WRITE_CHARGE = 6.0
+QUERY_PAGE_CHARGE = 3.0
+
+
+def parse_query(query: str, parameters: list):
+    """Returns a function that runs `query` over a list of documents."""
+    match = SELECT.match(query)
+    if not match:
+        raise ValueError(f"Unsupported query: {query}")
+    distinct, value, selection, rest = match.groups()
+    values = {p["name"]: p["value"] for p in parameters or []}
+
+    limit = None
+    offset_limit = OFFSET_LIMIT.search(rest)
+    if offset_limit:
+        offset, limit = int(offset_limit.group(1)), int(offset_limit.group(2))
+        rest = rest[:offset_limit.start()]
+    order_by = ORDER_BY.search(rest)
+    if order_by:
+        rest = rest[:order_by.start()]
+
+    filters = []
+    where = re.sub(r"^\s*where\s+", "", rest.strip(), flags=re.IGNORECASE)
+    for condition in re.split(r"\s+and\s+", where, flags=re.IGNORECASE) if where else []:
+        condition = condition.strip()
+        if m := CONDITION.match(condition):
+            field, operator, operand = m.groups()
+            if operand.startswith("@"):
+                operand = values[operand]
+            elif operand.startswith("'"):
+                operand = operand[1:-1]
+            else:
+                operand = int(operand)
+            filters.append(lambda doc, f=field, o=OPERATORS[operator], v=operand: o(doc.get(f), v))
+        elif m := NOT_IN.match(condition):
+            excluded = set(values[m.group(1)])
+            filters.append(lambda doc, f=m.group(2), e=excluded: doc.get(f) not in e)
+        else:
+            raise ValueError(f"Unsupported condition '{condition}' in query: {query}")
+
+    fields = None
+    if selection.strip() != "*":
+        fields = []
+        for part in selection.split(","):
+            field = FIELD.match(part.strip())
+            if not field:
+                raise ValueError(f"Unsupported projection '{part}' in query: {query}")
+            fields.append(field.group(1) or field.group(2))
+
+    def run(documents):
+        results = [doc for doc in documents if all(f(doc) for f in filters)]
+        if order_by:
+            ## stable sorts from the last key to the first give the combined order
+            for field, direction in reversed(ORDER_ITEM.findall(order_by.group(1))):
+                results.sort(key=lambda doc: doc.get(field) or "", reverse=(direction or "asc").lower() == "desc")
+        if limit is not None:
+            results = results[offset:offset + limit]
+        if value:
+            results = [doc.get(fields[0]) for doc in results]
+        elif fields:
+            results = [{field: doc[field] for field in fields if field in doc} for doc in results]
+        else:
+            results = [copy.deepcopy(doc) for doc in results]
+        if distinct:
+            unique = []
+            for result in results:
+                if result not in unique:
+                    unique.append(result)
+            results = unique
+        return results
+
+    return run
+
+
+class FakeItemPaged():
+
+    def __init__(self, results: list, page_size: int, hook):
+        self.results = results
+        self.page_size = page_size or 100
+        self.hook = hook
+
+    def by_page(self):
+        for start in range(0, max(len(self.results), 1), self.page_size):
+            page = self.results[start:start + self.page_size]
+            if self.hook:
+                self.hook({"x-ms-request-charge": str(QUERY_PAGE_CHARGE)}, page)
+            yield iter(page)
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+
+class FakeContainer():
+
+    def __init__(self, name: str, latency: float = 0.0):
+        self.id = name
+        self.latency = latency
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def respond(self, hook, charge, result):
+        if self.latency:
+            time.sleep(self.latency)
+        if hook:
+            hook({"x-ms-request-charge": str(charge)}, result)
+        return result
+
+    def stamp(self, item: dict) -> dict:
+        item["_etag"] = f'"{uuid.uuid4()}"'
+        item["_ts"] = int(time.time())
+        return item
+
+    def read(self, response_hook=None, **kwargs):
+        return self.respond(response_hook, READ_CHARGE, {"id": self.id})
+
+    def read_item(self, item, partition_key, etag=None, match_condition=None, response_hook=None, **kwargs):
+        with self._lock:
+            stored = self.get_from(self.items, item, partition_key)
+            ## an unchanged document comes back as a bodiless 304
+            result = None if etag and match_condition == MatchConditions.IfModified and stored["_etag"] == etag else copy.deepcopy(stored)
+        return self.respond(response_hook, READ_CHARGE, result)
+
+    def create_item(self, body, response_hook=None, **kwargs):
+        with self._lock:
+            result = self.apply(self.items, "create", (body,), body.get("userId"))
+        return self.respond(response_hook, WRITE_CHARGE, result)
+
+    def upsert_item(self, body, response_hook=None, **kwargs):
+        with self._lock:
+            result = self.apply(self.items, "upsert", (body,), body.get("userId"))
+        return self.respond(response_hook, WRITE_CHARGE, result)
+
+    def patch_item(self, item, partition_key, patch_operations, response_hook=None, **kwargs):
+        with self._lock:
+            result = self.apply(self.items, "patch", (item, patch_operations), partition_key)
+        return self.respond(response_hook, WRITE_CHARGE, result)
+
+    def delete_item(self, item, partition_key, response_hook=None, **kwargs):
+        with self._lock:
+            self.apply(self.items, "delete", (item,), partition_key)
+        return self.respond(response_hook, WRITE_CHARGE, None)
+
+    def execute_item_batch(self, batch_operations, partition_key, response_hook=None, **kwargs):
+        with self._lock:
+            ## all or nothing: apply to a copy and swap it in only when every operation succeeded
+            items = dict(self.items)
+            results = []
+            for index, (operation, args) in enumerate(batch_operations):
+                try:
+                    body = self.apply(items, operation, args, partition_key)
+                except exceptions.CosmosHttpResponseError as e:
+                    raise exceptions.CosmosBatchOperationError(error_index=index, headers={}, status_code=e.status_code,
+                                                               message=str(e), operation_responses=results)
+                results.append({"statusCode": 200, "requestCharge": WRITE_CHARGE, "resourceBody": body})
+            self.items = items
+        return self.respond(response_hook, WRITE_CHARGE * len(batch_operations), results)
+
+    def apply(self, items: dict, operation: str, args: tuple, partition_key):
+        if operation in ("create", "upsert"):
+            body = self.stamp(copy.deepcopy(args[0]))
+            key = (partition_key, body["id"])
+            if operation == "create" and key in items:
+                raise exceptions.CosmosResourceExistsError(status_code=409, message=f"Entity with the specified id already exists: {body['id']}")
+            items[key] = body
+            return copy.deepcopy(body)
+        if operation == "read":
+            return copy.deepcopy(self.get_from(items, args[0], partition_key))
+        if operation == "delete":
+            self.get_from(items, args[0], partition_key)
+            del items[(partition_key, args[0])]
+            return None
+        if operation == "patch":
+            body = copy.deepcopy(self.get_from(items, args[0], partition_key))
+            for patch in args[1]:
+                *parents, name = patch["path"].strip("/").split("/")
+                target = body
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                if patch["op"] == "remove":
+                    target.pop(name, None)
+                elif patch["op"] == "incr":
+                    target[name] = target.get(name, 0) + patch["value"]
+                else:
+                    target[name] = copy.deepcopy(patch["value"])
+            items[(partition_key, args[0])] = self.stamp(body)
+            return copy.deepcopy(body)
+        raise ValueError(f"Unsupported batch operation: {operation}")
+
+    def get_from(self, items: dict, item_id, partition_key) -> dict:
+        item = items.get((partition_key, item_id))
+        if item is None:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message=f"Entity with the specified id does not exist: {item_id}")
+        return item
+
+    def query_items(self, query, parameters=None, partition_key=None, enable_cross_partition_query=None, max_item_count=None,
+                    response_hook=None, **kwargs):
+        run = parse_query(query, parameters)
+        with self._lock:
+            documents = [doc for (pk, _), doc in self.items.items() if partition_key is None or pk == partition_key]
+            results = run(documents)
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeItemPaged(results, max_item_count, response_hook)
+
+
+class FakeDatabase():
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.containers = {}
+
+    def get_container_client(self, name: str) -> FakeContainer:
+        if name not in self.containers:
+            self.containers[name] = FakeContainer(name, self.latency)
+        return self.containers[name]
+
+
+class FakeCosmosClient():
+    """Drop-in for azure.cosmos.CosmosClient; databases (and their data) are shared by all instances."""
+
+    databases = {}
+    latency = 0.0
+
+    def __init__(self, url=None, credential=None, **kwargs):
+        pass
+
+    def get_database_client(self, name: str) -> FakeDatabase:
+        if name not in self.databases:
+            self.databases[name] = FakeDatabase(self.latency)
+        return self.databases[name]
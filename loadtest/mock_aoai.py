@@ -0,0 +1,161 @@
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Stand-in for an Azure OpenAI resource. Speaks chat/completions and the on-your-data
+# extensions/chat/completions protocol, streamed or not, with a configurable delay before
+# the first token and a fixed token rate, so app.py can be benchmarked without Azure.
+
+WORDS = ("Contoso ", "benefits ", "include ", "health ", "dental ", "and ", "vision ", "coverage ", "for ", "employees ")
+CITATIONS = {
+    "citations": [{"content": "Employees are eligible for health, dental and vision coverage.", "id": None, "title": "Benefit_Options.pdf",
+                   "filepath": "Benefit_Options.pdf", "url": "https://example.com/Benefit_Options.pdf", "metadata": {"chunking": "orignal document size=1011. Scores=3.36"},
+                   "chunk_id": "0"}],
+    "intent": "[\"employee benefits\"]"
+}
+
+
+class MockSettings():
+
+    def __init__(self, latency: float = 0.2, token_rate: float = 50.0, tokens: int = 100, throttle: float = 0.0, retry_after: float = 1.0):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+        ## share of requests answered with a 429, like a deployment over its quota
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def answer(self) -> list:
+        return [WORDS[i % len(WORDS)] for i in range(self.tokens)]
+
+
+def sse(obj) -> bytes:
+    ## compact separators, like the service sends
+    return b"data: " + json.dumps(obj, separators=(",", ":")).encode("utf-8") + b"\n\n"
+
+
+class MockAzureOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings: MockSettings = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = urlparse(self.path).path
+        self.settings.count()
+        if self.settings.throttle and random.random() < self.settings.throttle:
+            return self.send_json({"error": {"code": "429", "message": "Requests to the ChatCompletions_Create Operation have exceeded the rate limit."}},
+                                  429, {"retry-after-ms": str(int(self.settings.retry_after * 1000)), "Retry-After": str(max(1, round(self.settings.retry_after)))})
+        deployment = path.split("/deployments/", 1)[-1].split("/", 1)[0] if "/deployments/" in path else "mock"
+
+        time.sleep(self.settings.latency)
+        if path.endswith("/extensions/chat/completions"):
+            frames = self.extension_frames(deployment)
+            completion = self.extension_completion(deployment)
+        elif path.endswith("/chat/completions"):
+            frames = self.chat_frames(deployment)
+            completion = self.chat_completion(deployment)
+        else:
+            return self.send_json({"error": {"code": "404", "message": f"Unknown path {path}"}}, 404)
+
+        if body.get("stream"):
+            self.send_stream(frames)
+        else:
+            ## a non-streamed answer still takes as long as generating every token
+            time.sleep(self.settings.tokens / self.settings.token_rate if self.settings.token_rate else 0)
+            self.send_json(completion)
+
+    def envelope(self, deployment, object):
+        return {"id": f"chatcmpl-{uuid.uuid4().hex[:24]}", "model": deployment, "created": int(time.time()), "object": object}
+
+    def chat_frames(self, deployment):
+        envelope = self.envelope(deployment, "chat.completion.chunk")
+        yield sse({**envelope, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+        for token in self.settings.answer():
+            yield sse({**envelope, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]})
+        yield sse({**envelope, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        yield b"data: [DONE]\n\n"
+
+    def chat_completion(self, deployment):
+        return {**self.envelope(deployment, "chat.completion"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(self.settings.answer())}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 20, "completion_tokens": self.settings.tokens, "total_tokens": 20 + self.settings.tokens}}
+
+    def extension_frames(self, deployment):
+        envelope = self.envelope(deployment, "extensions.chat.completion.chunk")
+        tool = {"messages": [{"role": "tool", "content": json.dumps(CITATIONS), "end_turn": False}]}
+        yield sse({**envelope, "choices": [{"index": 0, "delta": {"context": tool}, "end_turn": False, "finish_reason": None}]})
+        yield sse({**envelope, "choices": [{"index": 0, "delta": {"role": "assistant"}, "end_turn": False, "finish_reason": None}]})
+        for token in self.settings.answer():
+            yield sse({**envelope, "choices": [{"index": 0, "finish_reason": None, "delta": {"content": token}, "end_turn": False}]})
+        yield sse({**envelope, "choices": [{"index": 0, "delta": {}, "end_turn": True, "finish_reason": "stop"}]})
+        yield b"data: [DONE]\n\n"
+
+    def extension_completion(self, deployment):
+        return {**self.envelope(deployment, "extensions.chat.completion"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(self.settings.answer()), "end_turn": True,
+                                                     "context": {"messages": [{"role": "tool", "content": json.dumps(CITATIONS), "end_turn": False}]}}}]}
+
+    def send_json(self, obj, status=200, headers={}):
+        payload = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_stream(self, frames):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        interval = 1 / self.settings.token_rate if self.settings.token_rate else 0
+        for frame in frames:
+            self.wfile.write(f"{len(frame):x}\r\n".encode("ascii") + frame + b"\r\n")
+            self.wfile.flush()
+            if interval:
+                time.sleep(interval)
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def start_mock_server(settings: MockSettings, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Starts the mock in a daemon thread; its base URL is http://{host}:{server.server_port}/."""
+    handler = type("Handler", (MockAzureOpenAIHandler,), {"settings": settings})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-aoai", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Azure OpenAI endpoint for local benchmarking")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before the first byte of each response.")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Streamed tokens per second.")
+    parser.add_argument("--tokens", type=int, default=100, help="Tokens in every answer.")
+    parser.add_argument("--throttle", type=float, default=0.0, help="Share of requests answered with a 429.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of the 429s, in seconds.")
+    args = parser.parse_args()
+
+    server = start_mock_server(MockSettings(args.latency, args.token_rate, args.tokens, args.throttle, args.retry_after), port=args.port)
+    print(f"Mock Azure OpenAI listening on http://127.0.0.1:{server.server_port}/ (set AZURE_OPENAI_ENDPOINT to this)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
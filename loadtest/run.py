@@ -0,0 +1,320 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from loadtest.mock_aoai import MockSettings, start_mock_server
+
+# Load generator for the chat routes. Each virtual user chats the way the frontend does:
+# /history/generate (or /conversation, without history) streams an answer, and
+# /history/update saves it. Reports time to first token, latency, throughput and the
+# resident memory of every server worker.
+#
+#   python -m loadtest.run --concurrency 32 --requests 500
+#   python -m loadtest.run --server uvicorn --workers 2 --with-data
+#   python -m loadtest.run --target http://localhost:5000 --worker-pid 1234 --worker-pid 1235
+#
+# Unless --target is given it starts the mock Azure OpenAI endpoint in this process and
+# serves the app (through loadtest.serve, against an in-memory Cosmos DB) in a child process.
+
+SCENARIOS = ("conversation", "generate", "update")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUESTIONS = ("What are my health plan options?", "Does the plan cover vision care?", "How do I add a dependent?",
+             "What is the deductible?", "Summarize the benefits in three bullets.")
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario '{name}', expected one of {', '.join(SCENARIOS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def descendants(pid: int) -> list:
+    children = {}
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    found, pending = [], [pid]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            found.append(child)
+            pending.append(child)
+    return found
+
+
+class Results():
+
+    def __init__(self):
+        self.latency = {name: [] for name in SCENARIOS}
+        self.ttft = {name: [] for name in SCENARIOS}
+        self.errors = {name: 0 for name in SCENARIOS}
+        self.chunks = 0
+        self.memory = {}
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def sample_memory(self, pids: list):
+        for pid in pids:
+            rss = rss_mb(pid)
+            if rss is not None:
+                first, peak, _ = self.memory.get(pid, (rss, rss, rss))
+                self.memory[pid] = (first, max(peak, rss), rss)
+
+    def report(self) -> str:
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        requests = sum(len(latencies) for latencies in self.latency.values()) + sum(self.errors.values())
+        lines = [f"{'scenario':<14}{'requests':>9}{'errors':>8}{'ttft p50':>11}{'ttft p99':>11}{'total p50':>11}{'total p99':>11}"]
+        for name in SCENARIOS:
+            latency, ttft = self.latency[name], self.ttft[name]
+            if not latency and not self.errors[name]:
+                continue
+            lines.append(f"{name:<14}{len(latency) + self.errors[name]:>9}{self.errors[name]:>8}"
+                         f"{percentile(ttft, 50) * 1000:>9.0f}ms{percentile(ttft, 99) * 1000:>9.0f}ms"
+                         f"{percentile(latency, 50) * 1000:>9.0f}ms{percentile(latency, 99) * 1000:>9.0f}ms")
+        lines.append(f"{requests} requests in {elapsed:.1f}s: {requests / elapsed:.1f} requests/s, {self.chunks / elapsed:.0f} answer chunks/s")
+        for pid, (first, peak, last) in sorted(self.memory.items()):
+            lines.append(f"process {pid}: RSS {first:.0f} MB at start, {peak:.0f} MB peak, {last:.0f} MB at end")
+        return "\n".join(lines)
+
+
+class VirtualUser():
+
+    def __init__(self, index: int, args, results: Results):
+        self.args = args
+        self.results = results
+        self.headers = {
+            "X-Ms-Client-Principal-Id": f"loadtest-user-{index % args.users}",
+            "X-Ms-Client-Principal-Name": f"loadtest-user-{index % args.users}@example.com",
+        }
+        self.messages = []
+        self.conversation_id = None
+        self.unsaved = []
+
+    async def run(self, client: httpx.AsyncClient, next_request):
+        scenarios, weights = zip(*self.args.mix.items())
+        while next_request():
+            scenario = random.choices(scenarios, weights)[0]
+            ## an answer has to exist before it can be saved
+            if scenario == "update" and not self.unsaved:
+                scenario = "generate"
+            started = time.perf_counter()
+            try:
+                if scenario == "update":
+                    await self.update(client)
+                    ttft = time.perf_counter() - started
+                else:
+                    ttft = await self.chat(client, scenario, started)
+                self.results.latency[scenario].append(time.perf_counter() - started)
+                self.results.ttft[scenario].append(ttft)
+            except Exception as e:
+                self.results.errors[scenario] += 1
+                if self.args.verbose:
+                    print(f"{scenario} failed: {e}", file=sys.stderr)
+
+    async def chat(self, client: httpx.AsyncClient, scenario: str, started: float) -> float:
+        if len(self.messages) >= self.args.turns * 2 or self.unsaved:
+            ## start over, like a user opening a new chat
+            self.messages, self.conversation_id, self.unsaved = [], None, []
+        messages = self.messages + [{"id": f"{time.time_ns()}", "role": "user", "content": random.choice(QUESTIONS)}]
+        body = {"messages": messages, "model": "mock"}
+        path = "/conversation"
+        if scenario == "generate":
+            path = "/history/generate"
+            body["conversation_id"] = self.conversation_id
+
+        ttft = None
+        answer, tool = [], None
+        async with client.stream("POST", path, json=body, headers=self.headers) as response:
+            if response.status_code != 200:
+                raise Exception(f"{path} returned {response.status_code}: {(await response.aread())[:200]}")
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise Exception(f"{path} streamed an error: {chunk['error']}")
+                self.conversation_id = chunk.get("history_metadata", {}).get("conversation_id", self.conversation_id)
+                for message in chunk.get("choices", [{}])[0].get("messages", []):
+                    if message.get("role") == "tool":
+                        tool = message
+                    elif message.get("role") == "assistant" and message.get("content"):
+                        ttft = ttft or time.perf_counter() - started
+                        answer.append(message["content"])
+                        self.results.chunks += 1
+        if not answer:
+            raise Exception(f"{path} returned no answer")
+
+        self.messages = messages
+        replies = ([tool] if tool else []) + [{"id": f"{time.time_ns()}", "role": "assistant", "content": "".join(answer)}]
+        if scenario == "generate":
+            self.unsaved = replies
+        else:
+            self.messages = self.messages + replies
+        return ttft
+
+    async def update(self, client: httpx.AsyncClient):
+        messages = self.messages + self.unsaved
+        response = await client.post("/history/update", json={"conversation_id": self.conversation_id, "messages": messages}, headers=self.headers)
+        if response.status_code != 200:
+            raise Exception(f"/history/update returned {response.status_code}: {response.text[:200]}")
+        self.messages, self.unsaved = messages, []
+
+
+async def run_load(args, base_url: str, pids: list) -> Results:
+    results = Results()
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    issued = 0
+
+    def next_request():
+        nonlocal issued
+        if (args.requests and issued >= args.requests) or (deadline and time.perf_counter() >= deadline):
+            return False
+        issued += 1
+        return True
+
+    async def sample_memory():
+        while True:
+            results.sample_memory(pids)
+            await asyncio.sleep(0.5)
+
+    async def virtual_user(index):
+        ## one keep-alive connection per virtual user, so with several worker processes
+        ## all of its requests (and the in-memory history they build up) stay on one worker
+        limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+            await VirtualUser(index, args, results).run(client, next_request)
+
+    sampler = asyncio.create_task(sample_memory())
+    await asyncio.gather(*(virtual_user(i) for i in range(args.concurrency)))
+    results.finished = time.perf_counter()
+    sampler.cancel()
+    results.sample_memory(pids)
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, aoai_endpoint: str):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=ROOT, LOADTEST_AOAI_ENDPOINT=aoai_endpoint,
+               LOADTEST_WITH_DATA=str(args.with_data).lower(), LOADTEST_COSMOS_LATENCY=str(args.cosmos_latency))
+    if args.server == "uvicorn":
+        command = [sys.executable, "-m", "uvicorn", "loadtest.serve:asgi_app", "--port", str(port),
+                   "--workers", str(args.workers), "--log-level", "warning"]
+    elif args.server == "uwsgi":
+        if not shutil.which("uwsgi"):
+            raise Exception("uwsgi is not installed")
+        ## --http-socket: workers accept connections themselves, with no router in between
+        command = ["uwsgi", "--http-socket", f"127.0.0.1:{port}", "--module", "loadtest.serve:wsgi_app", "--master",
+                   "--processes", str(args.workers), "--threads", str(args.threads), "--enable-threads", "--disable-logging"]
+    else:
+        command = [sys.executable, "-m", "loadtest.serve", "--port", str(port)]
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    base_url = f"http://127.0.0.1:{port}"
+
+    started = time.monotonic()
+    while time.monotonic() - started < 60:
+        if process.poll() is not None:
+            raise Exception(f"Server exited with {process.returncode}: {' '.join(command)}")
+        try:
+            httpx.get(f"{base_url}/metrics", timeout=1)
+            ## uvicorn and uwsgi masters fork their workers once the first is up
+            time.sleep(1 if args.workers > 1 else 0)
+            return process, base_url
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.terminate()
+    raise Exception("Server did not start within 60s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chat routes against local stand-ins for Azure OpenAI and Cosmos DB")
+    parser.add_argument("--concurrency", type=int, default=16, help="Virtual users chatting at the same time.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests to send in total (0 for no limit).")
+    parser.add_argument("--duration", type=float, default=0, help="Stop after this many seconds.")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("generate=2,update=2,conversation=1"),
+                        help="Relative weights of the scenarios, e.g. generate=2,update=2,conversation=1.")
+    parser.add_argument("--users", type=int, default=0, help="Distinct signed-in users (defaults to --concurrency).")
+    parser.add_argument("--turns", type=int, default=3, help="Questions per conversation before starting a new one.")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--target", help="Base URL of an already running app; no stand-ins are started.")
+    parser.add_argument("--worker-pid", type=int, action="append", default=[], help="Process to report memory for (with --target).")
+    parser.add_argument("--server", choices=("werkzeug", "uvicorn", "uwsgi"), default="werkzeug")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes (uvicorn and uwsgi).")
+    parser.add_argument("--threads", type=int, default=8, help="Threads per uwsgi worker.")
+    parser.add_argument("--with-data", action="store_true", help="Chat through the on-your-data extensions endpoint.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mock Azure OpenAI delay before the first byte.")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Mock Azure OpenAI tokens per second.")
+    parser.add_argument("--tokens", type=int, default=100, help="Tokens in every mock answer.")
+    parser.add_argument("--throttle", type=float, default=0.0, help="Share of mock Azure OpenAI requests answered with a 429.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of the mock 429s, in seconds.")
+    parser.add_argument("--cosmos-latency", type=float, default=0.0, help="Seconds added to every in-memory Cosmos DB call.")
+    parser.add_argument("--verbose", action="store_true", help="Print every failed request.")
+    args = parser.parse_args()
+    args.users = args.users or args.concurrency
+
+    process = None
+    if args.target:
+        base_url, pids = args.target.rstrip("/"), args.worker_pid
+    else:
+        mock = start_mock_server(MockSettings(args.latency, args.token_rate, args.tokens, args.throttle, args.retry_after))
+        process, base_url = start_server(args, f"http://127.0.0.1:{mock.server_port}/")
+        pids = [process.pid] + descendants(process.pid)
+
+    try:
+        print(f"Sending {args.requests or 'unlimited'} requests{f' for up to {args.duration:.0f}s' if args.duration else ''} "
+              f"from {args.concurrency} virtual users to {base_url}")
+        results = asyncio.run(run_load(args, base_url, pids))
+        print(results.report())
+    finally:
+        if process:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    main()
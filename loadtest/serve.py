@@ -0,0 +1,96 @@
+import argparse
+import logging
+import os
+import sys
+
+# Serves app.py against the mock Azure OpenAI endpoint and an in-memory Cosmos DB.
+#
+#   python -m loadtest.serve --port 5000 --aoai-endpoint http://127.0.0.1:8090/
+#   uvicorn loadtest.serve:asgi_app --workers 4        (LOADTEST_AOAI_ENDPOINT=...)
+#   uwsgi --http-socket :5000 --module loadtest.serve:wsgi_app --processes 4 --enable-threads
+#
+# The stand-ins are installed before app.py is imported, since it reads its settings and
+# creates its clients at import. Each worker process has its own in-memory Cosmos, so the
+# load generator keeps every virtual user on one keep-alive connection, and with it on one worker.
+
+DEFAULT_AOAI_ENDPOINT = "http://127.0.0.1:8090/"
+
+
+def install(aoai_endpoint: str, with_data: bool = False, cosmos_latency: float = 0.0):
+    """Points the app settings at the stand-ins. Must run before app.py is imported."""
+    if "app" in sys.modules:
+        raise Exception("install() must be called before app.py is imported")
+
+    settings = {
+        "AZURE_OPENAI_ENDPOINT": aoai_endpoint.rstrip("/") + "/",
+        "AZURE_OPENAI_KEY": "mock",
+        "AZURE_OPENAI_MODEL": "mock",
+        "AZURE_COSMOSDB_ACCOUNT": "loadtest",
+        "AZURE_COSMOSDB_ACCOUNT_KEY": "mock",
+        "AZURE_COSMOSDB_DATABASE": "db_conversation_history",
+        "AZURE_COSMOSDB_CONVERSATIONS_CONTAINER": "conversations",
+        "AZURE_COSMOSDB_USERSETTINGS_CONTAINER": "usersettings",
+    }
+    if with_data:
+        ## the mock extensions endpoint answers with canned citations in place of the search index
+        settings.update({
+            "DATASOURCE_TYPE": "AzureCognitiveSearch",
+            "AZURE_SEARCH_SERVICE": "mock",
+            "AZURE_SEARCH_INDEX": "mock",
+            "AZURE_SEARCH_KEY": "mock",
+        })
+    os.environ.update(settings)
+    if "AZURE_APP_INSIGHTS_CONNECTION_STRING" not in os.environ:
+        ## nothing listens there, and an hour between exports keeps the failed uploads out of the way
+        os.environ["AZURE_APP_INSIGHTS_CONNECTION_STRING"] = "InstrumentationKey=00000000-0000-0000-0000-000000000000;IngestionEndpoint=http://127.0.0.1:9"
+        os.environ.setdefault("AZURE_APP_INSIGHTS_EXPORT_INTERVAL", "3600")
+
+    from backend.history import cosmosdbservice
+    from backend.usersettings import cosmosdbserviceUserSettings
+    from loadtest.fake_cosmos import FakeCosmosClient
+
+    FakeCosmosClient.latency = cosmos_latency
+    cosmosdbservice.CosmosClient = FakeCosmosClient
+    cosmosdbserviceUserSettings.CosmosClient = FakeCosmosClient
+
+
+def install_from_env():
+    install(os.environ.get("LOADTEST_AOAI_ENDPOINT", DEFAULT_AOAI_ENDPOINT),
+            os.environ.get("LOADTEST_WITH_DATA", "false").lower() == "true",
+            float(os.environ.get("LOADTEST_COSMOS_LATENCY", 0)))
+
+
+def __getattr__(name):
+    ## `loadtest.serve:wsgi_app` / `loadtest.serve:asgi_app` for uwsgi and uvicorn workers
+    if name in ("wsgi_app", "asgi_app"):
+        if "app" not in sys.modules:
+            install_from_env()
+        if name == "wsgi_app":
+            from app import app
+        else:
+            from asgi import app
+        return app
+    raise AttributeError(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the app against local stand-ins for Azure OpenAI and Cosmos DB")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--aoai-endpoint", default=os.environ.get("LOADTEST_AOAI_ENDPOINT", DEFAULT_AOAI_ENDPOINT))
+    parser.add_argument("--with-data", action="store_true", help="Chat through the on-your-data extensions endpoint.")
+    parser.add_argument("--cosmos-latency", type=float, default=0.0, help="Seconds added to every Cosmos DB call.")
+    parser.add_argument("--asgi", action="store_true", help="Serve asgi.py with uvicorn instead of app.py with werkzeug.")
+    args = parser.parse_args()
+
+    install(args.aoai_endpoint, args.with_data, args.cosmos_latency)
+    if args.asgi:
+        import uvicorn
+        from asgi import app
+        uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    else:
+        from werkzeug.serving import run_simple
+        from app import app
+        ## per-request access logs would drown everything else under load
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        run_simple(args.host, args.port, app, threaded=True)
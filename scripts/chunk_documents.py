@@ -8,7 +8,7 @@ from azure.core.credentials import AzureKeyCredential
 from azure.keyvault.secrets import SecretClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
-from data_utils import chunk_directory
+from data_utils import ChunkingResult, iter_directory_chunks
 
 def get_document_intelligence_client(config, secret_client):
     print("Setting up Document Intelligence client...")
@@ -69,26 +69,26 @@ if __name__ == "__main__":
         # Crack and chunk documents
         print("Cracking and chunking documents...")
 
-        chunking_result = chunk_directory(
-                            directory_path=args.input_data_path, 
+        # chunks are written out as they are produced rather than collected first
+        chunking_result = ChunkingResult(chunks=[], total_files=0)
+        chunks = iter_directory_chunks(
+                            directory_path=args.input_data_path,
+                            result=chunking_result,
                             num_tokens=index_config.get("chunk_size", 1024),
                             token_overlap=index_config.get("token_overlap", 128),
                             form_recognizer_client=document_intelligence_client,
                             use_layout=index_config.get("use_layout", False),
                             njobs=1)
-        
-        print(f"Processed {chunking_result.total_files} files")
-        print(f"Unsupported formats: {chunking_result.num_unsupported_format_files} files")
-        print(f"Files with errors: {chunking_result.num_files_with_errors} files")
-        print(f"Found {len(chunking_result.chunks)} chunks")
 
         print("Writing chunking result to {}...".format(args.output_file_path))
         with open(args.output_file_path, "w") as f:
-            for chunk in chunking_result.chunks:
-                id = 0
+            for chunk in chunks:
+                # chunks carry stable ids derived from their file, position and content
                 d = dataclasses.asdict(chunk)
-                # add id to documents
-                d.update({"id": str(id)})
                 f.write(json.dumps(d) + "\n")
-                id += 1
         print("Chunking result written to {}.".format(args.output_file_path))
+
+        print(f"Processed {chunking_result.total_files} files")
+        print(f"Unsupported formats: {chunking_result.num_unsupported_format_files} files")
+        print(f"Files with errors: {chunking_result.num_files_with_errors} files")
+        print(f"Found {chunking_result.num_chunks} chunks")
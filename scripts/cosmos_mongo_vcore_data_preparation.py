@@ -2,17 +2,16 @@
 import argparse
 import json
 import os
-import uuid
 
 import requests
-from data_utils import Document
+from data_utils import ChunkingResult, Document, IndexManifest
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureCliCredential
 from pymongo.mongo_client import MongoClient
-from typing import List
+from typing import Iterable, List
 
-from data_utils import chunk_directory
+from data_utils import iter_directory_chunks
 
 SUPPORTED_LANGUAGE_CODES = {
     "ar": "Arabic",
@@ -122,11 +121,13 @@ def upsert_documents_to_index(
         mongo_client: MongoClient,
         database_name: str,
         collection_name: str,
-        docs: List[Document]
-        ):
+        docs: Iterable[Document]
+        ) -> int:
+    failures = 0
     for document in docs:
         finalDocChunk:dict = {}
-        finalDocChunk["_id"] = f"doc:{uuid.uuid4()}"
+        # stable chunk ids, so a re-run replaces chunks instead of duplicating them
+        finalDocChunk["_id"] = f"doc:{document.id}"
         finalDocChunk['title'] = document.title
         finalDocChunk["filepath"] = document.filepath
         finalDocChunk["url"] = document.url
@@ -137,12 +138,24 @@ def upsert_documents_to_index(
         mongo_collection = mongo_client[database_name][collection_name]
 
         try:
-            mongo_collection.insert_one(finalDocChunk)
+            mongo_collection.replace_one({"_id": finalDocChunk["_id"]}, finalDocChunk, upsert=True)
             print(f"Upsert doc chunk {document.id} successfully")
         
         except Exception as e:
             print(f"Failed to upsert doc chunk {document.id}")
+            failures += 1
             continue
+    return failures
+
+def delete_documents_from_index(
+        mongo_client: MongoClient,
+        database_name: str,
+        collection_name: str,
+        ids: List[str]
+        ):
+    mongo_collection = mongo_client[database_name][collection_name]
+    result = mongo_collection.delete_many({"_id": {"$in": [f"doc:{id}" for id in ids]}})
+    print(f"Deleted {result.deleted_count} doc chunks")
 
 def validate_index(
         mongo_client: MongoClient,
@@ -195,21 +208,36 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
     print("Chunking directory...")
     add_embeddings = True
 
-    result = chunk_directory(config["data_path"], num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
-                             azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
-                             add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint)
+    # with a manifest, only new and changed files are ingested and chunks of changed or removed files are deleted
+    manifest = IndexManifest(config["manifest_path"]) if config.get("manifest_path") else None
+    # chunks are upserted while later files are still being chunked, and counted into result as they go
+    result = ChunkingResult(chunks=[], total_files=0)
+    chunks = iter_directory_chunks(config["data_path"], result, num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
+                                   azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
+                                   add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint,
+                                   manifest=manifest, source_name=config["data_path"])
 
-    if len(result.chunks) == 0:
+    # upsert documents to index
+    print("Upserting documents to index...")
+    failures = upsert_documents_to_index(mongo_client, database_name, collection_name, chunks)
+
+    if result.num_chunks == 0 and not (manifest and result.num_unchanged_files):
         raise Exception("No chunks found. Please check the data path and chunk size.")
 
     print(f"Processed {result.total_files} files")
     print(f"Unsupported formats: {result.num_unsupported_format_files} files")
     print(f"Files with errors: {result.num_files_with_errors} files")
-    print(f"Found {len(result.chunks)} chunks")
-
-    # upsert documents to index
-    print("Upserting documents to index...")
-    upsert_documents_to_index(mongo_client, database_name, collection_name, result.chunks)
+    print(f"Found {result.num_chunks} chunks")
+    if result.embedding_cache_hits:
+        print(f"Embeddings for {result.embedding_cache_hits} chunks came from the embedding cache")
+
+    if result.deleted_chunk_ids:
+        print(f"Deleting {len(result.deleted_chunk_ids)} chunks of changed or removed files...")
+        delete_documents_from_index(mongo_client, database_name, collection_name, result.deleted_chunk_ids)
+    if manifest and failures:
+        print(f"Not updating the manifest since {failures} doc chunks failed to upsert; the next run retries their files")
+    elif manifest:
+        manifest.save()
 
     # check if index is ready/validate index
     print("Validating index...")
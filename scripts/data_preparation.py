@@ -13,7 +13,7 @@ from azure.identity import AzureCliCredential
 from azure.search.documents import SearchClient
 from tqdm import tqdm
 
-from data_utils import chunk_directory, chunk_blob_container
+from data_utils import ChunkingResult, IndexManifest, iter_blob_container_chunks, iter_directory_chunks
 
 SUPPORTED_LANGUAGE_CODES = {
     "ar": "Arabic",
@@ -253,22 +253,10 @@ def create_or_update_search_index(
 
 
 def upload_documents_to_index(service_name, subscription_id, resource_group, index_name, docs, credential=None, upload_batch_size = 50, admin_key=None):
+    """Uploads docs, a list or a stream of chunks, in batches of upload_batch_size as they come. Returns how many were uploaded."""
     if credential is None and admin_key is None:
         raise ValueError("credential and admin_key cannot be None")
     
-    to_upload_dicts = []
-
-    id = 0
-    for d in docs:
-        if type(d) is not dict:
-            d = dataclasses.asdict(d)
-        # add id to documents
-        d.update({"@search.action": "upload", "id": str(id)})
-        if "contentVector" in d and d["contentVector"] is None:
-            del d["contentVector"]
-        to_upload_dicts.append(d)
-        id += 1
-    
     endpoint = "https://{}.search.windows.net/".format(service_name)
     if not admin_key:
         admin_key = json.loads(
@@ -284,9 +272,8 @@ def upload_documents_to_index(service_name, subscription_id, resource_group, ind
         index_name=index_name,
         credential=AzureKeyCredential(admin_key),
     )
-    # Upload the documents in batches of upload_batch_size
-    for i in tqdm(range(0, len(to_upload_dicts), upload_batch_size), desc="Indexing Chunks..."):
-        batch = to_upload_dicts[i: i + upload_batch_size]
+
+    def upload_batch(batch):
         results = search_client.upload_documents(documents=batch)
         num_failures = 0
         errors = set()
@@ -299,6 +286,51 @@ def upload_documents_to_index(service_name, subscription_id, resource_group, ind
             raise Exception(f"INDEXING FAILED for {num_failures} documents. Please recreate the index."
                             f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}")
 
+    # only one batch is held at a time, so a stream of chunks is never materialized
+    batch = []
+    id = 0
+    for d in tqdm(docs, desc="Indexing Chunks...", unit="chunk"):
+        if type(d) is not dict:
+            d = dataclasses.asdict(d)
+        # keep the stable chunk id when there is one, so a re-run replaces the chunk instead of another one
+        d.update({"@search.action": "upload", "id": d.get("id") or str(id)})
+        if "contentVector" in d and d["contentVector"] is None:
+            del d["contentVector"]
+        batch.append(d)
+        id += 1
+        if len(batch) == upload_batch_size:
+            upload_batch(batch)
+            batch = []
+    if batch:
+        upload_batch(batch)
+    return id
+
+def delete_documents_from_index(service_name, subscription_id, resource_group, index_name, ids, credential=None, delete_batch_size=1000, admin_key=None):
+    if credential is None and admin_key is None:
+        raise ValueError("credential and admin_key cannot be None")
+
+    endpoint = "https://{}.search.windows.net/".format(service_name)
+    if not admin_key:
+        admin_key = json.loads(
+            subprocess.run(
+                f"az search admin-key show --subscription {subscription_id} --resource-group {resource_group} --service-name {service_name}",
+                shell=True,
+                capture_output=True,
+            ).stdout
+        )["primaryKey"]
+
+    search_client = SearchClient(
+        endpoint=endpoint,
+        index_name=index_name,
+        credential=AzureKeyCredential(admin_key),
+    )
+    for i in tqdm(range(0, len(ids), delete_batch_size), desc="Deleting Chunks..."):
+        batch = [{"id": id} for id in ids[i: i + delete_batch_size]]
+        results = search_client.delete_documents(documents=batch)
+        failures = [result for result in results if not result.succeeded and result.status_code != 404]
+        if failures:
+            raise Exception(f"DELETING FAILED for {len(failures)} documents. Error Messages: {list({result.error_message for result in failures})}")
+
 def validate_index(service_name, subscription_id, resource_group, index_name):
     api_version = "2021-04-30-Preview"
     admin_key = json.loads(
@@ -379,6 +411,9 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
     if "data_paths" in config:
         data_configs.extend(config["data_paths"])
 
+    # with a manifest, only new and changed files are ingested and chunks of changed or removed files are deleted
+    manifest = IndexManifest(config["manifest_path"]) if config.get("manifest_path") else None
+
     for data_config in data_configs:
         # chunk directory
         print(f"Chunking path {data_config['path']}...")
@@ -386,28 +421,42 @@ def create_index(config, credential, form_recognizer_client=None, embedding_mode
         if config.get("vector_config_name") and embedding_model_endpoint:
             add_embeddings = True
 
+        # chunks are uploaded while later files are still being chunked, and counted into result as they go
+        result = ChunkingResult(chunks=[], total_files=0)
         if "blob.core" in data_config["path"]:
-            result = chunk_blob_container(data_config["path"], credential=credential, num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
+            chunks = iter_blob_container_chunks(data_config["path"], credential, result, num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
                                 azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
-                                add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"])
+                                add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"],
+                                manifest=manifest, source_name=data_config["path"])
         elif os.path.exists(data_config["path"]):
-            result = chunk_directory(data_config["path"], num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
+            chunks = iter_directory_chunks(data_config["path"], result, num_tokens=config["chunk_size"], token_overlap=config.get("token_overlap",0),
                                     azure_credential=credential, form_recognizer_client=form_recognizer_client, use_layout=use_layout, njobs=njobs,
-                                    add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"])
+                                    add_embeddings=add_embeddings, embedding_endpoint=embedding_model_endpoint, url_prefix=data_config["url_prefix"],
+                                    manifest=manifest, source_name=data_config["path"])
         else:
             raise Exception(f"Path {data_config['path']} does not exist and is not a blob URL. Please check the path and try again.")
 
-        if len(result.chunks) == 0:
+        # upload documents to index
+        print("Uploading documents to index...")
+        upload_documents_to_index(service_name, subscription_id, resource_group, index_name, chunks, credential, admin_key=admin_key)
+
+        if result.num_chunks == 0 and not (manifest and result.num_unchanged_files):
             raise Exception("No chunks found. Please check the data path and chunk size.")
 
         print(f"Processed {result.total_files} files")
+        if manifest:
+            print(f"Unchanged since the last run: {result.num_unchanged_files} files")
         print(f"Unsupported formats: {result.num_unsupported_format_files} files")
         print(f"Files with errors: {result.num_files_with_errors} files")
-        print(f"Found {len(result.chunks)} chunks")
-
-        # upload documents to index
-        print("Uploading documents to index...")
-        upload_documents_to_index(service_name, subscription_id, resource_group, index_name, result.chunks, credential)
+        print(f"Found {result.num_chunks} chunks")
+        if result.embedding_cache_hits:
+            print(f"Embeddings for {result.embedding_cache_hits} chunks came from the embedding cache")
+
+        if result.deleted_chunk_ids:
+            print(f"Deleting {len(result.deleted_chunk_ids)} chunks of changed or removed files...")
+            delete_documents_from_index(service_name, subscription_id, resource_group, index_name, result.deleted_chunk_ids, credential, admin_key=admin_key)
+        if manifest:
+            manifest.save()
 
     # check if index is ready/validate index
     print("Validating index...")
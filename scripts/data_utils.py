@@ -1,24 +1,25 @@
 """Data utilities for index preparation."""
 import ast
+import hashlib
 import html
 import json
 import os
 import re
+import random
 import requests
-from openai import AzureOpenAI
-
-client = AzureOpenAI(api_version='2023-05-15',
-azure_endpoint=base_url,
-api_key=azure_credential.get_token("https://cognitiveservices.azure.com/.default").token,
-api_key=key)
-import re
+import sqlite3
 import tempfile
+import threading
 import time
+import unicodedata
 from abc import ABC, abstractmethod
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from functools import partial
 from typing import Callable, List, Dict, Optional, Generator, Tuple, Union
+from urllib.parse import parse_qs, urlparse
 
 import markdown
 import tiktoken
@@ -28,6 +29,7 @@ from azure.core.credentials import AzureKeyCredential
 from azure.storage.blob import ContainerClient
 from bs4 import BeautifulSoup
 from langchain.text_splitter import TextSplitter, MarkdownTextSplitter, RecursiveCharacterTextSplitter, PythonCodeTextSplitter
+from openai import AzureOpenAI, APIConnectionError, InternalServerError, RateLimitError
 from tqdm import tqdm
 from typing import Any
 
@@ -46,6 +48,17 @@ FILE_FORMAT_DICT = {
 
 RETRY_COUNT = 5
 
+# Embedding requests: inputs and tokens packed into one request, and requests in flight per process
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 16))
+EMBEDDING_BATCH_TOKENS = int(os.environ.get("EMBEDDING_BATCH_TOKENS", 32000))
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", 4))
+EMBEDDING_API_VERSION = "2023-05-15"
+# On-disk embedding cache shared by runs and processes; unset to always call the embedding model
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 200000))
+# Files each chunking process may have done or in progress before their chunks are consumed
+FILES_IN_FLIGHT_PER_JOB = 2
+
 SENTENCE_ENDINGS = [".", "!", "?"]
 WORDS_BREAKS = list(reversed([",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]))
 
@@ -447,11 +460,15 @@ class ChunkingResult:
     """Data model for chunking result
 
     Attributes:
-        chunks (List[Document]): List of chunks.
+        chunks (List[Document]): List of chunks. Empty when the chunks were streamed.
         total_files (int): Total number of files.
         num_unsupported_format_files (int): Number of files with unsupported format.
         num_files_with_errors (int): Number of files with errors.
         skipped_chunks (int): Number of chunks skipped.
+        num_chunks (int): Number of chunks produced, also when they were streamed.
+        embedding_cache_hits (int): Number of chunk embeddings found in the embedding cache.
+        num_unchanged_files (int): Number of files skipped because they did not change since the last run.
+        deleted_chunk_ids (List[str]): Ids of chunks from changed or removed files to delete from the index.
     """
     chunks: List[Document]
     total_files: int
@@ -459,6 +476,10 @@ class ChunkingResult:
     num_files_with_errors: int = 0
     # some chunks might be skipped to small number of tokens
     skipped_chunks: int = 0
+    num_chunks: int = 0
+    embedding_cache_hits: int = 0
+    num_unchanged_files: int = 0
+    deleted_chunk_ids: List[str] = field(default_factory=list)
 
 def extractStorageDetailsFromUrl(url):
     matches = re.fullmatch(r'https:\/\/([^\/.]*)\.blob\.core\.windows\.net\/([^\/]*)\/(.*)', url)
@@ -505,6 +526,84 @@ def convert_escaped_to_posix(escaped_path):
     posix_path = windows_path.replace("\\", "/")
     return posix_path
 
+def content_hash(content: Union[str, bytes]) -> str:
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+def stable_chunk_id(source_name: str, rel_file_path: str, chunk_index: int, content: str) -> str:
+    """A chunk id that stays the same across runs while the chunk does: derived from the data source,
+    the file's path in it, the chunk's position and its content. Valid as a search index key.
+    """
+    return content_hash("\n".join([source_name, convert_escaped_to_posix(rel_file_path), str(chunk_index), content_hash(content)]))
+
+def file_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class IndexManifest:
+    """What earlier runs put in an index: for each file of each data source, its size, mtime,
+    content hash and the ids of its chunks.
+
+    `plan` picks the files that are new or changed, comparing size and mtime first and the
+    content hash only when those differ (blob downloads get a new mtime on every run). `record`
+    and `forget` return the chunk ids to delete from the index. Call `save` once the index has
+    been updated, so an interrupted run is simply redone.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sources = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.sources = json.load(f).get("sources", {})
+        self._pending = {}
+
+    def plan(self, source_name: str, directory_path: str, file_paths: List[str]) -> Tuple[List[str], List[str], List[str]]:
+        """Splits `file_paths` into (changed, unchanged) and lists the relative paths of removed files."""
+        files = self.sources.setdefault(source_name, {})
+        changed, unchanged, seen = [], [], set()
+        for file_path in file_paths:
+            rel_file_path = convert_escaped_to_posix(os.path.relpath(file_path, directory_path))
+            seen.add(rel_file_path)
+            stat = os.stat(file_path)
+            entry = files.get(rel_file_path)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                unchanged.append(file_path)
+                continue
+            sha256 = file_hash(file_path)
+            if entry and entry["sha256"] == sha256:
+                entry["mtime"] = stat.st_mtime
+                unchanged.append(file_path)
+                continue
+            self._pending[(source_name, rel_file_path)] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+            changed.append(file_path)
+        removed = [rel_file_path for rel_file_path in files if rel_file_path not in seen]
+        return changed, unchanged, removed
+
+    def record(self, source_name: str, rel_file_path: str, chunk_ids: List[str]) -> List[str]:
+        """Stores the chunks a changed file now has; returns the ids of its chunks that are gone."""
+        rel_file_path = convert_escaped_to_posix(rel_file_path)
+        files = self.sources.setdefault(source_name, {})
+        previous = files.get(rel_file_path, {}).get("chunk_ids", [])
+        files[rel_file_path] = dict(self._pending.pop((source_name, rel_file_path)), chunk_ids=chunk_ids)
+        current = set(chunk_ids)
+        return [chunk_id for chunk_id in previous if chunk_id not in current]
+
+    def forget(self, source_name: str, rel_file_path: str) -> List[str]:
+        """Drops a removed file; returns the ids of its chunks."""
+        return self.sources.get(source_name, {}).pop(rel_file_path, {}).get("chunk_ids", [])
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+            json.dump({"version": 1, "sources": self.sources}, f)
+        os.replace(f.name, self.path)
+
 def _get_file_format(file_name: str, extensions_to_process: List[str]) -> Optional[str]:
     """Gets the file format from the file name.
     Returns None if the file format is not supported.
@@ -616,27 +715,245 @@ def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int) -> G
         yield current_chunk, total_size
 
 
-def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None):
-    endpoint = embedding_model_endpoint if embedding_model_endpoint else os.environ.get("EMBEDDING_MODEL_ENDPOINT")
-    key = embedding_model_key if embedding_model_key else os.environ.get("EMBEDDING_MODEL_KEY")
-    
-    if azure_credential is None and (endpoint is None or key is None):
-        raise Exception("EMBEDDING_MODEL_ENDPOINT and EMBEDDING_MODEL_KEY are required for embedding")
+def parse_embedding_endpoint(endpoint: str) -> Tuple[str, str, str]:
+    """Splits an embedding endpoint such as
+    https://<resource>.openai.azure.com/openai/deployments/<deployment>/embeddings?api-version=2023-06-01-preview
+    into (base url, deployment, api version).
+    """
+    base_url, rest = endpoint.split("/openai/deployments/")
+    deployment = rest.split("/embeddings")[0]
+    api_version = parse_qs(urlparse(endpoint).query).get("api-version", [EMBEDDING_API_VERSION])[0]
+    return base_url, deployment, api_version
+
 
+def retry_after_seconds(headers) -> Optional[float]:
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        if headers.get(name):
+            return float(headers[name]) / 1000
     try:
-        endpoint_parts = endpoint.split("/openai/deployments/")
-        base_url = endpoint_parts[0]
-        deployment_id = endpoint_parts[1].split("/embeddings")[0]
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class EmbeddingCache:
+    """Embeddings kept on disk between runs, keyed by model and a hash of the normalized chunk text.
 
+    One SQLite file can be shared by every process of a run. Vectors are stored as float32, the
+    precision the search index keeps, and the least recently used entries are evicted once there
+    are more than `max_entries`.
+    """
+
+    # Keys looked up per query, below SQLite's limit on bound parameters
+    QUERY_KEYS = 500
+
+    def __init__(self, path: str, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        normalized = " ".join(unicodedata.normalize("NFC", text).split())
+        return hashlib.sha256(f"{model}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """The cached vector of each text, or None where there is none."""
+        keys = [self.key(model, text) for text in texts]
+        found = {}
+        with self.lock, self.connection:
+            for i in range(0, len(keys), self.QUERY_KEYS):
+                part = keys[i:i + self.QUERY_KEYS]
+                placeholders = ",".join("?" * len(part))
+                found.update(self.connection.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part))
+            if found:
+                now = time.time()
+                self.connection.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return [array("f", found[key]).tolist() if key in found else None for key in keys]
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        now = time.time()
+        rows = [(self.key(model, text), array("f", vector).tobytes(), now) for text, vector in zip(texts, vectors)]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            self.entries += len(rows)
+            if self.entries > self.max_entries:
+                self.evict()
+
+    def evict(self):
+        ## other processes add entries too, so recount; going a tenth below the limit keeps this off every insert
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = self.entries - self.max_entries
+        if excess > 0:
+            excess += self.max_entries // 10
+            self.connection.execute("DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,))
+            self.entries -= excess
+            self.evictions += excess
+
+    def report(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (f"Embedding cache {self.path}: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{self.entries} entries, {self.evictions} evicted")
+
+
+class EmbeddingEngine:
+    """Embeds many texts with few requests to an Azure OpenAI embedding deployment.
+
+    Texts are packed into requests of up to `batch_size` inputs and `batch_tokens` tokens, sent
+    by one client over at most `max_concurrency` concurrent requests. A 429 holds every request
+    back for the service's Retry-After and halves the requests allowed in flight, which grow
+    back by one with every success; connection errors and 5xx back off exponentially. With a
+    `cache`, only the texts it does not hold yet are sent, and their vectors are added to it.
+    """
 
+    def __init__(self, endpoint: str, key: Optional[str] = None, azure_credential = None, batch_size: int = EMBEDDING_BATCH_SIZE,
+                 batch_tokens: int = EMBEDDING_BATCH_TOKENS, max_concurrency: int = EMBEDDING_CONCURRENCY, max_retries: int = RETRY_COUNT,
+                 cache: Optional[EmbeddingCache] = None):
+        base_url, self.deployment, api_version = parse_embedding_endpoint(endpoint)
+        # the same deployment name on another resource may be another model
+        self.model = f"{base_url}/{self.deployment}"
+        self.cache = cache
         if azure_credential is not None:
+            self.client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, max_retries=0,
+                                      azure_ad_token_provider=lambda: azure_credential.get_token("https://cognitiveservices.azure.com/.default").token)
         else:
+            self.client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, api_key=key, max_retries=0)
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="embedding")
+        self.limit = max_concurrency
+        self.active = 0
+        self.blocked_until = 0.0
+        self.condition = threading.Condition()
+        self.requests = 0
+        self.throttled = 0
+
+    def batches(self, texts: List[str]) -> Generator[List[int], None, None]:
+        """Yields the indexes of `texts` that go into each request."""
+        batch, batch_tokens = [], 0
+        for i, text in enumerate(texts):
+            tokens = TOKEN_ESTIMATOR.estimate_tokens(text)
+            if batch and (len(batch) >= self.batch_size or batch_tokens + tokens > self.batch_tokens):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embeds `texts`, returning their vectors in the same order."""
+        vectors = self.cache.get_many(self.model, texts) if self.cache else [None] * len(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        batches = [[missing[i] for i in batch] for batch in self.batches([texts[i] for i in missing])]
+        for batch, embeddings in zip(batches, self.executor.map(lambda batch: self.request([texts[i] for i in batch]), batches)):
+            for i, embedding in zip(batch, embeddings):
+                vectors[i] = embedding
+            if self.cache:
+                ## stored as each request completes, so an interrupted run keeps what it paid for
+                self.cache.put_many(self.model, [texts[i] for i in batch], embeddings)
+        return vectors
+
+    def request(self, inputs: List[str]) -> List[List[float]]:
+        error = None
+        for attempt in range(self.max_retries):
+            self.acquire()
+            try:
+                response = self.client.embeddings.create(model=self.deployment, input=inputs)
+            except RateLimitError as e:
+                error = e
+                self.release(retry_after=retry_after_seconds(e.response.headers) or 2 ** attempt)
+                continue
+            except (APIConnectionError, InternalServerError) as e:
+                error = e
+                self.release()
+                time.sleep(2 ** attempt * (1 + random.uniform(0, 0.25)))
+                continue
+            except Exception:
+                self.release()
+                raise
+            self.release(succeeded=True)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        raise Exception(f"Error getting embeddings from deployment {self.deployment} after {self.max_retries} attempts: {error}")
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.blocked_until - time.monotonic()
+                if wait <= 0 and self.active < self.limit:
+                    break
+                self.condition.wait(wait if wait > 0 else None)
+            self.active += 1
+            self.requests += 1
+
+    def release(self, succeeded: bool = False, retry_after: Optional[float] = None):
+        with self.condition:
+            self.active -= 1
+            if retry_after is not None:
+                ## throttled: everyone waits out the Retry-After, with jitter, and fewer requests go out at once
+                self.throttled += 1
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after * (1 + random.uniform(0, 0.25)))
+                self.limit = max(1, self.limit // 2)
+            elif succeeded and self.limit < self.max_concurrency:
+                self.limit += 1
+            self.condition.notify_all()
+
+
+_embedding_engines = {}
+_embedding_engines_lock = threading.Lock()
+
+def get_embedding_engine(embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None) -> EmbeddingEngine:
+    """The process-wide EmbeddingEngine for an endpoint, so every file and worker thread shares one client."""
+    endpoint = embedding_model_endpoint if embedding_model_endpoint else os.environ.get("EMBEDDING_MODEL_ENDPOINT")
+    key = embedding_model_key if embedding_model_key else os.environ.get("EMBEDDING_MODEL_KEY")
 
-        embeddings = client.embeddings.create(deployment_id=deployment_id, input=text)
-        return embeddings.data[0].embedding
+    if azure_credential is None and (endpoint is None or key is None):
+        raise Exception("EMBEDDING_MODEL_ENDPOINT and EMBEDDING_MODEL_KEY are required for embedding")
 
+    # worker processes receive a fresh copy of the credential with every file, so it is not part of the key
+    engine_key = (endpoint, key, azure_credential is not None)
+    with _embedding_engines_lock:
+        engine = _embedding_engines.get(engine_key)
+        if engine is None:
+            cache = EmbeddingCache(EMBEDDING_CACHE_PATH) if EMBEDDING_CACHE_PATH else None
+            engine = _embedding_engines[engine_key] = EmbeddingEngine(endpoint, key, azure_credential, cache=cache)
+        return engine
+
+
+def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None):
+    engine = get_embedding_engine(embedding_model_endpoint, embedding_model_key, azure_credential)
+    try:
+        return engine.embed([text])[0]
     except Exception as e:
-        raise Exception(f"Error getting embeddings with endpoint={endpoint} with error={e}")
+        raise Exception(f"Error getting embeddings with endpoint={embedding_model_endpoint} with error={e}")
+
+
+def add_embeddings_to_chunks(chunks: List[Document], embedding_model_endpoint=None, embedding_model_key=None, azure_credential=None) -> int:
+    """Sets contentVector on every chunk, in as few requests as the batch limits allow.
+    Returns how many of the vectors came from the embedding cache.
+    """
+    if not chunks:
+        return 0
+    engine = get_embedding_engine(embedding_model_endpoint, embedding_model_key, azure_credential)
+    hits = engine.cache.hits if engine.cache else 0
+    vectors = engine.embed([chunk.content for chunk in chunks])
+    for chunk, vector in zip(chunks, vectors):
+        chunk.contentVector = vector
+    return engine.cache.hits - hits if engine.cache else 0
 
 
 def chunk_content_helper(
@@ -728,29 +1045,20 @@ def chunk_content(
         )
         chunks = []
         skipped_chunks = 0
+        embedding_cache_hits = 0
         for chunk, chunk_size, doc in chunked_context:
             if chunk_size >= min_chunk_size:
-                if add_embeddings:
-                    for _ in range(RETRY_COUNT):
-                        try:
-                            doc.contentVector = get_embedding(chunk, azure_credential=azure_credential, embedding_model_endpoint=embedding_endpoint)
-                            break
-                        except:
-                            time.sleep(30)
-                    if doc.contentVector is None:
-                        raise Exception(f"Error getting embedding for chunk={chunk}")
-                    
-
                 chunks.append(
                     Document(
                         content=chunk,
                         title=doc.title,
-                        url=url,
-                        contentVector=doc.contentVector
+                        url=url
                     )
                 )
             else:
                 skipped_chunks += 1
+        if add_embeddings:
+            embedding_cache_hits = add_embeddings_to_chunks(chunks, embedding_endpoint, azure_credential=azure_credential)
 
     except UnsupportedFormatError as e:
         if ignore_errors:
@@ -768,6 +1076,7 @@ def chunk_content(
         chunks=chunks,
         total_files=1,
         skipped_chunks=skipped_chunks,
+        embedding_cache_hits=embedding_cache_hits,
     )
 
 def chunk_file(
@@ -847,7 +1156,8 @@ def process_file(
         use_layout = False,
         add_embeddings = False,
         azure_credential = None,
-        embedding_endpoint = None
+        embedding_endpoint = None,
+        source_name: str = ""
     ):
 
     if not form_recognizer_client:
@@ -876,6 +1186,7 @@ def process_file(
             embedding_endpoint=embedding_endpoint
         )
         for chunk_idx, chunk_doc in enumerate(result.chunks):
+            chunk_doc.id = stable_chunk_id(source_name, rel_file_path, chunk_idx, chunk_doc.content)
             chunk_doc.filepath = rel_file_path
             chunk_doc.metadata = json.dumps({"chunk_id": str(chunk_idx)})
     except Exception as e:
@@ -901,15 +1212,61 @@ def chunk_blob_container(
         njobs=4,
         add_embeddings = False,
         azure_credential = None,
-        embedding_endpoint = None
+        embedding_endpoint = None,
+        manifest: Optional[IndexManifest] = None,
+        source_name: Optional[str] = None
 ):
+    result = ChunkingResult(chunks=[], total_files=0)
+    result.chunks.extend(iter_blob_container_chunks(
+        blob_url,
+        credential,
+        result,
+        ignore_errors=ignore_errors,
+        num_tokens=num_tokens,
+        min_chunk_size=min_chunk_size,
+        url_prefix=url_prefix,
+        token_overlap=token_overlap,
+        extensions_to_process=extensions_to_process,
+        form_recognizer_client=form_recognizer_client,
+        use_layout=use_layout,
+        njobs=njobs,
+        add_embeddings=add_embeddings,
+        azure_credential=azure_credential,
+        embedding_endpoint=embedding_endpoint,
+        manifest=manifest,
+        source_name=source_name
+    ))
+    return result
+
+
+def iter_blob_container_chunks(
+        blob_url: str,
+        credential,
+        result: ChunkingResult,
+        ignore_errors: bool = True,
+        num_tokens: int = 1024,
+        min_chunk_size: int = 10,
+        url_prefix = None,
+        token_overlap: int = 0,
+        extensions_to_process: List[str] = list(FILE_FORMAT_DICT.keys()),
+        form_recognizer_client = None,
+        use_layout = False,
+        njobs=4,
+        add_embeddings = False,
+        azure_credential = None,
+        embedding_endpoint = None,
+        manifest: Optional[IndexManifest] = None,
+        source_name: Optional[str] = None
+) -> Generator[Document, None, None]:
+    """Downloads the blob container and yields its chunks like iter_directory_chunks."""
     with tempfile.TemporaryDirectory() as local_data_folder:
         print(f'Downloading {blob_url} to local folder')
         downloadBlobUrlToLocalFolder(blob_url, local_data_folder, credential)
         print(f'Downloaded.')
 
-        result = chunk_directory(
+        yield from iter_directory_chunks(
             local_data_folder,
+            result,
             ignore_errors=ignore_errors,
             num_tokens=num_tokens,
             min_chunk_size=min_chunk_size,
@@ -921,11 +1278,11 @@ def chunk_blob_container(
             njobs=njobs,
             add_embeddings=add_embeddings,
             azure_credential=azure_credential,
-            embedding_endpoint=embedding_endpoint
+            embedding_endpoint=embedding_endpoint,
+            manifest=manifest,
+            source_name=blob_url if source_name is None else source_name
         )
 
-    return result
-
 
 def chunk_directory(
         directory_path: str,
@@ -940,7 +1297,9 @@ def chunk_directory(
         njobs=4,
         add_embeddings = False,
         azure_credential = None,
-        embedding_endpoint = None
+        embedding_endpoint = None,
+        manifest: Optional[IndexManifest] = None,
+        source_name: str = ""
 ):
     """
     Chunks the given directory recursively
@@ -957,39 +1316,104 @@ def chunk_directory(
         form_recognizer_client: Optional form recognizer client to use for pdf files.
         use_layout (bool): If true, uses Layout model for pdf files. Otherwise, uses Read.
         add_embeddings (bool): If true, adds a vector embedding to each chunk using the embedding model endpoint and key.
+        manifest (IndexManifest): If given, only files that are new or changed since the run that saved it are chunked,
+                            and the ids of chunks from changed or removed files are returned in deleted_chunk_ids.
+        source_name (str): Names the data source in chunk ids and in the manifest, e.g. the configured data path,
+                            so that files with the same relative path in different sources do not collide.
 
     Returns:
         List[Document]: List of chunked documents.
     """
-    chunks = []
-    total_files = 0
-    num_unsupported_format_files = 0
-    num_files_with_errors = 0
-    skipped_chunks = 0
+    result = ChunkingResult(chunks=[], total_files=0)
+    result.chunks.extend(iter_directory_chunks(
+        directory_path,
+        result,
+        ignore_errors=ignore_errors,
+        num_tokens=num_tokens,
+        min_chunk_size=min_chunk_size,
+        url_prefix=url_prefix,
+        token_overlap=token_overlap,
+        extensions_to_process=extensions_to_process,
+        form_recognizer_client=form_recognizer_client,
+        use_layout=use_layout,
+        njobs=njobs,
+        add_embeddings=add_embeddings,
+        azure_credential=azure_credential,
+        embedding_endpoint=embedding_endpoint,
+        manifest=manifest,
+        source_name=source_name
+    ))
+    return result
+
+
+def iter_directory_chunks(
+        directory_path: str,
+        result: ChunkingResult,
+        ignore_errors: bool = True,
+        num_tokens: int = 1024,
+        min_chunk_size: int = 10,
+        url_prefix = None,
+        token_overlap: int = 0,
+        extensions_to_process: List[str] = list(FILE_FORMAT_DICT.keys()),
+        form_recognizer_client = None,
+        use_layout = False,
+        njobs=4,
+        add_embeddings = False,
+        azure_credential = None,
+        embedding_endpoint = None,
+        manifest: Optional[IndexManifest] = None,
+        source_name: str = ""
+) -> Generator[Document, None, None]:
+    """
+    Chunks the given directory recursively like chunk_directory, but yields the chunks file by file
+    instead of collecting them, so they can be uploaded while later files are still being chunked.
+    With njobs > 1 at most FILES_IN_FLIGHT_PER_JOB files per process are chunked ahead of the consumer,
+    which keeps memory bounded however large the directory is.
+    Args:
+        result (ChunkingResult): Receives the counts and deleted_chunk_ids as files are processed; its chunks stay empty.
+            The counts are complete once the generator is exhausted.
+        The other arguments are those of chunk_directory.
 
+    Yields:
+        Document: The chunks, in file order.
+    """
     all_files_directory = get_files_recursively(directory_path)
     files_to_process = [file_path for file_path in all_files_directory if os.path.isfile(file_path)]
+    if manifest is not None:
+        files_to_process, unchanged_files, removed_files = manifest.plan(source_name, directory_path, files_to_process)
+        result.num_unchanged_files += len(unchanged_files)
+        for rel_file_path in removed_files:
+            result.deleted_chunk_ids.extend(manifest.forget(source_name, rel_file_path))
+        print(f"{len(unchanged_files)} files unchanged and {len(removed_files)} files removed since the last run")
     print(f"Total files to process={len(files_to_process)} out of total directory size={len(all_files_directory)}")
 
+    def file_chunks(file_path, file_result, is_error):
+        result.total_files += 1
+        if is_error:
+            result.num_files_with_errors += 1
+            return []
+        # files that failed keep their previous chunks and are retried on the next run
+        if manifest is not None and not file_result.num_files_with_errors:
+            result.deleted_chunk_ids.extend(manifest.record(source_name, os.path.relpath(file_path, directory_path), [chunk.id for chunk in file_result.chunks]))
+        result.num_unsupported_format_files += file_result.num_unsupported_format_files
+        result.num_files_with_errors += file_result.num_files_with_errors
+        result.skipped_chunks += file_result.skipped_chunks
+        result.embedding_cache_hits += file_result.embedding_cache_hits
+        result.num_chunks += len(file_result.chunks)
+        return file_result.chunks
+
 
     if njobs==1:
         print("Single process to chunk and parse the files. --njobs > 1 can help performance.")
         for file_path in tqdm(files_to_process):
-            total_files += 1
-            result, is_error = process_file(file_path=file_path,directory_path=directory_path, ignore_errors=ignore_errors,
+            file_result, is_error = process_file(file_path=file_path,directory_path=directory_path, ignore_errors=ignore_errors,
                                        num_tokens=num_tokens,
                                        min_chunk_size=min_chunk_size, url_prefix=url_prefix,
                                        token_overlap=token_overlap,
                                        extensions_to_process=extensions_to_process,
                                        form_recognizer_client=form_recognizer_client, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint)
-            if is_error:
-                num_files_with_errors += 1
-                continue
-            chunks.extend(result.chunks)
-            num_unsupported_format_files += result.num_unsupported_format_files
-            num_files_with_errors += result.num_files_with_errors
-            skipped_chunks += result.skipped_chunks
+                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint, source_name=source_name)
+            yield from file_chunks(file_path, file_result, is_error)
     elif njobs > 1:
         print(f"Multiprocessing with njobs={njobs}")
         process_file_partial = partial(process_file, directory_path=directory_path, ignore_errors=ignore_errors,
@@ -998,26 +1422,28 @@ def chunk_directory(
                                        token_overlap=token_overlap,
                                        extensions_to_process=extensions_to_process,
                                        form_recognizer_client=None, use_layout=use_layout, add_embeddings=add_embeddings,
-                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint)
-        with ProcessPoolExecutor(max_workers=njobs) as executor:
-            futures = list(tqdm(executor.map(process_file_partial, files_to_process), total=len(files_to_process)))
-            for result, is_error in futures:
-                total_files += 1
-                if is_error:
-                    num_files_with_errors += 1
-                    continue
-                chunks.extend(result.chunks)
-                num_unsupported_format_files += result.num_unsupported_format_files
-                num_files_with_errors += result.num_files_with_errors
-                skipped_chunks += result.skipped_chunks
-
-    return ChunkingResult(
-            chunks=chunks,
-            total_files=total_files,
-            num_unsupported_format_files=num_unsupported_format_files,
-            num_files_with_errors=num_files_with_errors,
-            skipped_chunks=skipped_chunks,
-        )
+                                       azure_credential=azure_credential, embedding_endpoint=embedding_endpoint, source_name=source_name)
+        files = iter(files_to_process)
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=njobs) as executor, tqdm(total=len(files_to_process)) as progress:
+            try:
+                while True:
+                    # only submit a file when there is room, rather than all of them up front like executor.map
+                    while len(pending) < njobs * FILES_IN_FLIGHT_PER_JOB:
+                        file_path = next(files, None)
+                        if file_path is None:
+                            break
+                        pending.append((file_path, executor.submit(process_file_partial, file_path)))
+                    if not pending:
+                        break
+                    file_path, future = pending.popleft()
+                    file_result, is_error = future.result()
+                    progress.update()
+                    yield from file_chunks(file_path, file_result, is_error)
+            finally:
+                # the consumer stopped early, e.g. on a failed upload: do not chunk the files still queued
+                for _, future in pending:
+                    future.cancel()
 
 
 class SingletonFormRecognizerClient:
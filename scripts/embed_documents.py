@@ -1,13 +1,14 @@
 import argparse
-from asyncio import sleep
+import itertools
 import json
 
 from azure.identity import DefaultAzureCredential
 from azure.keyvault.secrets import SecretClient
 
-from data_utils import get_embedding
+from data_utils import get_embedding_engine
 
-RETRY_COUNT = 5
+# Documents read, embedded and written at a time
+EMBED_BATCH_DOCUMENTS = 256
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -48,20 +49,18 @@ if __name__ == "__main__":
 
         # Embed documents
         print("Generating embeddings...")
+        engine = get_embedding_engine(embedding_endpoint, embedding_key)
         with open(args.input_data_path) as input_file, open(args.output_file_path, "w") as output_file:
-            for line in input_file:
-                document = json.loads(line)
-                # Sleep/Retry in case embedding model is rate limited.
-                for _ in range(RETRY_COUNT):
-                    try:
-                        embedding = get_embedding(document["content"], embedding_endpoint,  embedding_key)
-                        document["contentVector"] = embedding
-                        break
-                    except:
-                        print("Error generating embedding. Retrying...")
-                        sleep(30)
-                
-                output_file.write(json.dumps(document) + "\n")
+            # The engine packs each group into a few requests and backs off when rate limited
+            while lines := list(itertools.islice(input_file, EMBED_BATCH_DOCUMENTS)):
+                documents = [json.loads(line) for line in lines]
+                vectors = engine.embed([document["content"] for document in documents])
+                for document, vector in zip(documents, vectors):
+                    document["contentVector"] = vector
+                    output_file.write(json.dumps(document) + "\n")
+        print(f"Sent {engine.requests} embedding requests, {engine.throttled} of them throttled.")
+        if engine.cache:
+            print(engine.cache.report())
 
         print("Embeddings generated and saved to {}.".format(args.output_file_path))
 
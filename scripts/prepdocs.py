@@ -23,7 +23,7 @@ from azure.search.documents import SearchClient
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
 
-from data_utils import chunk_directory
+from data_utils import ChunkingResult, IndexManifest, iter_directory_chunks
 
 
 def create_search_index(index_name, index_client):
@@ -75,38 +75,52 @@ def create_search_index(index_name, index_client):
         print(f"Search index {index_name} already exists")
 
 
-def upload_documents_to_index(docs, search_client, upload_batch_size=50):
-    to_upload_dicts = []
+def upload_batch(batch, search_client):
+    results = search_client.upload_documents(documents=batch)
+    num_failures = 0
+    errors = set()
+    for result in results:
+        if not result.succeeded:
+            print(
+                f"Indexing Failed for {result.key} with ERROR: {result.error_message}"
+            )
+            num_failures += 1
+            errors.add(result.error_message)
+    if num_failures > 0:
+        raise Exception(
+            f"INDEXING FAILED for {num_failures} documents. Please recreate the index."
+            f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}"
+        )
 
+
+def upload_documents_to_index(docs, search_client, upload_batch_size=50):
+    # docs may be a stream of chunks: only one batch is held at a time
+    batch = []
     id = 0
-    for document in docs:
+    for document in tqdm(docs, desc="Indexing Chunks...", unit="chunk"):
         d = dataclasses.asdict(document)
-        # add id to documents
-        d.update({"@search.action": "upload", "id": str(id)})
+        # keep the stable chunk id, so a re-run replaces the chunk instead of another one
+        d.update({"@search.action": "upload", "id": d.get("id") or str(id)})
         if "contentVector" in d and d["contentVector"] is None:
             del d["contentVector"]
-        to_upload_dicts.append(d)
+        batch.append(d)
         id += 1
+        if len(batch) == upload_batch_size:
+            upload_batch(batch, search_client)
+            batch = []
+    if batch:
+        upload_batch(batch, search_client)
+    return id
 
-    # Upload the documents in batches of upload_batch_size
-    for i in tqdm(
-        range(0, len(to_upload_dicts), upload_batch_size), desc="Indexing Chunks..."
-    ):
-        batch = to_upload_dicts[i : i + upload_batch_size]
-        results = search_client.upload_documents(documents=batch)
-        num_failures = 0
-        errors = set()
-        for result in results:
-            if not result.succeeded:
-                print(
-                    f"Indexing Failed for {result.key} with ERROR: {result.error_message}"
-                )
-                num_failures += 1
-                errors.add(result.error_message)
-        if num_failures > 0:
+
+def delete_documents_from_index(ids, search_client, delete_batch_size=1000):
+    for i in tqdm(range(0, len(ids), delete_batch_size), desc="Deleting Chunks..."):
+        batch = [{"id": id} for id in ids[i : i + delete_batch_size]]
+        results = search_client.delete_documents(documents=batch)
+        failures = [result for result in results if not result.succeeded and result.status_code != 404]
+        if failures:
             raise Exception(
-                f"INDEXING FAILED for {num_failures} documents. Please recreate the index."
-                f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}"
+                f"DELETING FAILED for {len(failures)} documents. Error Messages: {list({result.error_message for result in failures})}"
             )
 
 
@@ -127,35 +141,48 @@ def validate_index(index_name, index_client):
 
 
 def create_and_populate_index(
-    index_name, index_client, search_client, form_recognizer_client, azure_credential, embedding_endpoint
+    index_name, index_client, search_client, form_recognizer_client, azure_credential, embedding_endpoint, manifest_path=None
 ):
     # create or update search index with compatible schema
     create_search_index(index_name, index_client)
 
-    # chunk directory
-    print("Chunking directory...")
-    result = chunk_directory(
+    # with a manifest, only new and changed files are ingested and chunks of changed or removed files are deleted
+    manifest = IndexManifest(manifest_path) if manifest_path else None
+
+    # chunk directory, uploading the chunks while later files are still being chunked
+    print("Chunking directory and uploading documents to index...")
+    result = ChunkingResult(chunks=[], total_files=0)
+    chunks = iter_directory_chunks(
         "./data",
+        result,
         form_recognizer_client=form_recognizer_client,
         use_layout=True,
         ignore_errors=False,
         njobs=1,
         add_embeddings=True,
         azure_credential=azd_credential,
-        embedding_endpoint=embedding_endpoint
+        embedding_endpoint=embedding_endpoint,
+        manifest=manifest
     )
+    upload_documents_to_index(chunks, search_client)
 
-    if len(result.chunks) == 0:
+    if result.num_chunks == 0 and not (manifest and result.num_unchanged_files):
         raise Exception("No chunks found. Please check the data path and chunk size.")
 
     print(f"Processed {result.total_files} files")
+    if manifest:
+        print(f"Unchanged since the last run: {result.num_unchanged_files} files")
     print(f"Unsupported formats: {result.num_unsupported_format_files} files")
     print(f"Files with errors: {result.num_files_with_errors} files")
-    print(f"Found {len(result.chunks)} chunks")
+    print(f"Found {result.num_chunks} chunks")
+    if result.embedding_cache_hits:
+        print(f"Embeddings for {result.embedding_cache_hits} chunks came from the embedding cache")
 
-    # upload documents to index
-    print("Uploading documents to index...")
-    upload_documents_to_index(result.chunks, search_client)
+    if result.deleted_chunk_ids:
+        print(f"Deleting {len(result.deleted_chunk_ids)} chunks of changed or removed files...")
+        delete_documents_from_index(result.deleted_chunk_ids, search_client)
+    if manifest:
+        manifest.save()
 
     # check if index is ready/validate index
     print("Validating index...")
@@ -201,6 +228,11 @@ if __name__ == "__main__":
         required=False,
         help="Optional. Use this OpenAI endpoint to generate embeddings for the documents",
     )
+    parser.add_argument(
+        "--manifest",
+        required=False,
+        help="Optional. File recording what was indexed; later runs then only index new and changed files and delete chunks of removed ones",
+    )
     args = parser.parse_args()
 
     # Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
@@ -231,6 +263,6 @@ if __name__ == "__main__":
         credential=formrecognizer_creds,
     )
     create_and_populate_index(
-        args.index, index_client, search_client, form_recognizer_client, azd_credential, args.embeddingendpoint
+        args.index, index_client, search_client, form_recognizer_client, azd_credential, args.embeddingendpoint, args.manifest
     )
     print("Data preparation for index", args.index, "completed")
@@ -0,0 +1,23 @@
+import threading
+import time
+
+import pytest
+
+from backend.aoai.admission import AdmissionController, AdmissionRejected
+
+
+def test_full_queue_is_rejected_with_a_retry_hint():
+    controller = AdmissionController(max_concurrency=1, max_queue=1, max_wait=0.5)
+    held = controller.admit("gpt-4", cost=100)
+
+    waiter = threading.Thread(target=lambda: controller.admit("gpt-4", cost=100).release())
+    waiter.start()
+    time.sleep(0.05)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit("gpt-4", cost=100)
+    assert rejected.value.retry_after_header == "1"
+
+    held.release()
+    waiter.join()
+    assert controller.stats()["gpt-4"] == {"active": 0, "waiting": 0}
+
@@ -1,6 +1,66 @@
-from app import format_as_ndjson
+import json
+from types import SimpleNamespace
+
+import app as app_module
+from app import app, build_stream_response_with_data, deployment_router, format_as_ndjson, format_stream_chunk_without_data
+from backend.aoai.streaming import SSEParser, relay_stream
 
 
 def test_format_as_ndjson():
     obj = {"message": "I ❤️ 🐍 \n and escaped newlines"}
     assert format_as_ndjson(obj) == '{"message": "I ❤️ 🐍 \\n and escaped newlines"}\n'
+
+
+def test_stream_relay_fast_path_matches_full_parse():
+    frames = [
+        {"id": "1", "model": "gpt-4", "created": 1, "object": "chunk", "choices": [{"index": 0, "delta": {"role": "assistant"}, "end_turn": False}]},
+        {"id": "1", "model": "gpt-4", "created": 1, "object": "chunk", "choices": [{"index": 0, "delta": {"content": "Hi \"there\" ❤️\n"}, "end_turn": False}]},
+        {"id": "1", "model": "gpt-4", "created": 1, "object": "chunk", "choices": [{"index": 0, "delta": {"content": ""}, "end_turn": True}]},
+    ]
+    body = b"".join(b"data: " + json.dumps(f, separators=(",", ":")).encode() + b"\n\n" for f in frames) + b"data: [DONE]\n\n"
+    history_metadata = {"conversation_id": "abc"}
+
+    def build(data):
+        return build_stream_response_with_data(data, history_metadata)
+
+    # feed the body in awkward slices to exercise frame reassembly
+    chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+    relayed = [json.loads(line) for line in relay_stream(chunks, build)]
+    parsed = [json.loads(format_as_ndjson(r)) for r in map(build, SSEParser().feed(body)) if r]
+    assert relayed == parsed
+    assert relayed[1]["choices"][0]["messages"][0]["content"] == "Hi \"there\" ❤️\n"
+
+
+def test_answers_carry_the_message_id_of_their_own_request():
+    ## concurrent /history/generate requests each stamp their answer with their own id
+    frame = {"id": "upstream", "model": "gpt-4", "created": 1, "object": "chunk",
+             "choices": [{"index": 0, "delta": {"content": "Hi"}, "end_turn": False}]}
+    data = json.dumps(frame).encode()
+    first, second = {"message_id": "first"}, {"message_id": "second"}
+    assert build_stream_response_with_data(data, first)["id"] == "first"
+    assert build_stream_response_with_data(data, second)["id"] == "second"
+
+    chunk = SimpleNamespace(model="gpt-4", created=1, object="chunk", choices=[SimpleNamespace(delta=SimpleNamespace(content="Hi"))])
+    assert json.loads(format_stream_chunk_without_data(chunk, first))["id"] == "first"
+    assert json.loads(format_stream_chunk_without_data(chunk, {}))["id"] == ""
+
+
+def test_unknown_model_is_a_bad_request():
+    client = app.test_client()
+    response = client.post("/conversation", json={"model": "made-up-model", "messages": [{"role": "user", "content": "Hi"}]})
+    assert response.status_code == 400
+    assert "made-up-model" in response.json["error"]
+    assert "made-up-model" not in deployment_router.pools
+
+
+def test_metrics_need_the_token_when_one_is_set(monkeypatch):
+    client = app.test_client()
+    monkeypatch.setattr(app_module, "METRICS_ENABLED", False)
+    assert client.get("/metrics").status_code == 404
+
+    monkeypatch.setattr(app_module, "METRICS_ENABLED", True)
+    monkeypatch.setattr(app_module, "METRICS_TOKEN", "secret")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200 and b"http_request_seconds" in response.data
@@ -0,0 +1,58 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+import asgi
+from asgi import ChatApp, app
+
+
+def test_non_async_routes_fall_back_to_flask():
+    async def request():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.get("/history/ensure")
+
+    response = asyncio.run(request())
+    assert response.status_code == 404
+    assert response.json() == {"error": "CosmosDB is not configured"}
+
+
+def test_flask_fallback_serves_concurrent_requests():
+    def slow_wsgi_app(environ, start_response):
+        time.sleep(0.2)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [environ["PATH_INFO"].encode()]
+
+    async def requests():
+        transport = httpx.ASGITransport(app=ChatApp(slow_wsgi_app))
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await asyncio.gather(*(client.get(f"/history/{i}") for i in range(16)))
+
+    started = time.monotonic()
+    responses = asyncio.run(requests())
+    ## one shared WSGI thread would take 16 x 0.2s, and could deadlock
+    assert time.monotonic() - started < 1.5
+    assert [r.text for r in responses] == [f"/history/{i}" for i in range(16)]
+
+
+def test_error_after_the_answer_started_ends_the_stream(monkeypatch):
+    async def failing_answer(send, request_body, model, title_task=None):
+        async def chunks():
+            yield '{"choices": []}\n'
+            raise RuntimeError("upstream went away")
+        await asgi.send_stream(send, chunks())
+
+    monkeypatch.setattr(asgi.wsgi, "should_use_data", lambda: False)
+    monkeypatch.setattr(asgi, "conversation_without_data", failing_answer)
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.conversation_internal(send, None, {}, None))
+    ## one response: its status line, the chunk that streamed, an error line and the end of the body
+    assert [m["type"] for m in sent].count("http.response.start") == 1
+    assert json.loads(sent[-2]["body"]) == {"error": "upstream went away"}
+    assert sent[-1] == {"type": "http.response.body", "body": b""}
@@ -0,0 +1,37 @@
+import threading
+import time
+
+from backend.cache import TTLCache
+
+
+def test_concurrent_misses_share_one_load():
+    cache = TTLCache(max_entries=2, ttl=60)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return {"group-a", "group-b"}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("user", loader))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert all(r == {"group-a", "group-b"} for r in results)
+    assert cache.get("user", loader) == {"group-a", "group-b"}
+    assert cache.stats()["hits"] == 1
+
+
+def test_entries_expire_and_evict_least_recently_used():
+    cache = TTLCache(max_entries=2, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("c", 3)
+    assert cache.peek("a") is None
+    assert cache.peek("c") == 3
+    time.sleep(0.06)
+    assert cache.peek("c") is None
@@ -0,0 +1,27 @@
+from backend.aoai.client_pool import AzureOpenAIClientPool
+
+
+def test_clients_are_reused_per_deployment():
+    pool = AzureOpenAIClientPool(api_key="key")
+    first = pool.get_client("https://example.openai.azure.com/", "gpt-4", "2024-02-01")
+    second = pool.get_client("https://example.openai.azure.com/", "gpt-4", "2024-02-01")
+    other = pool.get_client("https://example.openai.azure.com/", "gpt-35-turbo", "2024-02-01")
+
+    assert first is second
+    assert other is not first
+    assert other._client is first._client
+    assert pool.stats() == {"clients": 2, "hits": 1, "misses": 2, "evictions": 0}
+    pool.close()
+
+
+def test_pool_keeps_only_the_most_recently_used_clients():
+    pool = AzureOpenAIClientPool(api_key="key", max_clients=2)
+    first = pool.get_client("https://example.openai.azure.com/", "gpt-4", "2024-02-01")
+    pool.get_client("https://example.openai.azure.com/", "gpt-35-turbo", "2024-02-01")
+    assert pool.get_client("https://example.openai.azure.com/", "gpt-4", "2024-02-01") is first
+    pool.get_client("https://example.openai.azure.com/", "gpt-4o", "2024-02-01")
+
+    ## gpt-35-turbo was used least recently, so it made room for gpt-4o
+    assert pool.get_client("https://example.openai.azure.com/", "gpt-4", "2024-02-01") is first
+    assert pool.stats() == {"clients": 2, "hits": 2, "misses": 3, "evictions": 1}
+    pool.close()
@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+## the ingestion scripts import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+
+import data_utils
+from data_utils import (FILES_IN_FLIGHT_PER_JOB, TOKEN_ESTIMATOR, ChunkingResult, Document, EmbeddingCache, EmbeddingEngine,
+                        IndexManifest, iter_directory_chunks, stable_chunk_id)
+
+ENDPOINT = "https://contoso.openai.azure.com/openai/deployments/ada/embeddings?api-version=2023-05-15"
+
+
+class FakeEmbeddings():
+    """Answers embeddings.create with the length of each input, throttling the calls listed in `throttle`."""
+
+    def __init__(self, throttle=()):
+        self.throttle = set(throttle)
+        self.calls = []
+
+    def create(self, model, input):
+        self.calls.append((time.monotonic(), list(input)))
+        if len(self.calls) in self.throttle:
+            response = httpx.Response(429, headers={"retry-after-ms": "200"}, request=httpx.Request("POST", ENDPOINT))
+            raise openai.RateLimitError("Too Many Requests", response=response, body=None)
+        ## the service may list the embeddings out of order
+        data = [SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)]
+        return SimpleNamespace(data=list(reversed(data)))
+
+
+def fake_engine(throttle=(), **kwargs):
+    engine = EmbeddingEngine(ENDPOINT, key="key", **kwargs)
+    engine.client = SimpleNamespace(embeddings=FakeEmbeddings(throttle))
+    return engine
+
+
+def test_embedding_requests_respect_batch_limits_and_back_off_on_429():
+    texts = [f"chunk {i} " + "word " * (i % 7) * 20 for i in range(20)]
+    batch_tokens = max(TOKEN_ESTIMATOR.estimate_tokens(text) for text in texts) * 2
+    engine = fake_engine(throttle=[1], batch_size=4, batch_tokens=batch_tokens, max_concurrency=1)
+
+    vectors = engine.embed(texts)
+
+    assert vectors == [[float(len(text))] for text in texts]
+    calls = engine.client.embeddings.calls
+    sent = [inputs for _, inputs in calls[1:]]
+    assert [text for inputs in sent for text in inputs] == texts
+    for inputs in sent:
+        assert len(inputs) <= 4
+        assert len(inputs) == 1 or sum(TOKEN_ESTIMATOR.estimate_tokens(text) for text in inputs) <= batch_tokens
+    ## the throttled batch is retried after the service's Retry-After, and counted
+    assert calls[1][1] == calls[0][1]
+    assert calls[1][0] - calls[0][0] >= 0.2
+    assert (engine.throttled, engine.requests) == (1, len(calls))
+
+
+def test_embedding_cache_counts_hits_misses_and_evictions(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.db"), max_entries=10)
+    engine = fake_engine(cache=cache)
+
+    engine.embed(["alpha", "beta"])
+    ## whitespace and unicode normalization do not change the key
+    assert engine.embed(["alpha ", "beta", "gamma"]) == [[5.0], [4.0], [5.0]]
+    assert [inputs for _, inputs in engine.client.embeddings.calls] == [["alpha", "beta"], ["gamma"]]
+    assert (cache.hits, cache.misses) == (2, 3)
+
+    ## alpha was used last, so it outlives the others once the cache overflows
+    time.sleep(0.01)
+    cache.get_many(engine.model, ["alpha"])
+    time.sleep(0.01)
+    cache.put_many(engine.model, [f"text {i}" for i in range(8)], [[float(i)] for i in range(8)])
+    ## 11 entries: the one over the limit goes, and a tenth of the limit more
+    assert cache.evictions == 2 and cache.entries == 9
+    assert cache.get_many(engine.model, ["alpha", "beta", "gamma"]) == [[5.0], None, None]
+    assert "2 evicted" in cache.report()
+
+
+def test_manifest_plans_changed_unchanged_and_removed_files(tmp_path):
+    data = tmp_path / "data"
+    (data / "sub").mkdir(parents=True)
+    manifest_path = str(tmp_path / "manifest.json")
+    for name, text in (("a.txt", "alpha"), ("sub/b.txt", "beta"), ("c.txt", "gamma")):
+        (data / name).write_text(text)
+
+    def run():
+        manifest = IndexManifest(manifest_path)
+        files = sorted(str(path) for path in data.rglob("*") if path.is_file())
+        changed, unchanged, removed = manifest.plan("source", str(data), files)
+        deleted = [chunk_id for rel_file_path in removed for chunk_id in manifest.forget("source", rel_file_path)]
+        for file_path in changed:
+            rel_file_path = os.path.relpath(file_path, data)
+            chunk_ids = [stable_chunk_id("source", rel_file_path, i, word) for i, word in enumerate(open(file_path).read().split())]
+            deleted += manifest.record("source", rel_file_path, chunk_ids)
+        manifest.save()
+        return [os.path.relpath(file_path, data) for file_path in changed], len(unchanged), removed, deleted
+
+    assert run() == (["a.txt", "c.txt", os.path.join("sub", "b.txt")], 0, [], [])
+    assert run() == ([], 3, [], [])
+
+    ## an edited file, a removed one and one that was only touched
+    (data / "a.txt").write_text("alpha two")
+    (data / "c.txt").unlink()
+    os.utime(data / "sub" / "b.txt", (1, 1))
+    changed, unchanged, removed, deleted = run()
+    assert (changed, unchanged, removed) == (["a.txt"], 1, ["c.txt"])
+    ## the first chunk of a.txt did not change and keeps its id; c.txt's chunk goes
+    assert deleted == [stable_chunk_id("source", "c.txt", 0, "gamma")]
+    assert stable_chunk_id("source", "sub\\b.txt", 0, "beta") == stable_chunk_id("source", "sub/b.txt", 0, "beta")
+
+
+def slow_process_file(file_path, directory_path, source_name="", **kwargs):
+    ## leaves a mark for every file a worker starts on
+    open(file_path + ".started", "w").close()
+    time.sleep(0.05)
+    rel_file_path = os.path.relpath(file_path, directory_path)
+    chunks = [Document(content=rel_file_path, id=stable_chunk_id(source_name, rel_file_path, 0, rel_file_path))]
+    return ChunkingResult(chunks=chunks, total_files=1), False
+
+
+def test_streamed_chunks_stop_when_the_consumer_does(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_utils, "process_file", slow_process_file)
+    for i in range(20):
+        (tmp_path / f"{i:02}.txt").write_text(str(i))
+    started = lambda: len(list(tmp_path.glob("*.started")))
+
+    result = ChunkingResult(chunks=[], total_files=0)
+    chunks = iter_directory_chunks(str(tmp_path), result, njobs=2)
+    assert next(chunks).content.endswith(".txt")
+    ## a failed upload abandons the stream: queued files are cancelled instead of chunked
+    chunks.close()
+    assert started() <= 2 * FILES_IN_FLIGHT_PER_JOB
+    assert (result.total_files, result.num_chunks, result.chunks) == (1, 1, [])
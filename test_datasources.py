@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from backend.aoai.datasources import CompletionSettings, DataSourceTemplate
+
+COMPLETION = CompletionSettings.from_env(0, 1000, 1.0, "", "true")
+
+
+def test_request_bodies_do_not_share_the_template():
+    template = DataSourceTemplate("AzureCognitiveSearch", {"indexName": "docs", "filter": None,
+                                                           "fieldsMapping": {"contentFields": ["content"]}}, COMPLETION)
+    with pytest.raises(TypeError):
+        template.parameters["indexName"] = "other"
+
+    first = template.build([{"role": "user", "content": "hi"}])
+    first["dataSources"][0]["parameters"]["indexName"] = "other"
+    first["dataSources"][0]["parameters"]["fieldsMapping"]["contentFields"].append("title")
+    second = template.build([{"role": "user", "content": "hi"}], filter="group_ids/any(g:search.in(g, 'a'))")
+
+    assert second["dataSources"][0]["parameters"]["indexName"] == "docs"
+    assert second["dataSources"][0]["parameters"]["fieldsMapping"] == {"contentFields": ["content"]}
+    assert second["dataSources"][0]["parameters"]["filter"].startswith("group_ids")
+    assert template.parameters["filter"] is None
+
+
+@pytest.mark.parametrize("setting", ["AZURE_SEARCH_STRICTNESS", "AZURE_SEARCH_TOP_K"])
+def test_bad_data_source_setting_fails_at_startup(setting):
+    env = dict(os.environ, AZURE_SEARCH_SERVICE="search", AZURE_SEARCH_INDEX="docs", AZURE_SEARCH_KEY="key", **{setting: "high"})
+    result = subprocess.run([sys.executable, "-c", "import app"], cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode != 0
+    assert f"{setting} must be an integer, got 'high'" in result.stderr
@@ -0,0 +1,96 @@
+import time
+
+from backend.history import cosmosdbservice
+from backend.history.cosmosdbservice import CosmosConversationClient, encode_cursor
+from backend.cache import TTLCache
+from backend.history.bulk_delete import BulkDeleteJobs
+from loadtest.fake_cosmos import FakeCosmosClient
+
+
+def test_fake_cosmos_serves_the_conversation_client(monkeypatch):
+    monkeypatch.setattr(cosmosdbservice, "CosmosClient", FakeCosmosClient)
+    monkeypatch.setattr(FakeCosmosClient, "databases", {})
+    client = CosmosConversationClient("https://fake", "key", "db", "conversations", cache=TTLCache(max_entries=10, ttl=60), cache_fresh=0)
+
+    conversations = [client.create_conversation("user", f"chat {i}") for i in range(3)]
+    conversation_id = conversations[0]["id"]
+    client.create_messages(conversation_id, "user", [("m1", {"role": "user", "content": "hi"}),
+                                                     ("m2", {"role": "assistant", "content": "hello"})])
+
+    ## the batch bumped updatedAt, so the first conversation is now the newest
+    first_page = client.get_conversations("user", limit=2, fields=("id", "updatedAt"))
+    assert first_page[0]["id"] == conversation_id
+    cursor = {"updatedAt": first_page[-1]["updatedAt"], "ids": [first_page[-1]["id"]]}
+    second_page = client.get_conversations("user", limit=2, cursor=cursor, fields=("id", "updatedAt"))
+    assert {c["id"] for c in first_page + second_page} == {c["id"] for c in conversations}
+    assert encode_cursor(second_page)
+
+    ## a stale cache entry is revalidated with a conditional read
+    assert client.get_conversation("user", conversation_id)["id"] == conversation_id
+    assert client.get_messages("user", conversation_id, fields=("id", "content")) == [{"id": "m1", "content": "hi"}, {"id": "m2", "content": "hello"}]
+
+    assert client.delete_messages(conversation_id, "user") == 2
+    assert client.get_messages("user", conversation_id) == []
+
+
+def test_cached_messages_follow_feedback_and_clears_from_other_workers(monkeypatch):
+    monkeypatch.setattr(cosmosdbservice, "CosmosClient", FakeCosmosClient)
+    monkeypatch.setattr(FakeCosmosClient, "databases", {})
+    ## two workers on one database, each with its own cache; revalidate on every read
+    workers = [CosmosConversationClient("https://fake", "key", "db", "conversations", enable_message_feedback=True,
+                                        cache=TTLCache(max_entries=10, ttl=60), cache_fresh=0) for _ in range(2)]
+    reader, writer = workers
+    conversation_id = reader.create_conversation("user", "chat")["id"]
+    reader.create_messages(conversation_id, "user", [("m1", {"role": "assistant", "content": "hello"})])
+
+    def read(client):
+        client.get_conversation("user", conversation_id)
+        return client.get_messages("user", conversation_id, fields=("id", "feedback"))
+
+    ## what a caller does to the messages it gets must not reach the cached list
+    read(reader)[0]["feedback"] = "edited"
+    assert read(reader) == [{"id": "m1", "feedback": ""}]
+
+    writer.update_message_feedback("user", "m1", "positive")
+    assert read(reader) == [{"id": "m1", "feedback": "positive"}]
+
+    writer.delete_messages(conversation_id, "user")
+    assert read(reader) == []
+
+
+def test_delete_jobs_can_be_polled_on_any_worker(monkeypatch):
+    monkeypatch.setattr(cosmosdbservice, "CosmosClient", FakeCosmosClient)
+    monkeypatch.setattr(FakeCosmosClient, "databases", {})
+    clients = [CosmosConversationClient("https://fake", "key", "db", "conversations") for _ in range(2)]
+    starter, poller = [BulkDeleteJobs(store=client) for client in clients]
+    for i in range(3):
+        clients[0].create_conversation("user", f"chat {i}")
+
+    job = starter.submit("user", lambda progress: clients[0].delete_all_conversations("user", progress=progress))
+    starter.executor.shutdown(wait=True)
+
+    assert poller.get("user", job["job_id"]) == starter.get("user", job["job_id"])
+    assert poller.get("user", job["job_id"])["status"] == "succeeded"
+    assert poller.get("user", job["job_id"])["result"] == {"conversations": 3, "messages": 0}
+    ## the job document survives the deletion it reports on, and stays with its user
+    assert poller.get("other user", job["job_id"]) is None
+    assert clients[1].get_conversations("user", limit=10) == []
+
+
+def test_message_pages_are_timed_without_the_time_spent_relaying_them(monkeypatch):
+    monkeypatch.setattr(cosmosdbservice, "CosmosClient", FakeCosmosClient)
+    monkeypatch.setattr(FakeCosmosClient, "databases", {})
+    client = CosmosConversationClient("https://fake", "key", "db", "conversations")
+    conversation_id = client.create_conversation("user", "chat")["id"]
+    client.create_messages(conversation_id, "user", [(f"m{i}", {"role": "user", "content": str(i)}) for i in range(3)])
+
+    pages = []
+    for page in client.iter_messages("user", conversation_id, fields=("id",), page_size=1):
+        pages.append(page)
+        ## a slow client reading the streamed answer
+        time.sleep(0.1)
+
+    assert pages == [[{"id": "m0"}], [{"id": "m1"}], [{"id": "m2"}]]
+    stats = client.request_metrics.stats()["get_messages"]
+    assert (stats["calls"], stats["requests"]) == (3, 3) and stats["request_charge"] > 0
+    assert stats["duration"] < 0.1
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from backend.aoai.admission import AdmissionController, AdmissionRejected, UpstreamUnavailable, retry_after_seconds
+from backend.aoai.router import OPEN, ChatBackend, DeploymentRouter, UnknownModel
+
+
+def test_throttled_call_waits_for_retry_after():
+    router = DeploymentRouter(AdmissionController(max_retries=2, max_wait=5),
+                              default_backend=lambda model: ChatBackend(model, "https://aoai.example", model))
+    attempts = []
+
+    def send(backend):
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise UpstreamUnavailable(429, retry_after_seconds({"retry-after-ms": "200"}))
+        return "answer"
+
+    lease, result = router.call("gpt-4", 100, send)
+    lease.release()
+    assert result == "answer"
+    assert attempts[1] - attempts[0] >= 0.2
+
+
+def test_failing_backend_fails_over_and_leaves_rotation():
+    east = ChatBackend("gpt-4@east", "https://east.example", "gpt-4")
+    west = ChatBackend("gpt-4@west", "https://west.example", "gpt-4")
+    router = DeploymentRouter(AdmissionController(max_wait=5), pools={"gpt-4": [east, west]}, failure_threshold=1, cooldown=60)
+    east.ttft = 0.1  ## the faster region goes first
+    calls = []
+
+    def send(backend):
+        calls.append(backend.name)
+        if backend is east:
+            raise UpstreamUnavailable(503)
+        return "answer"
+
+    lease, result = router.call("gpt-4", 100, send)
+    assert (result, calls) == ("answer", ["gpt-4@east", "gpt-4@west"])
+    assert router.stats()["gpt-4@east"]["state"] == OPEN
+    lease.track(iter(["chunk"])).__next__()
+    lease.release()
+    assert west.ttft is not None and west.outstanding == 0
+
+    ## with its circuit open, east is skipped without being called
+    lease, _ = router.call("gpt-4", 100, send)
+    lease.release()
+    assert calls[2:] == ["gpt-4@west"]
+
+
+def test_failed_trial_call_does_not_keep_the_backend_out():
+    router = DeploymentRouter(AdmissionController(max_wait=0.5), failure_threshold=1, cooldown=0.1,
+                              default_backend=lambda model: ChatBackend(model, "https://aoai.example", model))
+    outcomes = [UpstreamUnavailable(503), ValueError("bad request body"), "answer"]
+
+    def send(backend):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    ## the 503 opens the circuit; once it is half-open the trial call fails without a retryable status
+    with pytest.raises(AdmissionRejected):
+        router.call("gpt-4", 100, send)
+    time.sleep(0.1)
+    with pytest.raises(ValueError):
+        router.call("gpt-4", 100, send)
+    backend = router.backends("gpt-4")[0]
+    assert not backend.trial and backend.outstanding == 0
+
+    lease, result = router.call("gpt-4", 100, send)
+    lease.release()
+    assert result == "answer"
+    assert router.stats()["gpt-4"]["state"] != OPEN
+
+
+def test_unknown_models_are_refused_without_a_new_pool():
+    router = DeploymentRouter(AdmissionController(max_wait=1), models=["gpt-4"],
+                              default_backend=lambda model: ChatBackend(model, "https://aoai.example", model))
+    lease, result = router.call("gpt-4", 100, lambda backend: backend.deployment)
+    lease.release()
+    assert result == "gpt-4"
+
+    with pytest.raises(UnknownModel):
+        router.call("made-up-model", 100, lambda backend: "answer")
+    assert list(router.pools) == ["gpt-4"] and not router.routes(None)
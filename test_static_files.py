@@ -0,0 +1,27 @@
+from backend.static_files import IMMUTABLE, REVALIDATE, StaticFiles, precompress
+
+
+def test_precompressed_variants_and_revalidation(tmp_path):
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "assets" / "index-87c2be60.js").write_text("console.log('chat');\n" * 200)
+    (tmp_path / "index.html").write_text("<html></html>")
+    assert precompress(str(tmp_path)) >= 1
+
+    for in_memory in (False, True):
+        static_files = StaticFiles(str(tmp_path), in_memory=in_memory)
+
+        status, headers, variant = static_files.select("assets/index-87c2be60.js", "gzip, deflate")
+        headers = dict(headers)
+        assert status == 200
+        assert headers["Content-Encoding"] == "gzip"
+        assert headers["Cache-Control"] == IMMUTABLE
+        assert headers["Vary"] == "Accept-Encoding"
+
+        status, _, variant = static_files.select("assets/index-87c2be60.js", "identity", headers["ETag"])
+        assert status == 304 and variant is None
+
+        status, headers, variant = static_files.select("index.html", "gzip")
+        assert status == 200 and dict(headers)["Cache-Control"] == REVALIDATE
+        assert "Content-Encoding" not in dict(headers)
+
+        assert static_files.select("../test_static_files.py") is None